@@ -116,6 +116,15 @@ LogEnabled = True
 """Whether to log all SQL statements."""
 LogSQL = False
 
+"""
+Whether to collect execution statistics of database queries, available
+as db.profiler.report() in the console.
+"""
+DBProfileQueries = False
+
+"""Seconds after which a profiled query has its query plan logged."""
+DBSlowQueryThreshold = 0.5
+
 """URLs for download list, changelog and submitting feedback."""
 DownloadURL  = "http://erki.lap.ee/downloads/Skyperious/"
 ChangelogURL = "http://suurjaak.github.com/Skyperious/changelog.html"
@@ -275,6 +284,96 @@ StatusFlashLength = 30000
 """How many items in the Recent Files menu."""
 MaxRecentFiles = 20
 
+"""
+Maximum number of read-only connections opened per database for concurrent
+reading, in addition to the main connection.
+"""
+DBReadConnectionsMax = 4
+
+"""
+Seconds to wait for a free read-only connection, before falling back to the
+main database connection.
+"""
+DBReadConnectionTimeout = 10
+
+"""
+Maximum estimated size of chat messages kept in memory per database, in bytes.
+Least recently viewed chats are dropped first.
+"""
+MessageCacheSize = 500 * 1024 * 1024
+
+"""
+Number of chats above and below the opened chat in the chats list, whose
+messages are loaded and parsed in the background for faster opening.
+"""
+ChatPrefetchNeighbours = 2
+
+"""
+Number of most recently active chats whose messages are loaded and parsed
+in the background for faster opening.
+"""
+ChatPrefetchRecent = 3
+
+"""Pause before prefetching each chat in the background, in seconds."""
+ChatPrefetchDelay = 0.5
+
+"""
+Number of BLOB values like contact avatars kept in memory per database,
+other BLOBs are retrieved from the database on demand.
+"""
+BlobCacheSize = 100
+
+"""
+Memory-mapped I/O size for read-only database connections, in bytes
+(PRAGMA mmap_size).
+"""
+DBMmapSize = 256 * 1024 * 1024
+
+"""Page cache size for databases opened in read-only mode, in bytes."""
+DBCacheSize = 64 * 1024 * 1024
+
+"""Whether databases are opened in read-only mode, refusing all changes."""
+DBOpenReadOnly = False
+
+"""
+Named SQLite PRAGMA settings applied around database operations, previous
+values being restored afterwards: "browse" is set on opening a connection,
+"bulk-write" is used for merging and recovering data, "scan" for searching
+and exporting.
+"""
+DBPragmaProfiles = {
+    "browse":     {"cache_size": -8192, "temp_store": "DEFAULT"},
+    "bulk-write": {"cache_size": -131072, "synchronous": "NORMAL",
+                   "temp_store": "MEMORY"},
+    "scan":       {"cache_size": -65536, "temp_store": "MEMORY"},
+}
+
+"""
+Whether to keep an index database for each opened Skype database, for faster
+message and statistics queries. Skype databases themselves are not changed.
+"""
+DBSidecarEnabled = False
+
+"""Directory for index databases, named by Skype database path."""
+DBSidecarDirectory = os.path.join(ApplicationDirectory, "indexes")
+
+"""
+Whether to keep a term frequency index of message words per chat, author and
+month in the index database, for word clouds over any chat or period.
+Indexing parses all messages once, new messages are indexed incrementally.
+"""
+DBTermIndexEnabled = False
+
+"""
+File for caching database metadata like chat statistics and table row counts
+across program sessions, next to ConfigFile.
+"""
+DBMetadataCacheFile = "%s.cache" % os.path.join(ApplicationDirectory,
+                                                Title.lower())
+
+"""Maximum number of databases to keep cached metadata for."""
+DBMetadataCacheLimit = 20
+
 
 def load():
     """Loads FileDirectives from ConfigFile into this module's attributes."""
@@ -84,27 +84,30 @@ def export_chats(chats, path, format, db, messages=None, skip=True):
                    "" if len(format) > 4 else "as %s " % format.upper(),
                    format if len(format) > 4 else path)
 
-    if format.lower().endswith(".xlsx"):
-        filename = make_filename(chats[0])
-        count = export_chats_xlsx(chats, filename, db, messages, skip)
-        files.append(filename)
-    else:
-        export_func = (export_chats_xlsx if format.lower().endswith("xlsx")
-                       else export_chat_csv if format.lower().endswith("csv")
-                       else export_chat_template)
-        for chat in chats:
-            if skip and not messages and not chat["message_count"]:
-                main.log("Skipping exporting %s: no messages.",
-                         chat["title_long_lc"])
-                continue
-            main.status("Exporting %s.", chat["title_long_lc"])
-            wx.SafeYield()
-            filename = make_filename(chat)
-            msgs = messages or db.get_messages(chat)
-            chatarg = [chat] if "xlsx" == format.lower() else chat
-            export_func(chatarg, filename, db, msgs)
+    with db.read_connection("scan"):
+        if format.lower().endswith(".xlsx"):
+            filename = make_filename(chats[0])
+            count = export_chats_xlsx(chats, filename, db, messages, skip)
             files.append(filename)
-        count = len(files)
+        else:
+            fmt = format.lower()
+            export_func = (export_chats_xlsx if fmt.endswith("xlsx")
+                           else export_chat_csv if fmt.endswith("csv")
+                           else export_chat_template)
+            for chat in chats:
+                if skip and not messages and not chat["message_count"]:
+                    main.log("Skipping exporting %s: no messages.",
+                             chat["title_long_lc"])
+                    continue
+                main.status("Exporting %s.", chat["title_long_lc"])
+                wx.SafeYield()
+                filename = make_filename(chat)
+                fields = skypedata.MESSAGE_FIELDS["export"]
+                msgs = messages or db.get_messages(chat, fields=fields)
+                chatarg = [chat] if "xlsx" == format.lower() else chat
+                export_func(chatarg, filename, db, msgs)
+                files.append(filename)
+            count = len(files)
     return (files, count)
 
 
@@ -135,7 +138,8 @@ def export_chats_xlsx(chats, filename, db, messages=None, skip=True):
         writer.writerow(["Time", "Author", "Message", "Skype Name"],
                         {3: "boldhidden"})
         writer.set_header(False)
-        msgs = messages or db.get_messages(chat)
+        fields = skypedata.MESSAGE_FIELDS["export"]
+        msgs = messages or db.get_messages(chat, fields=fields)
         for i, m in enumerate(msgs):
             text = parser.parse(m, text={"wrap": False})
             try:
@@ -175,17 +179,21 @@ def export_chat_template(chat, filename, db, messages):
                 img = wx.ImageFromStream(cStringIO.StringIO(raw))
                 namespace.update(chat_picture=img, chat_picture_raw=raw)
             for p in chat["participants"]:
-                contact = p["contact"].copy()
+                # Leave out BLOBs not yet retrieved, avatars are taken below
+                contact = p["contact"].copy(load=False) \
+                          if isinstance(p["contact"], skypedata.LazyRow) \
+                          else p["contact"].copy()
                 namespace["participants"].append(contact)
                 contact.update(avatar_image_raw="", avatar_image_large_raw="")
                 bmp = contact.get("avatar_bitmap")
                 if not bmp:
-                    bmp = skypedata.get_avatar(contact, conf.AvatarImageSize)
+                    bmp = skypedata.get_avatar(p["contact"],
+                                               conf.AvatarImageSize)
                     if bmp:
                         p["contact"]["avatar_bitmap"] = bmp # Cache resized
                 if bmp:
                     size = conf.AvatarImageLargeSize
-                    raw_large = skypedata.get_avatar_jpg(contact, size)
+                    raw_large = skypedata.get_avatar_jpg(p["contact"], size)
                     contact["avatar_image_raw"] = util.bitmap_to_raw(bmp)
                     contact["avatar_image_large_raw"] = raw_large
 
@@ -11,12 +11,16 @@ Released under the MIT License.
 @modified    16.11.2013
 ------------------------------------------------------------------------------
 """
+import bisect
 import cgi
 import collections
+import contextlib
 import copy
 import cStringIO
 import csv
 import datetime
+import hashlib
+import json
 import math
 import os
 import Queue
@@ -24,8 +28,10 @@ import re
 import sqlite3
 import shutil
 import string
+import struct
 import sys
 import textwrap
+import threading
 import time
 import traceback
 import urllib
@@ -33,6 +39,7 @@ import wx
 import wx.lib.wordwrap
 import wx.grid
 import xml.etree.cElementTree
+import zlib
 
 import conf
 import emoticons
@@ -66,6 +73,17 @@ MESSAGES_TYPE_FILE         =  68 # File transfer
 MESSAGES_TYPE_BIRTHDAY     = 110 # Birthday notification
 TRANSFER_TYPE_OUTBOUND     =   1 # Transfer sent by partner_handle
 TRANSFER_TYPE_INBOUND      =   2 # Transfer sent to partner_handle
+# Message columns needed by MessageParser.parse()
+MESSAGE_FIELDS_PARSE = ["author", "body_xml", "edited_timestamp",
+                        "from_dispname", "guid", "id", "identities",
+                        "timestamp", "type"]
+# Message columns needed by consumers, for get_messages(fields=..)
+MESSAGE_FIELDS = {
+    "search": MESSAGE_FIELDS_PARSE + ["convo_id"],
+    "diff":   MESSAGE_FIELDS_PARSE + ["remote_id"],
+    "stats":  MESSAGE_FIELDS_PARSE,
+    "export": MESSAGE_FIELDS_PARSE,
+}
 CONTACT_FIELD_TITLES = {
     "displayname" : "Display name",
     "skypename"   : "Skype Name",
@@ -128,15 +146,54 @@ class SkypeDatabase(object):
       "voicemails": "CREATE TABLE Voicemails (id INTEGER NOT NULL PRIMARY KEY, is_permanent INTEGER, type INTEGER, partner_handle TEXT, partner_dispname TEXT, status INTEGER, failurereason INTEGER, subject TEXT, timestamp INTEGER, duration INTEGER, allowed_duration INTEGER, playback_progress INTEGER, convo_id INTEGER, chatmsg_guid BLOB, notification_id INTEGER, flags INTEGER, size INTEGER, path TEXT, failures INTEGER, vflags INTEGER, xmsg TEXT, extprop_hide_from_history INTEGER)",
     }
 
+    """Maximum number of cached query column maps in row_factory."""
+    ROW_COLUMNS_MAX = 100
+
+    """Number of messages read at a time in uncached message queries."""
+    MESSAGES_CHUNK = 1000
+
+    """Leading keywords of SQL statements that do not change table data."""
+    READ_KEYWORDS = ("SELECT", "PRAGMA", "EXPLAIN", "ATTACH", "DETACH",
+                     "BEGIN", "COMMIT", "END", "ROLLBACK", "SAVEPOINT",
+                     "RELEASE")
+
+    """Regex for the table changed by an INSERT, UPDATE or DELETE statement."""
+    WRITE_RGX = re.compile(r"^\s*(?:(?:INSERT|REPLACE|INSERT\s+OR\s+\w+)\s+"
+                           r"INTO|UPDATE(?:\s+OR\s+\w+)?|DELETE\s+FROM)\s+"
+                           r"(?:\w+\.)?[\[\"`']?(\w+)", re.I)
+
+    """Regex for an INSERT statement that cannot replace existing rows."""
+    APPEND_RGX = re.compile(r"^\s*INSERT\s+(?:OR\s+(?:ABORT|FAIL|IGNORE|"
+                            r"ROLLBACK)\s+)?INTO\s", re.I)
+
+    """Tables that cached rows depend on, if other than the cache name."""
+    CACHE_DEPENDENCIES = {
+        "conversations": ["conversations", "participants", "contacts",
+                          "accounts"],
+        "videos":        ["videos", "calls"],
+    }
+
+    """Cached tables that can be refreshed by loading only new rows."""
+    APPENDABLE_TABLES = ["calls", "messages", "smses", "transfers"]
 
-    def __init__(self, filename, log_error=True):
+
+    def __init__(self, filename, log_error=True, read_only=False,
+                 immutable=False):
         """
         Initializes a new Skype database object from the file.
 
         @param   log_error  if False, exceptions on opening the database
                             are not written to log (written by default)
+        @param   read_only  if True, the database is opened in read-only mode,
+                            refusing all changes
+        @param   immutable  if True, the database is opened in read-only mode
+                            and assumed to not change while open, skipping
+                            all file locking (for snapshot copies and files
+                            on read-only media)
         """
         self.filename = filename
+        self.read_only = read_only or immutable
+        self.immutable = immutable
         self.basefilename = os.path.basename(self.filename)
         self.backup_created = False
         self.consumers = set() # Registered objects, notified on clearing cache
@@ -144,19 +201,61 @@ class SkypeDatabase(object):
         self.id = None   # Accounts.skypename
         self.tables = {} # {"name": {"Name":str, "rows": 0, "columns": []}, }
         self.tables_list = None # Ordered list of table items
+        # Last exact table row counts, as {"tablename1": {"rows": int,
+        # "max_rowid": int, "version": (data_version, total_changes)}}
+        self.table_counts = {}
+        # For accessing tables and table_counts, updated also by row count
+        # threads
+        self.tables_lock = threading.RLock()
         self.table_rows = {}    # {"tablename1": [..], }
         self.table_objects = {} # {"tablename1": {id1: {rowdata1}, }, }
+        # Cached rows grouped by column value, built on first lookup, as
+        # {"tablename1": {"column1": {value1: [{rowdata1}, ], }, }, }
+        self.table_indexes = {}
+        # Recently retrieved BLOB values, as {(table, rowid, column): value}
+        self.blob_cache = collections.OrderedDict()
+        self.blob_lock = threading.Lock() # For accessing blob_cache
         self.table_grids = {}   # {"tablename1": TableBase, }
+        # Tables changed via the main connection since cache was last
+        # cleared, "*" if unknown tables were changed
+        self.tables_changed = set()
+        # Whether the main connection has changes not yet committed, which
+        # pooled read connections do not see
+        self.in_transaction = False
+        # Database state when cache was last cleared, as {"version":
+        # (data_version, total_changes), "size": int, "mtime": float,
+        # "rowids": {"tablename1": max rowid, }, "counts": {"tablename1":
+        # row count, } for cached tables that can be appended to}
+        self.change_state = None
+        # Column index maps for row_factory, as
+        # {id(cursor.description): (cursor.description, {name: index})}
+        self.row_columns = {}
+        self.pool = None # ConnectionPool for concurrent read-only queries
+        self.sidecar = None # SidecarIndex, if opened
+        self.profiler = QueryProfiler(conf.DBProfileQueries)
+        # Precomputed metadata like chat statistics, with the data version
+        # it was computed at, as {"chats": (version, {chat ID: [..]}), }
+        self.metadata = {}
+        self.metadata_loaded = False # Whether to save metadata on closing
+        # Prepared INSERT statements, as {(table, ((column, type), )):
+        # InsertPlan}
+        self.insert_plans = {}
+        # Per-chat message lists, kept in table_rows["messages"]
+        self.message_cache = MessageCache(conf.MessageCacheSize)
+        # Message counts per day and author, as {chat ID: DailyStatistics}
+        self.daily_stats = {}
         self.update_fileinfo()
         try:
-            self.connection = sqlite3.connect(self.filename,
-                                              check_same_thread=False)
-            self.connection.row_factory = self.row_factory
-            self.connection.text_factory = str
+            self.connection = self.connect(self.read_only)
+            if self.read_only:
+                self.connection.execute("PRAGMA cache_size = -%d"
+                                        % (conf.DBCacheSize / 1024))
             rows = self.execute("SELECT name, sql FROM sqlite_master "
                                 "WHERE type = 'table'").fetchall()
             for row in rows:
                 self.tables[row["name"].lower()] = row
+            self.pool = ConnectionPool(lambda: self.connect(read_only=True),
+                                       conf.DBReadConnectionsMax)
         except Exception, e:
             if log_error:
                 main.log("Error opening database %s.\n\n%s",
@@ -165,15 +264,12 @@ class SkypeDatabase(object):
             raise
 
         try:
-            self.account = self.execute("SELECT *, "
-                "COALESCE(fullname, displayname, skypename, '') AS name, "
-                "skypename AS identity FROM accounts LIMIT 1"
-            ).fetchone()
-            self.id = self.account["skypename"]
+            self.update_accountinfo(log_error=False)
         except Exception, e:
             if log_error:
                 main.log("Error getting account information from %s.\n\n%s",
                          filename, traceback.format_exc())
+        self.mark_unchanged()
 
 
     def __str__(self):
@@ -181,6 +277,87 @@ class SkypeDatabase(object):
             return self.filename
 
 
+    def connect(self, read_only=False):
+        """
+        Opens and returns a new connection to the database file. Read-only
+        connections are opened via URI if supported by SQLite, and with
+        PRAGMA query_only otherwise, and use memory-mapped I/O.
+        """
+        result = None
+        if read_only and is_uri_supported():
+            path = os.path.abspath(self.filename)
+            uri = "file:%s?mode=ro%s" % (urllib.pathname2url(path),
+                  "&immutable=1" if self.immutable else "")
+            result = sqlite3.connect(uri, check_same_thread=False)
+        if not result:
+            result = sqlite3.connect(self.filename, check_same_thread=False)
+            if read_only:
+                result.execute("PRAGMA query_only = ON")
+        self.apply_pragmas(conf.DBPragmaProfiles.get("browse") or {}, result)
+        if read_only:
+            result.execute("PRAGMA mmap_size = %d" % conf.DBMmapSize)
+        result.row_factory = self.row_factory
+        result.text_factory = str
+        return result
+
+
+    def apply_pragmas(self, pragmas, connection=None, schema=None):
+        """
+        Sets the specified PRAGMA values on the connection.
+
+        @param   pragmas     {pragma name: value}
+        @param   connection  connection to use if not the main connection
+        @param   schema      name of attached database to use, if not main
+        @return              {pragma name: previous value}
+        """
+        result = {}
+        connection = connection or self.connection
+        prefix = "%s." % schema if schema else ""
+        for name, value in sorted(pragmas.items()):
+            if not re.match("^\\w+$", name) \
+            or not re.match("^-?\\w+$", str(value)):
+                main.log("Invalid PRAGMA %s = %r, skipping.", name, value)
+                continue # continue for name, value in sorted(..)
+            try:
+                sql = "PRAGMA %s%s" % (prefix, name)
+                row = connection.execute(sql).fetchone()
+                connection.execute("%s = %s" % (sql, value))
+                if row is not None:
+                    result[name] = row[name] if isinstance(row, Row) \
+                                   else row[0]
+            except Exception:
+                main.log("Error setting PRAGMA %s = %s in %s.\n\n%s", name,
+                         value, self.filename, traceback.format_exc())
+        return result
+
+
+    @contextlib.contextmanager
+    def pragma_profile(self, name, connection=None, schema=None):
+        """
+        Context manager applying the named PRAGMA profile from
+        conf.DBPragmaProfiles to the connection, restoring previous values
+        on exit.
+
+        @param   name        profile name, like "bulk-write" or "scan"
+        @param   connection  connection to use if not the main connection
+        @param   schema      name of attached database to use, if not main
+        """
+        connection = connection or self.connection
+        pragmas = conf.DBPragmaProfiles.get(name) or {}
+        main.log("Applying \"%s\" profile to %s (%s).", name, self.filename,
+                 ", ".join("%s=%s" % x for x in sorted(pragmas.items())))
+        previous = self.apply_pragmas(pragmas, connection, schema)
+        try:
+            yield connection
+        finally:
+            try:
+                self.apply_pragmas(previous, connection, schema)
+                main.log("Restored settings from \"%s\" profile in %s.",
+                         name, self.filename)
+            except Exception:
+                pass # Connection may already be closed
+
+
     def check_integrity(self):
         """Checks SQLite database integrity, returning a list of errors."""
         result = []
@@ -199,60 +376,217 @@ class SkypeDatabase(object):
         result = []
         with open(filename, "w") as _: pass # Truncate file
         self.execute("ATTACH DATABASE ? AS new", (filename, ))
-        # Create structure for all tables
-        for t in filter(lambda x: x.get("sql"), self.tables_list):
-            if t["name"].lower().startswith("sqlite_"): continue # Internal use
-            sql  = t["sql"].replace("CREATE TABLE ", "CREATE TABLE new.")
-            self.execute(sql)
-        # Copy data from all tables
-        for t in filter(lambda x: x.get("sql"), self.tables_list):
-            if t["name"].lower().startswith("sqlite_"): continue # Internal use
-            sql = "INSERT INTO new.%(name)s SELECT * FROM main.%(name)s" % t
-            try:
+        with self.pragma_profile("bulk-write", schema="new"):
+            # Create structure for all tables
+            for t in filter(lambda x: x.get("sql"), self.tables_list):
+                if t["name"].lower().startswith("sqlite_"):
+                    continue # Skip tables for internal use
+                sql  = t["sql"].replace("CREATE TABLE ", "CREATE TABLE new.")
                 self.execute(sql)
-            except Exception as e:
-                result.append(repr(e))
-                main.log("Error copying table %s from %s to %s.\n\n%s",
-                         t["name"], self.filename, filename,
-                         traceback.format_exc())
-        # Create indexes
-        indexes = []
-        try:
-            sql = "SELECT * FROM sqlite_master WHERE TYPE = ?"
-            indexes = self.execute(sql, ("index", )).fetchall()
-        except Exception as e:
-            result.append(repr(e))
-            main.log("Error getting indexes from %s.\n\n%s",
-                     self.filename, traceback.format_exc())
-        for i in filter(lambda x: x.get("sql"), indexes):
-            sql  = i["sql"].replace("CREATE INDEX ", "CREATE INDEX new.")
+            # Copy data from all tables
+            for t in filter(lambda x: x.get("sql"), self.tables_list):
+                if t["name"].lower().startswith("sqlite_"):
+                    continue # Skip tables for internal use
+                sql = "INSERT INTO new.%(name)s SELECT * FROM main.%(name)s" % t
+                try:
+                    self.execute(sql)
+                except Exception as e:
+                    result.append(repr(e))
+                    main.log("Error copying table %s from %s to %s.\n\n%s",
+                             t["name"], self.filename, filename,
+                             traceback.format_exc())
+            # Create indexes
+            indexes = []
             try:
-                self.execute(sql)
+                sql = "SELECT * FROM sqlite_master WHERE TYPE = ?"
+                indexes = self.execute(sql, ("index", )).fetchall()
             except Exception as e:
                 result.append(repr(e))
-                main.log("Error creating index %s for %s.\n\n%s",
-                         i["name"], filename, traceback.format_exc())
+                main.log("Error getting indexes from %s.\n\n%s",
+                         self.filename, traceback.format_exc())
+            for i in filter(lambda x: x.get("sql"), indexes):
+                sql  = i["sql"].replace("CREATE INDEX ", "CREATE INDEX new.")
+                try:
+                    self.execute(sql)
+                except Exception as e:
+                    result.append(repr(e))
+                    main.log("Error creating index %s for %s.\n\n%s",
+                             i["name"], filename, traceback.format_exc())
         self.execute("DETACH DATABASE new")
         return result
 
 
-    def clear_cache(self):
-        """Clears all the currently cached rows."""
-        self.table_rows.clear()
-        self.table_objects.clear()
+    def clear_cache(self, full=False):
+        """
+        Clears currently cached rows of tables changed since last clearing,
+        and statistics derived from them. Rows added to message, transfer, SMS
+        and call tables by other programs are loaded into the cache instead,
+        if no earlier rows were deleted.
+
+        @param   full  if True, all cached rows are cleared
+        """
+        changes = None if full else self.get_changed_tables()
+        if changes is None:
+            self.table_rows.clear()
+            self.table_objects.clear()
+            self.table_indexes.clear()
+            self.message_cache.clear()
+            self.daily_stats.clear()
+            with self.blob_lock:
+                self.blob_cache.clear()
+        elif changes:
+            main.log("Refreshing cache for changed tables in %s: %s.",
+                     self.filename, ", ".join(sorted(changes)))
+            rowids = self.change_state["rowids"]
+            for name in self.APPENDABLE_TABLES:
+                if "appended" == changes.get(name) \
+                and (name in self.table_rows or name in self.table_objects):
+                    self.load_new_rows(name, rowids.get(name) or 0)
+            for name in set(self.table_rows) | set(self.table_objects):
+                dependencies = self.CACHE_DEPENDENCIES.get(name, [name])
+                states = [changes.get(t) for t in dependencies]
+                if "changed" in states or ("appended" in states
+                and name not in self.APPENDABLE_TABLES):
+                    self.table_rows.pop(name, None)
+                    self.table_objects.pop(name, None)
+                    self.table_indexes.pop(name, None)
+                    if "messages" == name:
+                        self.message_cache.clear()
+            if "changed" in (changes.get("messages"), changes.get("transfers")):
+                self.daily_stats.clear()
+            with self.blob_lock:
+                for key in [k for k in self.blob_cache if k[0] in changes]:
+                    del self.blob_cache[key]
+        self.mark_unchanged()
         self.get_tables(True)
 
 
-    def update_accountinfo(self):
-        """Refreshes Skype account information."""
+    def get_changed_tables(self):
+        """
+        Returns tables changed since cache was last cleared, as
+        {"tablename1": "appended" if only new rows were detected, or "changed"},
+        or None if changes cannot be determined. After changes by other
+        programs, all tables are taken as changed, except cached tables that
+        can be appended to, where rows were only added: the largest ROWID
+        grew and the count of earlier rows is the same.
+        """
+        state = self.change_state
+        if not state or "*" in self.tables_changed:
+            return None
+        result = dict((t, "changed") for t in self.tables_changed)
+        version = self.get_data_version()
+        stat = os.stat(self.filename)
+        if version[0] is not None and state["version"][0] is not None:
+            external = (version[0] != state["version"][0])
+        else: # PRAGMA data_version not supported, fall back to file info
+            external = ((stat.st_size, stat.st_mtime)
+                        != (state["size"], state["mtime"]))
+        if external:
+            for name in self.tables:
+                if name in result:
+                    continue # continue for name in self.tables
+                result[name] = "changed"
+                max_rowid_old = state["rowids"].get(name)
+                count_old, counted = state["counts"].get(name), \
+                                     self.table_counts.get(name)
+                if count_old is None and counted \
+                and counted["version"] == state["version"]:
+                    count_old = counted["rows"]
+                if max_rowid_old is None or count_old is None \
+                or not self.get_max_rowid(name) > max_rowid_old:
+                    continue # continue for name in self.tables
+                row = self.execute("SELECT COUNT(*) AS count FROM %s "
+                                   "WHERE rowid <= ?" % name,
+                                   [max_rowid_old], log=False).fetchone()
+                if row["count"] == count_old:
+                    result[name] = "appended"
+        return result
+
+
+    def mark_unchanged(self):
+        """
+        Records current database state for detecting subsequent changes,
+        counting rows in cached tables that can be appended to, if not
+        counted at this state already.
+        """
+        stat = os.stat(self.filename)
+        version, counts = self.get_data_version(), {}
+        for name in self.APPENDABLE_TABLES:
+            if name in self.tables \
+            and (name in self.table_rows or name in self.table_objects):
+                counted = self.table_counts.get(name)
+                counts[name] = counted["rows"] if counted \
+                               and counted["version"] == version \
+                               else self.count_table_rows(name)
+        self.change_state = {"version": version,
+            "size": stat.st_size, "mtime": stat.st_mtime,
+            "rowids": dict((t, self.get_max_rowid(t)) for t in self.tables),
+            "counts": counts}
+        self.tables_changed.clear()
+
+
+    def load_new_rows(self, table, max_rowid):
+        """
+        Loads rows added to the table beyond the specified ROWID into
+        currently cached rows of the table.
+        """
+        if "messages" == table:
+            chat_messages = self.table_rows["messages"]
+            chat_ids = {} # {convo_id: set(IDs of cached new messages)}
+            sql = "SELECT m.* FROM messages m WHERE m.id > ? AND m.type IN " \
+                  "(2, 10, 12, 13, 30, 39, 51, 60, 61, 63, 64, 68)"
+            for message in self.execute(sql, [max_rowid]).fetchall():
+                messages = chat_messages.peek(message["convo_id"])
+                if messages is None:
+                    continue # continue for message in self.execute(..)
+                if message["convo_id"] not in chat_ids:
+                    chat_ids[message["convo_id"]] = set(m["id"]
+                        for m in messages if m["id"] > max_rowid)
+                if message["id"] in chat_ids[message["convo_id"]]:
+                    continue # continue for message in self.execute(..)
+                message["datetime"] = None
+                if message["timestamp"]:
+                    message["datetime"] = datetime.datetime.fromtimestamp(
+                        message["timestamp"])
+                chat_messages.add(message["convo_id"], message)
+            for convo_id in chat_ids:
+                chat_messages.update_size(convo_id)
+        else:
+            rows = self.table_rows.get(table, [])
+            objects = self.table_objects.get(table)
+            indexes = self.table_indexes.get(table, {})
+            ids = set(r["id"] for r in rows if r["id"] > max_rowid)
+            sql = "SELECT * FROM %s WHERE id > ? ORDER BY id" % table
+            for row in self.execute(sql, [max_rowid]).fetchall():
+                if row["id"] in ids:
+                    continue # continue for row in self.execute(..)
+                if table in self.table_rows:
+                    rows.append(row)
+                if objects is not None:
+                    objects[row["id"]] = row
+                for column, index in indexes.items():
+                    key = self.make_index_key(row[column])
+                    index.setdefault(key, []).append(row)
+
+
+    def update_accountinfo(self, log_error=True):
+        """
+        Refreshes Skype account information.
+
+        @param   log_error  if False, errors are raised instead of logged
+        """
         try:
-            self.account = self.execute("SELECT *, "
+            row = self.execute("SELECT %s, "
                 "COALESCE(fullname, displayname, skypename, '') AS name, "
-                "skypename AS identity FROM accounts LIMIT 1").fetchone()
+                "skypename AS identity FROM accounts LIMIT 1"
+                % self.get_columns_sql("accounts")).fetchone()
+            self.account = self.defer_blobs("accounts", row) if row else None
             self.id = self.account["skypename"]
         except Exception, e:
+            if not log_error:
+                raise
             main.log("Error getting account information from %s.\n\n%s",
-                     filename, traceback.format_exc())
+                     self.filename, traceback.format_exc())
 
 
     def register_consumer(self, consumer):
@@ -276,6 +610,16 @@ class SkypeDatabase(object):
 
     def close(self):
         """Closes the database and frees all allocated data."""
+        if getattr(self, "metadata_loaded", False) and self.is_open():
+            self.save_metadata()
+        if getattr(self, "sidecar", None):
+            self.sidecar.close()
+            self.sidecar = None
+        if getattr(self, "pool", None):
+            main.log("Closing read connections to %s, usage statistics: %s.",
+                     self.filename, self.pool.stats)
+            self.pool.close()
+            self.pool = None
         if hasattr(self, "connection"):
             try:
                 self.connection.close()
@@ -284,20 +628,254 @@ class SkypeDatabase(object):
             del self.connection
             self.connection = None
         for attr in ["tables", "tables_list", "table_rows",
-        "table_grids", "table_objects"]:
+        "table_grids", "table_objects", "table_indexes", "blob_cache"]:
             if hasattr(self, attr):
                 delattr(self, attr)
                 setattr(self, attr, None if ("tables_list" == attr) else {})
 
 
-    def execute(self, sql, params=[], log=True):
-        """Shorthand for self.connection.execute()."""
+    def execute(self, sql, params=[], log=True, connection=None):
+        """
+        Shorthand for self.connection.execute().
+
+        @param   connection  connection to execute on if not the main
+                             connection, e.g. from read_connection()
+        """
         result = None
         if self.connection:
             if log and conf.LogSQL:
                 main.log("SQL: %s%s", sql,
                          ("\nParameters: %s" % params) if params else "")
-            result = self.connection.execute(sql, params)
+            if isinstance(params, Row):
+                params = params.copy() # sqlite3 binds names from dicts only
+            if not connection \
+            and not sql.lstrip()[:9].upper().startswith(self.READ_KEYWORDS):
+                match = self.WRITE_RGX.match(sql)
+                table = match.group(1).lower() if match else "*"
+                self.tables_changed.add(table)
+                self.in_transaction = True
+                if not self.APPEND_RGX.match(sql):
+                    if table in ("messages", "transfers", "*"):
+                        self.daily_stats.clear() # Counted rows have changed
+                    if self.sidecar:
+                        self.sidecar.invalidate(table)
+            if self.profiler.enabled:
+                result = self.profiler.execute(connection or self.connection,
+                                               sql, params, self.get_caller())
+            else:
+                result = (connection or self.connection).execute(sql, params)
+        return result
+
+
+    def commit(self):
+        """Commits pending changes on the main connection."""
+        self.connection.commit()
+        self.in_transaction = False
+
+
+    def get_caller(self):
+        """
+        Returns the name of the function that called execute(), and of the
+        first calling function outside its module, like
+        "skypedata.get_messages (workers.run)".
+        """
+        names = []
+        frame = sys._getframe(2)
+        while frame and len(names) < 2:
+            module = os.path.splitext(
+                os.path.basename(frame.f_code.co_filename))[0]
+            if "contextlib" != module \
+            and (not names or not names[0].startswith(module + ".")):
+                names.append("%s.%s" % (module, frame.f_code.co_name))
+            frame = frame.f_back
+        return names[0] + (" (%s)" % names[1] if len(names) > 1 else "")
+
+
+    @contextlib.contextmanager
+    def read_connection(self, profile=None):
+        """
+        Context manager for a read-only connection from the pool, checked out
+        for the current thread. Yields the main connection if no pooled
+        connection is available, or if the main connection has uncommitted
+        changes, so that reads during e.g. merging see them. Results must be
+        fully fetched within the context, as a pending statement keeps the
+        connection from other readers and holds a read lock on the database.
+
+        @param   profile  name of PRAGMA profile to apply for the duration,
+                          also in effect for nested reads in the same thread
+        """
+        pool, connection = self.pool, None
+        if pool and not self.in_transaction:
+            connection = pool.acquire(conf.DBReadConnectionTimeout)
+        try:
+            if profile:
+                with self.pragma_profile(profile, connection) as c:
+                    yield c
+            else:
+                yield connection or self.connection
+        finally:
+            if connection:
+                pool.release(connection)
+
+
+    def open_sidecar(self):
+        """
+        Opens the index database kept for this database in
+        conf.DBSidecarDirectory, and brings it up to date in the background.
+        """
+        if not self.sidecar and self.is_open():
+            path = os.path.normcase(os.path.abspath(self.filename))
+            name = "%s.db" % hashlib.md5(path.encode("utf-8")
+                                         if isinstance(path, unicode)
+                                         else path).hexdigest()
+            filename = os.path.join(conf.DBSidecarDirectory, name)
+            self.sidecar = SidecarIndex(self, filename)
+            self.sidecar.refresh()
+
+
+    def use_sidecar(self, connection, *tables):
+        """
+        Returns whether the index database is up to date for the specified
+        tables and attached to the connection as "sidecar", syncing it with
+        new rows first if needed.
+        """
+        sidecar = self.sidecar
+        return bool(sidecar and sidecar.sync() and sidecar.tables.issuperset(
+                    tables) and sidecar.attach(connection))
+
+
+    def load_metadata(self):
+        """
+        Loads metadata precomputed for this database in an earlier session
+        from conf.DBMetadataCacheFile: exact table row counts, chat statistics,
+        general and activity statistics. Metadata made for the same file
+        contents is used as is. If the file has changed, row counts are kept
+        as estimates to be counted again, and messages appended since are
+        added to chat statistics if no earlier messages have been deleted.
+        Metadata is saved again on closing the database.
+        """
+        if not self.is_open() or self.metadata_loaded:
+            return
+        self.metadata_loaded = True
+        cache = MetadataCache(conf.DBMetadataCacheFile)
+        entry = cache.get(self.filename)
+        if not entry:
+            return
+        same = (entry.get("identity") == self.get_file_identity())
+        version, rowids = self.get_data_version(), entry.get("rowids") or {}
+        current = dict((t, rowids.get(t) if same else self.get_max_rowid(t))
+                       for t in rowids if t in self.tables)
+        with self.tables_lock:
+            for table, rows in (entry.get("counts") or {}).items():
+                if table in current and table not in self.table_counts:
+                    # Counts from changed contents are only used as estimates
+                    self.table_counts[table] = {"rows": rows,
+                        "max_rowid": rowids[table],
+                        "version": version if same else None}
+        if self.table_counts and self.tables_list is not None:
+            self.get_tables(True) # Update rowcounts retrieved before loading
+        chats = entry.get("chats")
+        if chats is not None and not same:
+            max_rowid = rowids.get("messages")
+            if max_rowid is None or current.get("messages") < max_rowid \
+            or self.execute(
+                "SELECT COUNT(*) AS count FROM messages WHERE id <= ? "
+                "AND type IN (2, 10, 13, 51, 60, 61, 63, 64, 68)", [max_rowid]
+            ).fetchone()["count"] != sum(x[0] for x in chats.values()):
+                chats = None # Messages have been deleted
+            elif current["messages"] > max_rowid:
+                chats = self.update_chat_metadata(chats, max_rowid)
+        if chats is not None:
+            self.set_metadata("chats", chats)
+        for key in ["general", "activity"]:
+            if same and entry.get(key):
+                self.set_metadata(key, entry[key])
+        main.log("Loaded %s metadata for %s from %s.",
+                 "cached" if same else "partially cached", self.filename,
+                 conf.DBMetadataCacheFile)
+
+
+    def save_metadata(self):
+        """
+        Saves metadata valid for current database contents to
+        conf.DBMetadataCacheFile, keyed by database path.
+        """
+        version, tables = self.get_data_version(), self.tables
+        entry = {"identity": self.get_file_identity(),
+                 "rowids": dict((t, self.get_max_rowid(t)) for t in tables),
+                 "counts": dict((t, c["rows"])
+                                for t, c in self.table_counts.items()
+                                if c["version"] == version and t in tables)}
+        for key in ["chats", "general", "activity"]:
+            value = self.get_metadata(key)
+            if value is not None:
+                entry[key] = value
+        try:
+            cache = MetadataCache(conf.DBMetadataCacheFile,
+                                  conf.DBMetadataCacheLimit)
+            cache.set(self.filename, entry)
+        except Exception, e:
+            main.log("Error saving metadata for %s to %s.\n\n%s",
+                     self.filename, conf.DBMetadataCacheFile,
+                     traceback.format_exc())
+
+
+    def get_metadata(self, key):
+        """
+        Returns the metadata value if computed at current database contents,
+        else None.
+        """
+        version, value = self.metadata.get(key, (None, None))
+        if value is not None and version == self.get_data_version():
+            return value
+
+
+    def set_metadata(self, key, value):
+        """Stores the metadata value as computed at current database state."""
+        self.metadata[key] = (self.get_data_version(), value)
+
+
+    def update_chat_metadata(self, chats, max_rowid):
+        """
+        Returns chat statistics metadata with messages beyond the specified
+        ROWID added.
+
+        @param   chats  {"chat ID": [message count, first message timestamp,
+                                     last message timestamp]}
+        """
+        result = dict(chats)
+        rows = self.execute(
+            "SELECT convo_id, COUNT(*) AS count, MIN(timestamp) AS first, "
+            "MAX(timestamp) AS last FROM messages WHERE id > ? "
+            "AND type IN (2, 10, 13, 51, 60, 61, 63, 64, 68) "
+            "GROUP BY convo_id", [max_rowid]).fetchall()
+        for row in rows:
+            key = str(row["convo_id"])
+            count, first, last = result.get(key, [0, None, None])
+            first = min(filter(None, [first, row["first"]]) or [None])
+            last = max(filter(None, [last, row["last"]]) or [None])
+            result[key] = [count + row["count"], first, last]
+        return result
+
+
+    def get_file_identity(self):
+        """
+        Returns values identifying database file contents across program
+        sessions, as {"size": bytes, "mtime": timestamp, "counter": file
+        change counter from SQLite header, "wal": [size, mtime] of
+        write-ahead log if any}. PRAGMA data_version is only comparable
+        within the same connection.
+        """
+        stat = os.stat(self.filename)
+        result = {"size": stat.st_size, "mtime": stat.st_mtime}
+        with open(self.filename, "rb") as f:
+            f.seek(24)
+            header = f.read(4)
+        if len(header) == 4:
+            result["counter"] = struct.unpack(">L", header)[0]
+        if os.path.exists("%s-wal" % self.filename):
+            stat = os.stat("%s-wal" % self.filename)
+            result["wal"] = [stat.st_size, stat.st_mtime]
         return result
 
 
@@ -317,7 +895,7 @@ class SkypeDatabase(object):
         self.ensure_backup()
         res = self.execute(sql)
         affected_rows = res.rowcount
-        self.connection.commit()
+        self.commit()
         return affected_rows
 
 
@@ -359,7 +937,7 @@ class SkypeDatabase(object):
                 "UPDATE messages SET timestamp = timestamp + ? "
                 "WHERE timestamp > ?", [seconds, self.future_check_timestamp]
             )
-            self.connection.commit()
+            self.commit()
             self.last_modified = datetime.datetime.now()
 
 
@@ -371,45 +949,143 @@ class SkypeDatabase(object):
     def get_tables(self, refresh=False, this_table=None):
         """
         Returns the names and rowcounts of all tables in the database, as
-        [{"name": "tablename", "rows": 0, "sql": CREATE SQL}, ].
+        [{"name": "tablename", "rows": 0, "rows_estimated": False,
+          "sql": CREATE SQL}, ].
         Uses already retrieved cached values if possible, unless refreshing.
+        Rowcounts are exact for tables unchanged since last counted, and
+        fast estimates for others, to be counted with count_table_rows().
 
         @param   refresh     if True, information including rowcounts is
                              refreshed
         @param   this_table  if set, only information for this table is
-                                refreshed
-        """
-        if self.is_open() and (refresh or self.tables_list is None):
-            sql = "SELECT name, sql FROM sqlite_master WHERE type = 'table' " \
-                  "%sORDER BY name COLLATE NOCASE" % \
-                  ("AND name = ? " if this_table else "")
-            params = [this_table] if this_table else []
-            rows = self.execute(sql, params).fetchall()
-            tables = {}
-            tables_list = []
-            for row in rows:
-                table = row
-                table["rows"] = self.execute(
-                    "SELECT COUNT(*) AS count FROM %s" % table["name"], log=False
-                ).fetchone()["count"]
-                # Here and elsewhere in this module - table names are turned to
-                # lowercase when used as keys.
-                tables[table["name"].lower()] = table
-                tables_list.append(table)
+                                refreshed, with an exact rowcount
+        """
+        with self.tables_lock:
+            if self.is_open() and (refresh or self.tables_list is None):
+                self.load_tables(this_table)
+            return self.tables_list
+
+
+    def load_tables(self, this_table=None):
+        """
+        Loads table information into tables and tables_list, for all tables
+        or only the specified table, see get_tables(). Rowcounts of tables
+        changed since last counted are estimated as the last count plus the
+        number of rows beyond the last counted ROWID; tables where ROWIDs
+        have not only grown use ANALYZE statistics instead, if any.
+        """
+        sql = "SELECT name, sql FROM sqlite_master WHERE type = 'table' " \
+              "%sORDER BY name COLLATE NOCASE" % \
+              ("AND name = ? " if this_table else "")
+        params = [this_table] if this_table else []
+        rows = self.execute(sql, params).fetchall()
+        tables = {}
+        tables_list = []
+        version, estimates = self.get_data_version(), None
+        for row in rows:
+            table = row
+            table["rows"], table["rows_estimated"] = None, False
+            counted = self.table_counts.get(table["name"].lower())
+            if counted and counted["version"] != version and not this_table:
+                max_rowid = self.get_max_rowid(table["name"])
+                if None in (max_rowid, counted["max_rowid"]) \
+                or max_rowid < counted["max_rowid"]:
+                    counted = None # Rows deleted, last count is no base
             if this_table:
-                self.tables.update(tables)
-                for t in self.tables_list or []:
-                    if t["name"] == this_table:
-                        self.tables_list.remove(t)
-                if self.tables_list is None:
-                    self.tables_list = []
-                self.tables_list += tables_list
-                self.tables_list.sort(key=lambda x: x["name"])
+                table["rows"] = self.count_table_rows(table["name"])
+            elif counted and counted["version"] == version:
+                table["rows"] = counted["rows"]
+            elif counted:
+                # Assume new rows were appended since last count, rows
+                # deleted or changed in place are only seen on recount
+                table["rows"] = counted["rows"] + self.execute(
+                    "SELECT COUNT(*) AS count FROM %s WHERE rowid > ?" %
+                    table["name"], [counted["max_rowid"]], log=False
+                ).fetchone()["count"]
+                table["rows_estimated"] = True
             else:
-                self.tables = tables
-                self.tables_list = tables_list
+                if estimates is None:
+                    estimates = self.get_rowcount_estimates()
+                table["rows"] = estimates.get(table["name"].lower())
+                if table["rows"] is None:
+                    table["rows"] = self.get_max_rowid(table["name"]) or 0
+                table["rows_estimated"] = True
+            # Here and elsewhere in this module - table names are turned to
+            # lowercase when used as keys.
+            tables[table["name"].lower()] = table
+            tables_list.append(table)
+        if this_table:
+            self.tables.update(tables)
+            for t in self.tables_list or []:
+                if t["name"] == this_table:
+                    self.tables_list.remove(t)
+            if self.tables_list is None:
+                self.tables_list = []
+            self.tables_list += tables_list
+            self.tables_list.sort(key=lambda x: x["name"])
+        else:
+            self.tables = tables
+            self.tables_list = tables_list
+
+
+    def count_table_rows(self, table):
+        """
+        Returns the exact number of rows in the table, counted on a read-only
+        connection, and updates table information. Can be called from any
+        thread.
+        """
+        version = self.get_data_version()
+        with self.read_connection() as connection:
+            max_rowid = self.get_max_rowid(table, connection)
+            result = self.execute("SELECT COUNT(*) AS count FROM %s" % table,
+                                  log=False, connection=connection
+                                 ).fetchone()["count"]
+        with self.tables_lock:
+            self.table_counts[table.lower()] = {"rows": result,
+                "max_rowid": max_rowid, "version": version}
+            if table.lower() in self.tables:
+                self.tables[table.lower()]["rows"] = result
+                self.tables[table.lower()]["rows_estimated"] = False
+        return result
+
+
+    def get_max_rowid(self, table, connection=None):
+        """Returns the largest ROWID in the table, or None if not available."""
+        result = None
+        try:
+            result = self.execute("SELECT MAX(ROWID) AS id FROM %s" % table,
+                log=False, connection=connection).fetchone()["id"]
+        except Exception:
+            pass # Table without ROWID
+        return result
+
+
+    def get_rowcount_estimates(self):
+        """
+        Returns table row counts from ANALYZE statistics, if the database has
+        any, as {"tablename1": count, }.
+        """
+        result = {}
+        if "sqlite_stat1" in self.tables:
+            try:
+                for row in self.execute("SELECT tbl, stat FROM sqlite_stat1",
+                                        log=False).fetchall():
+                    if row["stat"] and row["tbl"]:
+                        result[row["tbl"].lower()] = \
+                            int(row["stat"].split()[0])
+            except Exception:
+                pass # Malformed or partial statistics
+        return result
 
-        return self.tables_list
+
+    def get_data_version(self):
+        """
+        Returns a value that changes whenever database content is changed, as
+        (PRAGMA data_version, changes made on main connection).
+        """
+        row = self.execute("PRAGMA data_version", log=False).fetchone()
+        data_version = row["data_version"] if row else None
+        return (data_version, self.connection.total_changes)
 
 
     def get_general_statistics(self, full=True):
@@ -420,13 +1096,21 @@ class SkypeDatabase(object):
                        and last chat
         """
         result = collections.defaultdict(str)
+        cached = self.get_metadata("general") if full else None
+        if cached:
+            result.update(cached)
+            return result
         if self.account:
             result.update({"name": self.account.get("name"),
                            "skypename": self.account.get("skypename")})
+        self.get_tables()
         for k, table in [("chats", "Conversations"), ("messages", "Messages"),
                        ("contacts", "Contacts"), ("transfers", "Transfers")]:
-            res = self.execute("SELECT COUNT(*) AS count FROM %s" % table)
-            result[k] = next(res, {}).get("count")
+            info = self.tables.get(table.lower())
+            if info and not info.get("rows_estimated"):
+                result[k] = info.get("rows")
+            else:
+                result[k] = self.count_table_rows(table)
 
         res = self.execute("SELECT m.*, COALESCE(NULLIF(c.displayname, ''), "
             "NULLIF(c.meta_topic, '')) AS chat_title, c.type AS chat_type "
@@ -471,12 +1155,67 @@ class SkypeDatabase(object):
                 % "!="[i], result).fetchone()
             result["messages_" + ("to", "from")[i]] = row["count"]
 
+        self.set_metadata("general", dict(result))
+        return result
+
+
+    def get_activity_statistics(self, chat_ids):
+        """
+        Returns message activity statistics for the chats, queried on a
+        read-only connection from the pool, so that it can run in several
+        threads at once.
+
+        @param   chat_ids  IDs of the chats to aggregate
+        @return            {"messages": count, "authors": {author: count},
+                            "days": {"YYYY-MM-DD": count}, "hours": [count, ],
+                            "first": first message info or None,
+                            "last": last message info or None,
+                            "chats": number of chats aggregated}, message
+                            info as {"timestamp", "author", "from_dispname",
+                            "chat_title", "chat_type"}
+        """
+        result = {"messages": 0, "authors": {}, "days": {}, "hours": [0] * 24,
+                  "first": None, "last": None, "chats": len(chat_ids)}
+        if not chat_ids or not self.is_open():
+            return result
+        where = "WHERE m.type IN " \
+                "(2, 10, 12, 13, 30, 39, 51, 60, 61, 63, 64, 68) " \
+                "AND m.convo_id IN (%s)" % ", ".join("%d" % int(i)
+                                                    for i in chat_ids)
+        with self.read_connection() as connection:
+            for row in self.execute(
+                "SELECT m.author, strftime('%%Y-%%m-%%d', m.timestamp, "
+                "'unixepoch', 'localtime') AS day, CAST(strftime('%%H', "
+                "m.timestamp, 'unixepoch', 'localtime') AS INTEGER) AS hour, "
+                "COUNT(*) AS count FROM messages m %s "
+                "GROUP BY m.author, day, hour" % where,
+                log=False, connection=connection
+            ).fetchall():
+                author, day, count = row["author"], row["day"], row["count"]
+                result["messages"] += count
+                result["authors"][author] = \
+                    result["authors"].get(author, 0) + count
+                if day is not None:
+                    result["days"][day] = result["days"].get(day, 0) + count
+                    result["hours"][row["hour"]] += count
+            for key, direction in [("first", "ASC"), ("last", "DESC")]:
+                row = self.execute(
+                    "SELECT m.timestamp, m.author, m.from_dispname, "
+                    "COALESCE(NULLIF(c.displayname, ''), NULLIF(c.meta_topic, "
+                    "'')) AS chat_title, c.type AS chat_type FROM messages m "
+                    "LEFT JOIN conversations c ON m.convo_id = c.id "
+                    "%s AND m.timestamp IS NOT NULL ORDER BY m.timestamp %s "
+                    "LIMIT 1" % (where, direction),
+                    log=False, connection=connection).fetchone()
+                if row:
+                    result[key] = dict((k, row[k]) for k in ["timestamp",
+                        "author", "from_dispname", "chat_title", "chat_type"])
         return result
 
 
     def get_messages(self, chat=None, ascending=True,
                      additional_sql=None, additional_params=None,
-                     timestamp_from=None, use_cache=True):
+                     timestamp_from=None, use_cache=True, fields=None):
         """
         Yields all the messages (or messages for the specified chat), as
         {"datetime": datetime, ..}, ordered from earliest to latest.
@@ -491,83 +1230,203 @@ class SkypeDatabase(object):
         @param   timestamp_from     timestamp beyond which messages will start
         @param   use_cache          whether to use cached values if available.
                                     The LIKE keywords will be ignored if True.
+        @param   fields             message columns to retrieve if not all,
+                                    like MESSAGE_FIELDS["search"]; "id" and
+                                    "timestamp" are always included. Messages
+                                    with only some columns are not cached.
         """
         if self.is_open() and "messages" in self.tables:
             if "messages" not in self.table_rows:
-                self.table_rows["messages"] = {} # {convo_id: [{msg1},]}
-            if not use_cache \
-            or not (chat and chat["id"] in self.table_rows["messages"]):
-                params = {}
-                # Take only message types we can handle
-                sql = "SELECT m.* FROM messages m "
-                if additional_sql and " c." in additional_sql:
-                    sql += "LEFT JOIN conversations c ON m.convo_id = c.id "
-                # Take only known and supported types of messages.
-                sql += "WHERE m.type IN " \
-                       "(2, 10, 12, 13, 30, 39, 51, 60, 61, 63, 64, 68)"
-                if chat:
-                    sql += " AND m.convo_id = :convo_id"
-                    params["convo_id"] = chat["id"]
-                if timestamp_from:
-                    sql += " AND m.timestamp %s :timestamp" % \
-                           (">" if ascending else "<")
-                    params["timestamp"] = timestamp_from
-                if additional_sql:
-                    sql += " AND (%s)" % additional_sql
-                    params.update(additional_params or {})
-                sql += " ORDER BY m.timestamp %s" \
-                    % ("ASC" if ascending else "DESC")
-                res = self.execute(sql, params)
+                self.message_cache.clear()
+                # {convo_id: [{msg1},]}
+                self.table_rows["messages"] = self.message_cache
+            cached = None
+            if chat and use_cache:
+                cached = self.table_rows["messages"].get(chat["id"])
+            if cached is None:
                 messages = []
-                message = res.fetchone()
-                while message:
-                    message["datetime"] = None
-                    if message["timestamp"]:
-                        message["datetime"] = datetime.datetime.fromtimestamp(
-                            message["timestamp"]
-                        )
-                    if chat and use_cache and len(params) == 1:
-                        messages.append(message)
-                    yield message
-                    message = res.fetchone()
-                if chat and use_cache and len(params) == 1:
+                cacheable = chat and use_cache and not fields
+                last = None # Last message read, for continuing after it
+                while True:
+                    with self.read_connection() as connection:
+                        sql, params = self.make_messages_query(connection,
+                            chat, ascending, additional_sql,
+                            additional_params, timestamp_from, fields, last)
+                        # Read uncached queries in chunks, as the reader
+                        # holds a lock on the database until read through
+                        if not cacheable:
+                            sql += " LIMIT %s" % self.MESSAGES_CHUNK
+                        rows = self.execute(sql, params,
+                                            connection=connection).fetchall()
+                    for message in rows:
+                        message["datetime"] = None
+                        if message["timestamp"]:
+                            message["datetime"] = \
+                                datetime.datetime.fromtimestamp(
+                                    message["timestamp"])
+                        if cacheable and len(params) == 1:
+                            messages.append(message)
+                        yield message
+                    if cacheable or len(rows) < self.MESSAGES_CHUNK:
+                        break # break while True
+                    last = rows[-1]
+                if cacheable and len(params) == 1:
                     # Only cache queries getting full range
                     self.table_rows["messages"][chat["id"]] = messages
             else:
-                messages_sorted = sorted(
-                    self.table_rows["messages"][chat["id"]],
-                    key=lambda m: m["timestamp"], reverse=not ascending
-                )
-                if timestamp_from:
-                    messages_sorted = filter(
-                        lambda x: (x["timestamp"] > timestamp_from)
-                        if ascending else
-                        (x["timestamp"] < timestamp_from), messages_sorted
-                    )
-                for message in messages_sorted:
-                    yield message
+                # Cached messages are kept sorted, bisect the requested range
+                lo, hi = 0, len(cached)
+                if timestamp_from and ascending:
+                    lo = self.message_cache.bisect(chat["id"], timestamp_from,
+                                                   right=True)
+                elif timestamp_from:
+                    hi = self.message_cache.bisect(chat["id"], timestamp_from)
+                indexes = xrange(lo, hi) if ascending \
+                          else xrange(hi - 1, lo - 1, -1)
+                for i in indexes:
+                    yield cached[i]
+
+
+    def make_messages_query(self, connection, chat=None, ascending=True,
+                            additional_sql=None, additional_params=None,
+                            timestamp_from=None, fields=None, last=None):
+        """
+        Returns (SQL, params) for querying messages like get_messages(),
+        ordered by timestamp and ID.
+
+        @param   connection  connection the query will run on
+        @param   last        message to continue after, if any
+        """
+        params = {}
+        # Filter and order by index database columns if possible
+        x, columns = "m", "m.*"
+        if fields:
+            columns = ", ".join("m.%s" % f for f in sorted(
+                      set(fields) | set(["id", "timestamp"])))
+        sql = "SELECT %s FROM messages m " % columns
+        if self.use_sidecar(connection, "messages"):
+            x = "i"
+            sql = "SELECT %s FROM sidecar.messages i " \
+                  "CROSS JOIN messages m ON m.id = i.id " % columns
+        if additional_sql and " c." in additional_sql:
+            sql += "LEFT JOIN conversations c ON m.convo_id = c.id "
+        # Take only known and supported types of messages.
+        sql += "WHERE %s.type IN " \
+               "(2, 10, 12, 13, 30, 39, 51, 60, 61, 63, 64, 68)" % x
+        if chat:
+            sql += " AND %s.convo_id = :convo_id" % x
+            params["convo_id"] = chat["id"]
+        if timestamp_from:
+            sql += " AND %s.timestamp %s :timestamp" % \
+                   (x, ">" if ascending else "<")
+            params["timestamp"] = timestamp_from
+        if additional_sql:
+            sql += " AND (%s)" % additional_sql
+            params.update(additional_params or {})
+        if last:
+            # Continue after last message; NULL timestamps sort lowest
+            op, args = (">" if ascending else "<"), {"x": x}
+            if last["timestamp"] is None:
+                sql += " AND (%(x)s.timestamp IS NULL AND %(x)s.id %(op)s "\
+                       ":last_id" % dict(args, op=op)
+                if ascending:
+                    sql += " OR %(x)s.timestamp IS NOT NULL" % args
+            else:
+                sql += " AND (%(x)s.timestamp %(op)s :last_ts OR " \
+                       "(%(x)s.timestamp = :last_ts AND %(x)s.id %(op)s " \
+                       ":last_id)" % dict(args, op=op)
+                if not ascending:
+                    sql += " OR %(x)s.timestamp IS NULL" % args
+                params["last_ts"] = last["timestamp"]
+            sql += ")"
+            params["last_id"] = last["id"]
+        direction = "ASC" if ascending else "DESC"
+        sql += " ORDER BY %s.timestamp %s, %s.id %s" % (x, direction,
+                                                        x, direction)
+        return sql, params
+
+
+    def get_messages_page(self, chat, before=None, after=None, limit=None):
+        """
+        Returns a page of chat messages ordered from earliest to latest,
+        keyed by (timestamp, id), so that messages sharing a timestamp are
+        neither skipped nor repeated between pages. Without before or after,
+        returns the latest messages.
+
+        @param   chat    as returned by get_conversations()
+        @param   before  (timestamp, id) to return messages before, if any
+        @param   after   (timestamp, id) to return messages after, if any
+        @param   limit   maximum number of messages to return, if any; taken
+                         from the end nearest to after if only after given,
+                         and nearest to before otherwise
+        @return          [message, ]
+        """
+        result = []
+        if not self.is_open() or "messages" not in self.tables:
+            return result
+        ascending = bool(after and not before)
+        cached = self.table_rows.get("messages", {}).get(chat["id"])
+        if cached is not None:
+            lo, hi = 0, len(cached)
+            if after:
+                lo = self.message_cache.bisect(chat["id"], *after, right=True)
+            if before:
+                hi = max(lo, self.message_cache.bisect(chat["id"], *before))
+            if limit is not None and ascending:
+                hi = min(hi, lo + limit)
+            elif limit is not None:
+                lo = max(lo, hi - limit)
+            return cached[lo:hi]
+
+        with self.read_connection() as connection:
+            # Filter and order by index database columns if possible
+            x = "m"
+            sql = "SELECT m.* FROM messages m "
+            if self.use_sidecar(connection, "messages"):
+                x = "i"
+                sql = "SELECT m.* FROM sidecar.messages i " \
+                      "CROSS JOIN messages m ON m.id = i.id "
+            sql += "WHERE %s.type IN " \
+                   "(2, 10, 12, 13, 30, 39, 51, 60, 61, 63, 64, 68) " \
+                   "AND %s.convo_id = :convo_id" % (x, x)
+            params = {"convo_id": chat["id"]}
+            for name, bound, op in [("after", after, ">"),
+                                    ("before", before, "<")]:
+                if bound:
+                    sql += " AND (%(x)s.timestamp %(op)s :%(name)s_ts " \
+                           "OR (%(x)s.timestamp = :%(name)s_ts " \
+                           "AND %(x)s.id %(op)s :%(name)s_id))" % locals()
+                    params.update({"%s_ts" % name: bound[0],
+                                   "%s_id" % name: bound[1]})
+            direction = "ASC" if ascending else "DESC"
+            sql += " ORDER BY %s.timestamp %s, %s.id %s" % \
+                   (x, direction, x, direction)
+            if limit is not None:
+                sql += " LIMIT %d" % limit
+            for message in self.execute(sql, params, connection=connection):
+                message["datetime"] = None
+                if message["timestamp"]:
+                    message["datetime"] = datetime.datetime.fromtimestamp(
+                                              message["timestamp"])
+                result.append(message)
+        return result if ascending else result[::-1]
 
 
     def row_factory(self, cursor, row):
         """
-        Creates dicts from resultset rows, with BLOB fields converted to
-        strings.
+        Creates Row objects from resultset rows, with string and BLOB fields
+        converted to Unicode on first access. The column index map is built
+        once per query and shared by all its rows.
         """
-        result = {}
-        #print cursor.description
-        for idx, col in enumerate(cursor.description):
-            name = col[0]
-            result[name] = row[idx]
-        for name in result.keys():
-            datatype = type(result[name])
-            if datatype is buffer:
-                result[name] = str(result[name]).decode("latin1")
-            elif datatype is str or datatype is unicode:
-                try:
-                    result[name] = str(result[name]).decode("utf-8")
-                except:
-                    result[name] = str(result[name]).decode("latin1")
-        return result
+        description = cursor.description
+        cached = self.row_columns.get(id(description))
+        if not cached or cached[0] is not description:
+            if len(self.row_columns) >= self.ROW_COLUMNS_MAX:
+                self.row_columns.clear()
+            columns = dict((c[0], i) for i, c in enumerate(description))
+            # Description is kept referenced, so that its id stays unique.
+            cached = self.row_columns[id(description)] = (description, columns)
+        return Row(cached[1], row)
 
 
     def get_conversations(self):
@@ -581,38 +1440,31 @@ class SkypeDatabase(object):
         conversations = []
         if self.is_open() and "conversations" in self.tables:
             if "conversations" not in self.table_rows:
-                participants = {}
-                if "contacts" in self.tables and "participants" in self.tables:
-                    main.log("Conversations and participants: "
-                             "retrieving all (%s).", self.filename)
-                    self.get_contacts()
-                    self.get_table_rows("participants")
-                    for i in self.table_objects["participants"].values():
-                        if i["convo_id"] not in participants:
-                            participants[i["convo_id"]] = []
-                        if i["identity"] == self.id:
-                            i["contact"] = self.account
-                        else:
-                            # Fake a dummy contact object if no contact row
-                            i["contact"] = self.table_objects["contacts"].get(
-                                i["identity"], {"skypename":   i["identity"],
-                                                "identity":    i["identity"],
-                                                "name":        i["identity"],
-                                                "fullname":    i["identity"],
-                                                "displayname": i["identity"]}
-                            )
-                        participants[i["convo_id"]].append(i)
-                [i.sort(key=lambda x: (x["contact"].get("name", "")).lower())
-                 for i in participants.values()]
+                main.log("Conversations: retrieving all (%s).", self.filename)
+                # Participant identities for the chats list in one pass,
+                # full participant lists are retrieved on first access.
+                people_sql, people_join = ", NULL AS participant_identities", ""
+                if "participants" in self.tables:
+                    people_sql = ", p.participant_identities"
+                    people_join = (
+                        "LEFT JOIN (SELECT convo_id, "
+                        "GROUP_CONCAT(identity, ' ') AS participant_identities "
+                        "FROM (SELECT convo_id, identity FROM participants "
+                        "ORDER BY convo_id, identity) GROUP BY convo_id) p "
+                        "ON p.convo_id = c.id ")
                 rows = self.execute(
-                    "SELECT *, COALESCE(displayname, meta_topic, '') AS title, "
-                    "NULL AS created_datetime, "
-                    "NULL AS last_activity_datetime "
-                    "FROM conversations WHERE displayname IS NOT NULL "
-                    "ORDER BY last_activity_timestamp DESC"
+                    "SELECT c.*, COALESCE(c.displayname, c.meta_topic, '') "
+                    "AS title, NULL AS created_datetime, "
+                    "NULL AS last_activity_datetime%s "
+                    "FROM conversations c %s"
+                    "WHERE c.displayname IS NOT NULL "
+                    "ORDER BY c.last_activity_timestamp DESC"
+                    % (people_sql, people_join)
                 ).fetchall()
                 conversations = []
-                for chat in rows:
+                for row in rows:
+                    loader = lambda row=row: self.get_participants(row)
+                    chat = LazyRow(row, {"participants": loader})
                     chat["title_long"] = ("Chat with %s"
                         if CHATS_TYPE_SINGLE == chat["type"]
                         else "Group chat \"%s\"") % chat["title"]
@@ -631,13 +1483,9 @@ class SkypeDatabase(object):
                     chat["last_message_timestamp"] = None
                     chat["first_message_datetime"] = None
                     chat["last_message_datetime"] = None
-                    chat["participants"] = participants.get(chat["id"], [])
                     conversations.append(chat)
-                main.log("Conversations and participants retrieved "
-                    "(%s chats, %s contacts, %s).",
-                    len(conversations), len(self.table_rows["contacts"]),
-                    self.filename
-                )
+                main.log("Conversations retrieved (%s chats, %s).",
+                         len(conversations), self.filename)
                 self.table_rows["conversations"] = conversations
             else:
                 conversations = self.table_rows["conversations"]
@@ -660,23 +1508,41 @@ class SkypeDatabase(object):
             main.log("Statistics collection starting (%s).", self.filename)
         stats = []
         participants = {}
-        if self.is_open() and "messages" in self.tables:
+        cached = self.get_metadata("chats") if self.is_open() else None
+        if cached is not None:
+            for chat_id, (count, first, last) in cached.items():
+                stats.append({"id": int(chat_id), "message_count": count,
+                              "first_message_timestamp": first,
+                              "last_message_timestamp": last,
+                              "first_message_datetime": None,
+                              "last_message_datetime": None})
+            stats = dict((i["id"], i) for i in stats)
+        elif self.is_open() and "messages" in self.tables:
             and_str, and_val = "", []
             if chats and len(chats) == 1:
                 and_str = " AND convo_id in (%s)" % \
                           ", ".join(["?"] * len(chats))
                 and_val = [c["id"] for c in chats]
-            rows_stat = self.execute(
-                "SELECT convo_id AS id, COUNT(*) AS message_count, "
-                "MIN(timestamp) AS first_message_timestamp, "
-                "MAX(timestamp) AS last_message_timestamp, "
-                "NULL AS first_message_datetime, "
-                "NULL AS last_message_datetime "
-                "FROM messages "
-                "WHERE type IN (2, 10, 13, 51, 60, 61, 63, 64, 68) "
-                + and_str +
-                "GROUP BY convo_id", and_val).fetchall()
+            with self.read_connection() as connection:
+                # Index database has the needed columns in a smaller table
+                table = "sidecar.messages" \
+                        if self.use_sidecar(connection, "messages") \
+                        else "messages"
+                rows_stat = self.execute(
+                    "SELECT convo_id AS id, COUNT(*) AS message_count, "
+                    "MIN(timestamp) AS first_message_timestamp, "
+                    "MAX(timestamp) AS last_message_timestamp, "
+                    "NULL AS first_message_datetime, "
+                    "NULL AS last_message_datetime "
+                    "FROM %s "
+                    "WHERE type IN (2, 10, 13, 51, 60, 61, 63, 64, 68) "
+                    "%s GROUP BY convo_id" % (table, and_str), and_val,
+                    connection=connection).fetchall()
             stats = dict((i["id"], i) for i in rows_stat)
+            if not and_str:
+                self.set_metadata("chats", dict((str(k), [v["message_count"],
+                    v["first_message_timestamp"], v["last_message_timestamp"]])
+                    for k, v in stats.items()))
         for chat in chats:
             if chat["id"] in stats:
                 stamptodate = datetime.datetime.fromtimestamp
@@ -693,6 +1559,377 @@ class SkypeDatabase(object):
             main.log("Statistics collected (%s).", self.filename)
 
 
+    def get_chat_statistics(self, chat, first=None, last=None,
+                            message_ids=None, text_lengths=None,
+                            after_id=None, by_day=False):
+        """
+        Returns statistics for chat messages, computed with aggregate queries
+        and SQL helper functions: message, SMS, call and file counts,
+        character totals, call durations and date bounds, in total and per
+        author. Message bodies are parsed only if they have markup or
+        possible emoticons, and for files not listed in Transfers. For a
+        range of a single chat spanning several days, counts for the whole
+        days inside the range are taken from daily aggregates, and only the
+        first and last day are queried.
+
+        @param   chat          as returned from get_conversations(), if any
+        @param   first         (timestamp, id) of the first message to include
+        @param   last          (timestamp, id) of the last message to include
+        @param   message_ids   IDs of the messages to include, if not a range
+        @param   text_lengths  known text lengths of messages not having plain
+                               text bodies, as {id: length}
+        @param   after_id      ID beyond which to include messages, if any
+        @param   by_day        whether to additionally return counts per
+                               day and author, for DailyStatistics
+        @return                {"counts": {author: {"messages", "chars",
+                                "smses", "smschars", "calls", "calldurations",
+                                "files", "bytes"}}, "messages", "chars",
+                                "smses", "smschars", "calls", "calldurations",
+                                "callmaxdurations", "files", "bytes",
+                                "transfers": [], "total", "startdate",
+                                "enddate"}, with by_day also {"days":
+                                {"YYYY-MM-DD": {author: {"total", "messages",
+                                 .., "callmaxdurations", "first", "last"}}}}
+        """
+        fields = ["messages", "chars", "smses", "smschars", "calls",
+                  "calldurations", "files", "bytes"]
+        stats = dict((k, 0) for k in fields)
+        stats.update({"counts": {}, "transfers": [], "total": 0,
+                      "callmaxdurations": 0, "startdate": None,
+                      "enddate": None})
+        if by_day:
+            stats["days"] = {}
+        if not self.is_open() or "messages" not in self.tables:
+            return stats
+
+        def get_counts(author, day=None):
+            """Returns the counts dictionaries to update for author and day."""
+            result = [stats["counts"].setdefault(author,
+                      dict((k, 0) for k in fields))]
+            if by_day:
+                result.append(stats["days"].setdefault(day, {}).setdefault(
+                    author, dict(DailyStatistics.EMPTY)))
+            return result
+
+        parser, lengths = MessageParser(self, chat), text_lengths or {}
+        text_length = lambda id, body, type: lengths[id] if id in lengths \
+                      else parser.get_text_length(body, type)
+        scopes = [] # [(SQL condition, {params}), ]
+        file_scopes = scopes # Scopes for file messages, if different
+        inner = None # [first day, last day] taken from daily aggregates
+        first_last = [] # [timestamp, ]
+        if message_ids is not None:
+            ids = sorted(set(message_ids))
+            for i in range(0, len(ids), 500): # Stay under SQL variable limit
+                scopes.append(("%%(x)s.id IN (%s)" % ", ".join(
+                               "%d" % x for x in ids[i:i + 500]), {}))
+        else:
+            def make_scope(first, last):
+                """Returns (SQL condition, {params}) for message bounds."""
+                sql, params = [], {}
+                for name, bound, op in [("first", first, ">"),
+                                        ("last", last, "<")]:
+                    if bound: # Plain timestamp bound for using an index
+                        sql.append("%%(x)s.timestamp %(op)s= :%(name)s_ts "
+                                   "AND (%%(x)s.timestamp %(op)s :%(name)s_ts "
+                                   "OR %%(x)s.id %(op)s= :%(name)s_id)"
+                                   % locals())
+                        params.update({"%s_ts" % name: bound[0],
+                                       "%s_id" % name: bound[1]})
+                if after_id is not None:
+                    sql.append("%(x)s.id > :after_id")
+                    params["after_id"] = after_id
+                return " AND ".join(sql), params
+
+            scopes.append(make_scope(first, last))
+            if chat and first and last and after_id is None and not by_day:
+                day1, day2 = [datetime.date.fromtimestamp(b[0])
+                              for b in (first, last)]
+                if (day2 - day1).days > 1:
+                    day = datetime.timedelta(days=1)
+                    midnight = lambda d: int(time.mktime(d.timetuple()))
+                    inner = [(day1 + day).isoformat(),
+                             (day2 - day).isoformat()]
+                    file_scopes = scopes[:]
+                    scopes = [make_scope(first, (midnight(day1 + day) - 1,
+                                                 sys.maxint)),
+                              make_scope((midnight(day2), 0), last)]
+                    daily = self.get_chat_daily_statistics(chat).get(*inner)
+                    for author, values in daily["counts"].items():
+                        for counts in get_counts(author):
+                            for k in fields:
+                                counts[k] += values[k]
+                    stats["total"] += daily["total"]
+                    stats["callmaxdurations"] += daily["callmaxdurations"]
+                    first_last.extend(filter(None, [daily["first"],
+                                                    daily["last"]]))
+
+        with self.read_connection() as connection:
+            connection.create_function("MESSAGE_TEXT_LENGTH", 3, text_length)
+            connection.create_aggregate("CALL_DURATIONS", 1,
+                                        CallDurationsAggregate)
+            # Filter by index database columns if possible
+            x, sql_from = "m", "FROM messages m "
+            if self.use_sidecar(connection, "messages"):
+                x, sql_from = "i", "FROM sidecar.messages i " \
+                                   "CROSS JOIN messages m ON m.id = i.id "
+            day_sql, group_sql = "NULL", ""
+            if by_day or inner:
+                day_sql = "strftime('%%Y-%%m-%%d', %s.timestamp, " \
+                          "'unixepoch', 'localtime')" % x
+            if by_day:
+                group_sql = " GROUP BY day, m.author"
+
+            def make_where(condition, params):
+                """Returns the WHERE clause and parameters for the scope."""
+                where = "WHERE %s.type IN " \
+                        "(2, 10, 12, 13, 30, 39, 51, 60, 61, 63, 64, 68)" % x
+                if chat:
+                    where += " AND %s.convo_id = :convo_id" % x
+                    params = dict(params, convo_id=chat["id"])
+                if condition:
+                    where += " AND %s" % (condition % {"x": x})
+                return where, params
+
+            for where, params in [make_where(*y) for y in scopes]:
+                for row in self.execute(
+                    "SELECT m.author AS author, %(x)s.type AS type, "
+                    "%(day_sql)s AS day, COUNT(*) AS count, SUM(CASE WHEN "
+                    "%(x)s.type IN (%(sms)s, %(msg)s) THEN MESSAGE_TEXT_LENGTH("
+                    "m.id, m.body_xml, %(x)s.type) END) AS chars, "
+                    "MIN(%(x)s.timestamp) AS first, MAX(%(x)s.timestamp) AS "
+                    "last %(sql_from)s%(where)s GROUP BY m.author, %(x)s.type, "
+                    "day" % dict(locals(),
+                    sms=MESSAGES_TYPE_SMS, msg=MESSAGES_TYPE_MESSAGE),
+                    params, connection=connection
+                ):
+                    stats["total"] += row["count"]
+                    first_last.extend(filter(None, [row["first"],
+                                                    row["last"]]))
+                    all_counts = get_counts(row["author"], row["day"])
+                    if by_day:
+                        counts = all_counts[-1]
+                        counts["total"] += row["count"]
+                        counts["first"] = min(filter(None, [counts["first"],
+                                              row["first"]]) or [None])
+                        counts["last"] = max(counts["last"], row["last"])
+                    field = {MESSAGES_TYPE_SMS: "smses",
+                             MESSAGES_TYPE_CALL: "calls",
+                             MESSAGES_TYPE_MESSAGE: "messages",
+                             MESSAGES_TYPE_FILE: "files"}.get(row["type"])
+                    if not field:
+                        continue # continue for row in self.execute(..)
+                    for counts in all_counts:
+                        if MESSAGES_TYPE_FILE != row["type"]:
+                            counts[field] += row["count"]
+                        if MESSAGES_TYPE_SMS == row["type"]:
+                            counts["smschars"] += row["chars"] or 0
+                        elif MESSAGES_TYPE_MESSAGE == row["type"]:
+                            counts["chars"] += row["chars"] or 0
+
+                for row in self.execute(
+                    "SELECT CALL_DURATIONS(m.body_xml) AS durations, %s AS "
+                    "day, m.author AS author %s%s AND %s.type = %s%s"
+                    % (day_sql, sql_from, where, x, MESSAGES_TYPE_CALL,
+                    group_sql), params, connection=connection
+                ).fetchall():
+                    durations = json.loads(row["durations"] or "{}") # Null
+                    stats["callmaxdurations"] += durations.get("max", 0)
+                    if by_day and durations:
+                        get_counts(row["author"], row["day"])[-1][
+                            "callmaxdurations"] += durations["max"]
+                    for identity, duration in durations.get("durations",
+                                                            {}).items():
+                        for counts in get_counts(identity, row["day"]):
+                            counts["calldurations"] += duration
+
+            # Files sent are few, taken from Transfers as in parsing
+            for where, params in [make_where(*y) for y in file_scopes]:
+                for m in self.execute(
+                    "SELECT m.id, m.author, m.body_xml, m.from_dispname, "
+                    "m.guid, m.timestamp, %s AS day %s%s AND %s.type = %s "
+                    "ORDER BY %s.timestamp, %s.id" % (day_sql, sql_from,
+                    where, x, MESSAGES_TYPE_FILE, x, x), params,
+                    connection=connection
+                ).fetchall():
+                    files = parser.get_files(m)
+                    stats["transfers"].extend(files)
+                    if inner and inner[0] <= m["day"] <= inner[1]:
+                        continue # continue for m in self.execute(..)
+                    for counts in get_counts(m["author"], m["day"]):
+                        counts["files"] += len(files)
+                        counts["bytes"] += sum(int(f["filesize"] or 0)
+                                               for f in files)
+
+        for k in fields:
+            stats[k] = sum(i[k] for i in stats["counts"].values())
+        if first_last:
+            stamptodate = datetime.datetime.fromtimestamp
+            stats["startdate"] = stamptodate(min(first_last))
+            stats["enddate"] = stamptodate(max(first_last))
+        return stats
+
+
+    def get_chat_daily_statistics(self, chat):
+        """
+        Returns message counts of the chat per day and author, as
+        DailyStatistics. Built once and kept in the index database if
+        available; messages appended to the chat since are added
+        incrementally, and counts are rebuilt if chat messages have been
+        deleted. Counts are rebuilt also after messages or transfers have
+        been changed in place, or changed by other programs unless the index
+        database has been checked since and cleared the changed chats.
+        """
+        version = self.get_data_version()
+        daily = self.daily_stats.get(chat["id"])
+        if daily and daily.version == version:
+            return daily
+        sidecar = self.sidecar
+        with self.read_connection() as connection:
+            x, sql_from = "m", "messages m"
+            checked = self.use_sidecar(connection, *[t for t in
+                      ("messages", "transfers") if t in self.tables])
+            if checked:
+                x, sql_from = "i", "sidecar.messages i"
+            sql = "SELECT COALESCE(MAX(%s.id), 0) AS max_id, COUNT(*) AS " \
+                  "count FROM %s WHERE %s.convo_id = :convo_id" % \
+                  (x, sql_from, x)
+            row = self.execute(sql, {"convo_id": chat["id"]},
+                               connection=connection).fetchone()
+            state = [row["max_id"], row["count"]]
+            if daily and daily.version[0] != version[0] and not checked:
+                daily = None # Changed by other programs, changes unknown
+            if not daily and checked:
+                daily = sidecar.get_daily(chat["id"])
+            if daily and daily.state != state:
+                row = self.execute(sql + " AND %s.id > :max_id" % x,
+                                   {"convo_id": chat["id"],
+                                    "max_id": daily.state[0]},
+                                   connection=connection).fetchone()
+                if state[0] < daily.state[0] \
+                or state[1] - daily.state[1] != row["count"]:
+                    daily = None # Messages have been deleted or replaced
+        days, full = None, not daily
+        if not daily or daily.state != state:
+            if full:
+                main.log("Collecting daily statistics for chat %s (%s).",
+                         chat["id"], self.filename)
+            after_id = None if full else daily.state[0]
+            daily = daily or DailyStatistics()
+            days = self.get_chat_statistics(chat, after_id=after_id,
+                                            by_day=True)["days"]
+            daily.add(days, state)
+        if sidecar and days is not None:
+            sidecar.set_daily(chat["id"], daily,
+                              None if full else days.keys())
+        daily.version = version
+        self.daily_stats[chat["id"]] = daily
+        return daily
+
+
+    def update_term_index(self, chat):
+        """
+        Brings the term frequency index up to date for the chat if
+        conf.DBTermIndexEnabled, counting words of messages appended since,
+        or of all chat messages if not indexed or having lost messages.
+
+        @return  whether the index is up to date for the chat
+        """
+        sidecar = self.sidecar
+        if not conf.DBTermIndexEnabled or not sidecar \
+        or "messages" not in self.tables:
+            return False
+        counts = collections.defaultdict(int) # {(author, month, word): count}
+        with self.read_connection() as connection:
+            if not self.use_sidecar(connection, "messages"):
+                return False
+            sql = "SELECT COALESCE(MAX(id), 0) AS max_id, COUNT(*) AS count " \
+                  "FROM sidecar.messages WHERE convo_id = :convo_id"
+            params = {"convo_id": chat["id"]}
+            row = self.execute(sql, params, connection=connection).fetchone()
+            state, indexed = [row["max_id"], row["count"]], \
+                             sidecar.get_terms_state(chat["id"])
+            if indexed and list(indexed) == state:
+                return True
+            clear = not indexed or state[0] < indexed[0]
+            if not clear:
+                params["max_id"] = indexed[0]
+                row = self.execute(sql + " AND id > :max_id", params,
+                                   connection=connection).fetchone()
+                clear = (state[1] - indexed[1] != row["count"])
+            if clear:
+                main.log("Indexing words of chat %s (%s).",
+                         chat["id"], self.filename)
+                params["max_id"] = 0
+            parser = MessageParser(self, chat)
+            counters = {} # {(author, month): WordCounter}
+            for row in self.execute(
+                "SELECT m.author, m.body_xml, i.type, strftime('%%Y-%%m', "
+                "i.timestamp, 'unixepoch', 'localtime') AS month "
+                "FROM sidecar.messages i CROSS JOIN messages m "
+                "ON m.id = i.id WHERE i.convo_id = :convo_id "
+                "AND i.id > :max_id AND i.type IN (%s, %s)"
+                % (MESSAGES_TYPE_SMS, MESSAGES_TYPE_MESSAGE), params,
+                connection=connection
+            ):
+                key = (row["author"], row["month"])
+                if key not in counters:
+                    counters[key] = wordcloud.WordCounter(limit=sys.maxint)
+                parser.count_words(row["body_xml"], row["type"],
+                                   counters[key])
+        for (author, month), counter in counters.items():
+            for word, count in counter.counts.iteritems():
+                counts[(author, month, word)] += count
+        return sidecar.add_terms(chat["id"], counts, state, clear)
+
+
+    def get_term_counts(self, chats=None, authors=None, first_month=None,
+                        last_month=None):
+        """
+        Returns message word counts from the term frequency index, for
+        making word clouds and top word lists with wordcloud.get_cloud().
+        Index is brought up to date for the chats first.
+
+        @param   chats        chats to include, all if None
+        @param   authors      author identities to include, all if None
+        @param   first_month  first month to include, as "YYYY-MM", if any
+        @param   last_month   last month to include, as "YYYY-MM", if any
+        @return               wordcloud.WordCounter, or None if the index is
+                              not enabled or not available
+        """
+        if not self.is_open() or "conversations" not in self.tables:
+            return None
+        where, params = [], {}
+        if chats is None:
+            chats = self.execute("SELECT id FROM conversations").fetchall()
+        else:
+            where.append("convo_id IN (%s)" % ", ".join(
+                         "%d" % c["id"] for c in chats))
+        if not all([self.update_term_index(c) for c in chats]):
+            return None
+        if authors is not None:
+            where.append("author IN (%s)" % ", ".join(
+                         ":author%s" % i for i in range(len(authors))))
+            params.update(("author%s" % i, a) for i, a in enumerate(authors))
+        for name, month, op in [("first", first_month, ">="),
+                                ("last", last_month, "<=")]:
+            if month:
+                where.append("month %s :%s" % (op, name))
+                params[name] = month
+        result = wordcloud.WordCounter(limit=sys.maxint)
+        with self.read_connection() as connection:
+            if not self.use_sidecar(connection, "messages"):
+                return None
+            for row in self.execute(
+                "SELECT term, SUM(count) AS count FROM sidecar.terms %s"
+                "GROUP BY term" % ("WHERE %s " % " AND ".join(where)
+                                   if where else ""),
+                params, connection=connection
+            ):
+                result.counts[row["term"]] = row["count"]
+        return result
+
+
     def get_contactgroups(self):
         """
         Returns the non-empty contact groups in the database.
@@ -726,13 +1963,14 @@ class SkypeDatabase(object):
         if self.is_open() and "contacts" in self.tables:
             if "contacts" not in self.table_rows:
                 rows = self.execute(
-                    "SELECT *, COALESCE(skypename, pstnnumber, '') "
+                    "SELECT %s, COALESCE(skypename, pstnnumber, '') "
                         "AS identity, "
                     "COALESCE(fullname, displayname, skypename, pstnnumber, '') "
                     "AS name FROM contacts ORDER BY name COLLATE NOCASE"
+                    % self.get_columns_sql("contacts")
                 ).fetchall()
                 self.table_objects["contacts"] = {}
-                for c in rows:
+                for c in map(lambda x: self.defer_blobs("contacts", x), rows):
                     contacts.append(c)
                     self.table_objects["contacts"][c["identity"]] = c
                 self.table_rows["contacts"] = contacts
@@ -782,6 +2020,38 @@ class SkypeDatabase(object):
         return rows
 
 
+    def get_indexed_rows(self, table, column, value):
+        """
+        Returns cached rows of the specified table where column equals value,
+        looked up from a hash index built over the cached rows on first use
+        and dropped together with the cached rows.
+
+        @param   table   "calls", "smses", "transfers" or "videos",
+                         or any other table in the database
+        """
+        table = table.lower()
+        indexes = self.table_indexes.get(table)
+        if indexes is None or column not in indexes:
+            getter = {"calls": self.get_calls, "smses": self.get_smses,
+                      "transfers": self.get_transfers,
+                      "videos": self.get_videos}.get(table)
+            rows = getter() if getter else self.get_table_rows(table)
+            index = {}
+            for row in rows:
+                key = self.make_index_key(row[column])
+                index.setdefault(key, []).append(row)
+            if table in self.table_rows:
+                self.table_indexes.setdefault(table, {})[column] = index
+        else:
+            index = indexes[column]
+        return list(index.get(self.make_index_key(value), []))
+
+
+    def make_index_key(self, value):
+        """Returns the value as hashable, BLOB values as strings."""
+        return str(value) if isinstance(value, buffer) else value
+
+
     def get_smses(self):
         """
         Returns all the SMSes in the database.
@@ -822,6 +2092,43 @@ class SkypeDatabase(object):
         return transfers
 
 
+    def get_message_transfers(self, message):
+        """
+        Returns the transfers of the message, via the index database if
+        available and transfers are not cached.
+        """
+        if self.is_open() and "transfers" in self.tables \
+        and "transfers" not in self.table_rows:
+            with self.read_connection() as connection:
+                if self.use_sidecar(connection, "transfers"):
+                    return self.execute(
+                        "SELECT transfers.* FROM sidecar.transfers i "
+                        "CROSS JOIN transfers ON transfers.id = i.id "
+                        "WHERE i.chatmsg_guid = "
+                        "(SELECT guid FROM messages WHERE id = ?) "
+                        "ORDER BY transfers.id", [message["id"]],
+                        connection=connection).fetchall()
+        return self.get_indexed_rows("transfers", "chatmsg_guid",
+                                     message["guid"])
+
+
+    def get_message_smses(self, message):
+        """
+        Returns the SMSes of the message, via the index database if
+        available and SMSes are not cached.
+        """
+        if self.is_open() and "smses" in self.tables \
+        and "smses" not in self.table_rows:
+            with self.read_connection() as connection:
+                if self.use_sidecar(connection, "smses"):
+                    return self.execute(
+                        "SELECT smses.* FROM sidecar.smses i "
+                        "CROSS JOIN smses ON smses.id = i.id "
+                        "WHERE i.chatmsg_id = ? ORDER BY smses.id",
+                        [message["id"]], connection=connection).fetchall()
+        return self.get_indexed_rows("smses", "chatmsg_id", message["id"])
+
+
     def get_videos(self, chat=None):
         """
         Returns all valid video rows in the database (with a matching row in
@@ -848,7 +2155,7 @@ class SkypeDatabase(object):
                 videos = self.table_rows["videos"]
 
         if chat:
-            videos = [v for v in videos if v["convo_id"] == chat["id"]]
+            videos = self.get_indexed_rows("videos", "convo_id", chat["id"])
         return videos
 
 
@@ -861,6 +2168,15 @@ class SkypeDatabase(object):
                        under this chat
         """
         calls = []
+        if self.is_open() and "calls" in self.tables \
+        and chat and "calls" not in self.table_rows:
+            with self.read_connection() as connection:
+                if self.use_sidecar(connection, "calls"):
+                    return self.execute(
+                        "SELECT calls.* FROM sidecar.calls i "
+                        "CROSS JOIN calls ON calls.id = i.id "
+                        "WHERE i.conv_dbid = ? ORDER BY calls.id",
+                        [chat["id"]], connection=connection).fetchall()
         if self.is_open() and "calls" in self.tables:
             if "calls" not in self.table_rows:
                 rows = self.execute(
@@ -876,10 +2192,56 @@ class SkypeDatabase(object):
                 calls = self.table_rows["calls"]
 
         if chat:
-            calls = [c for c in calls if c["conv_dbid"] == chat["id"]]
+            calls = self.get_indexed_rows("calls", "conv_dbid", chat["id"])
         return calls
 
 
+    def get_participants(self, chat):
+        """
+        Returns the participants of the chat ordered by name, as
+        [{all Participant columns, "contact": {all Contact columns}}],
+        with "contact" as the account row for the database account owner,
+        and as a dummy row for participants missing from Contacts.
+        """
+        participants = []
+        if self.is_open() and "participants" in self.tables:
+            rows = self.execute("SELECT * FROM participants "
+                                "WHERE convo_id = ?", [chat["id"]]).fetchall()
+            contacts = self.table_objects.get("contacts") or {}
+            if "contacts" in self.tables and any(p["identity"] not in contacts
+            and p["identity"] != self.id for p in rows):
+                # Retrieve all missing participant contacts in one query
+                contacts = self.table_objects.setdefault("contacts", {})
+                for row in self.execute(
+                    "SELECT %s, COALESCE(fullname, displayname, skypename, "
+                                       "pstnnumber, '') AS name, "
+                    "COALESCE(skypename, pstnnumber, '') AS identity "
+                    "FROM contacts WHERE skypename IN (SELECT identity "
+                    "FROM participants WHERE convo_id = :id) OR "
+                    "(skypename IS NULL AND pstnnumber IN (SELECT identity "
+                    "FROM participants WHERE convo_id = :id))"
+                    % self.get_columns_sql("contacts"), {"id": chat["id"]}
+                ).fetchall():
+                    contact = self.defer_blobs("contacts", row)
+                    contacts.setdefault(contact["identity"], contact)
+            for p in rows:
+                if p["identity"] == self.id:
+                    p["contact"] = self.account
+                else:
+                    # Fake a dummy contact object if no contact row
+                    p["contact"] = contacts.get(p["identity"]) or \
+                        {"skypename":   p["identity"],
+                         "identity":    p["identity"],
+                         "name":        p["identity"],
+                         "fullname":    p["identity"],
+                         "displayname": p["identity"]}
+                participants.append(p)
+            participants.sort(key=lambda p: (
+                ((p["contact"] or {}).get("name") or p["identity"]).lower(),
+                p["id"]))
+        return participants
+
+
     def get_conversation_participants(self, chat):
         """
         Returns the participants of the chat, as
@@ -892,9 +2254,11 @@ class SkypeDatabase(object):
                 # Retrieve and cache all contacts
                 self.table_objects["contacts"] = {}
                 rows = self.execute(
-                    "SELECT *, COALESCE(skypename, pstnnumber, '') AS identity "
-                    "FROM contacts").fetchall()
-                for row in rows:
+                    "SELECT %s, COALESCE(skypename, pstnnumber, '') "
+                    "AS identity FROM contacts"
+                    % self.get_columns_sql("contacts")
+                ).fetchall()
+                for row in map(lambda x: self.defer_blobs("contacts", x), rows):
                     self.table_objects["contacts"][row["identity"]] = row
             rows = self.execute(
                 "SELECT COALESCE(c.fullname, c.displayname, c.skypename, "
@@ -928,18 +2292,71 @@ class SkypeDatabase(object):
             contact = self.table_objects["contacts"].get(identity)
             if not contact:
                 contact = self.execute(
-                    "SELECT *, COALESCE(fullname, displayname, skypename, "
+                    "SELECT %s, COALESCE(fullname, displayname, skypename, "
                                        "pstnnumber, '') AS name, "
                     "COALESCE(skypename, pstnnumber, '') AS identity "
                     "FROM contacts WHERE skypename = :identity "
-                    "OR pstnnumber = :identity",
-                    {"identity": identity}
+                    "OR pstnnumber = :identity"
+                    % self.get_columns_sql("contacts"), {"identity": identity}
                 ).fetchone()
+                if contact:
+                    contact = self.defer_blobs("contacts", contact)
                 self.table_objects["contacts"][identity] = contact
 
         return contact
 
 
+    def get_columns_sql(self, table):
+        """
+        Returns the column list for selecting rows of the specified table
+        without BLOB columns, to be retrieved on demand with get_blob().
+        """
+        columns = self.get_table_columns(table) or []
+        names = [c["name"] for c in columns
+                 if c["name"] not in self.get_blob_columns(table)]
+        return ", ".join(names) or "*"
+
+
+    def get_blob_columns(self, table):
+        """Returns the names of BLOB columns in the specified table."""
+        return [c["name"] for c in self.get_table_columns(table) or []
+                if "BLOB" == (c["type"] or "").upper()]
+
+
+    def defer_blobs(self, table, row):
+        """
+        Returns the row selected without BLOB columns as a LazyRow
+        retrieving BLOB values on access, via the BLOB cache.
+        """
+        loaders = {}
+        for name in map(str, self.get_blob_columns(table)):
+            if name not in row:
+                loaders[name] = lambda name=name: \
+                    self.get_blob(table, row["id"], name)
+        return LazyRow(row, loaders, keep=False) if loaders else row
+
+
+    def get_blob(self, table, rowid, column):
+        """
+        Returns the value of a BLOB column in the specified table row,
+        keeping the most recently used values in a small cache.
+        """
+        key, missing = (table.lower(), rowid, column), object()
+        with self.blob_lock:
+            value = self.blob_cache.pop(key, missing)
+        if value is missing:
+            if not self.is_open():
+                return None
+            row = self.execute("SELECT %s FROM %s WHERE id = ?" %
+                               (column, table), [rowid], log=False).fetchone()
+            value = row[column] if row else None
+        with self.blob_lock:
+            self.blob_cache[key] = value
+            while len(self.blob_cache) > conf.BlobCacheSize:
+                self.blob_cache.popitem(last=False)
+        return value
+
+
     def get_table_columns(self, table):
         """
         Returns the columns of the specified table, as
@@ -1000,7 +2417,13 @@ class SkypeDatabase(object):
 
 
     def ensure_backup(self):
-        """Creates a backup file if configured so, and not already created."""
+        """
+        Creates a backup file if configured so, and not already created.
+        Raises an error if the database is opened in read-only mode.
+        """
+        if self.read_only:
+            raise sqlite3.OperationalError(
+                "Database %s is opened in read-only mode." % self.filename)
         if conf.DBDoBackup:
             if (not self.backup_created
             or not os.path.exists("%s.bak" % self.filename)):
@@ -1014,7 +2437,7 @@ class SkypeDatabase(object):
         for using as a query parameter.
         """
         result = []
-        is_dict = isinstance(values, dict)
+        is_dict = isinstance(values, (dict, Row))
         list_values = [values[i] for i in list_columns] if is_dict else values
         map_columns = dict([(i["name"], i) for i in col_data])
         for i, val in enumerate(list_values):
@@ -1028,6 +2451,19 @@ class SkypeDatabase(object):
         return result
 
 
+    def get_insert_plan(self, table):
+        """
+        Returns an InsertPlan for inserting rows into the table without
+        primary key values, reused while the table structure is unchanged.
+        """
+        table = table.lower()
+        col_data = self.get_table_columns(table)
+        key = (table, tuple((c["name"], c["type"]) for c in col_data))
+        if key not in self.insert_plans:
+            self.insert_plans[key] = InsertPlan(table, col_data)
+        return self.insert_plans[key]
+
+
     def fill_missing_fields(self, data, fields):
         """Creates a copy of the data and adds any missing fields."""
         filled = data.copy()
@@ -1041,8 +2477,9 @@ class SkypeDatabase(object):
         """Creates the specified table and updates our column data."""
         table = table.lower()
         if create_sql or (table in self.INSERT_STATEMENTS):
+            self.ensure_backup()
             self.execute(create_sql or self.INSERT_STATEMENTS[table])
-            self.connection.commit()
+            self.commit()
             row = self.execute("SELECT name, sql FROM sqlite_master "
                                 "WHERE type = 'table' "
                                 "AND LOWER(name) = ?", [table]).fetchone()
@@ -1057,16 +2494,9 @@ class SkypeDatabase(object):
             self.create_table("conversations")
         if self.is_open() and "conversations" in self.tables:
             self.ensure_backup()
-            col_data = self.get_table_columns("conversations")
-            fields = [col["name"] for col in col_data if col["name"] != "id"]
-            str_cols = ", ".join(fields)
-            str_vals = ":" + ", :".join(fields)
-            chat_filled = self.fill_missing_fields(chat, fields)
-            chat_filled = self.blobs_to_binary(chat_filled, fields, col_data)
-
-            cursor = self.execute("INSERT INTO conversations (%s) VALUES (%s)"
-                                  % (str_cols, str_vals), chat_filled)
-            self.connection.commit()
+            plan = self.get_insert_plan("conversations")
+            cursor = self.execute(plan.sql, plan.make_params(chat))
+            self.commit()
             self.last_modified = datetime.datetime.now()
             return cursor.lastrowid
 
@@ -1107,77 +2537,48 @@ class SkypeDatabase(object):
                                   [source_chat["id"]])])
             chatrows_present = dict([(i["name"], 1)
                 for i in self.execute("SELECT name FROM chats")])
-            col_data = self.get_table_columns("messages")
-            fields = [col["name"] for col in col_data if col["name"] != "id"]
-            str_cols = ", ".join(fields)
-            str_vals = ":" + ", :".join(fields)
-            transfer_col_data = self.get_table_columns("transfers")
-            transfer_fields = [col["name"] for col in transfer_col_data
-                               if col["name"] != "id"]
-            transfer_cols = ", ".join(transfer_fields)
-            transfer_vals = ", ".join(["?"] * len(transfer_fields))
-            sms_col_data = self.get_table_columns("smses")
-            sms_fields = [col["name"] for col in sms_col_data
-                          if col["name"] != "id"]
-            sms_cols = ", ".join(sms_fields)
-            sms_vals = ", ".join(["?"] * len(sms_fields))
-            chat_col_data = self.get_table_columns("chats")
-            chat_fields = [col["name"] for col in chat_col_data
-                           if col["name"] != "id"]
-            chat_cols = ", ".join(chat_fields)
-            chat_vals = ", ".join(["?"] * len(chat_fields))
+            plan = self.get_insert_plan("messages")
+            transfer_plan = self.get_insert_plan("transfers")
+            sms_plan = self.get_insert_plan("smses")
+            chat_plan = self.get_insert_plan("chats")
+            convo_values = {"convo_id": chat["id"]}
             timestamp_earliest = source_chat["creation_timestamp"] \
                                  or sys.maxsize
             for i, m in enumerate(messages):
-                if not isinstance(m, dict):
+                if not isinstance(m, (dict, Row)):
                     sql = "SELECT * FROM messages WHERE id = ?"
                     m = source_db.execute(sql, (m, )).fetchone()
                 # Insert corresponding Chats entry, if not present
                 if (m["chatname"] not in chatrows_present
                 and m["chatname"] in chatrows_source):
-                    chatrowdata = chatrows_source[m["chatname"]]
-                    chatrow = [chatrowdata.get(col, "") for col in chat_fields]
-                    chatrow = self.blobs_to_binary(
-                        chatrow, chat_fields, chat_col_data)
-                    sql = "INSERT INTO chats (%s) VALUES (%s)" % \
-                          (chat_cols, chat_vals)
-                    self.execute(sql, chatrow)
+                    chatrow = chat_plan.make_params(
+                        chatrows_source[m["chatname"]], default="")
+                    self.execute(chat_plan.sql, chatrow)
                     chatrows_present[m["chatname"]] = 1
-                m_filled = self.fill_missing_fields(m, fields)
-                m_filled["convo_id"] = chat["id"]
-                m_filled = self.blobs_to_binary(m_filled, fields, col_data)
-                cursor = self.execute("INSERT INTO messages (%s) VALUES (%s)"
-                                      % (str_cols, str_vals), m_filled)
+                cursor = self.execute(plan.sql,
+                                      plan.make_params(m, convo_values))
                 m_id = cursor.lastrowid
                 if (m["chatmsg_type"] == 7 and m["type"] == 68
                 and "transfers" in source_db.tables):
-                    transfers = [t for t in source_db.get_transfers()
-                                 if t.get("chatmsg_guid") == m["guid"]]
+                    transfers = source_db.get_message_transfers(m)
                     if transfers:
-                        sql = "INSERT INTO transfers (%s) VALUES (%s)" % \
-                              (transfer_cols, transfer_vals)
                         transfers.sort(key=lambda x: x.get("chatmsg_index"))
                         for t in transfers:
                             # pk_id and nodeid are troublesome, ditto in SMSes,
                             # because their meaning is unknown - will
                             # something go out of sync if their values differ?
-                            row = [t.get(col, "") if col != "convo_id" else chat["id"]
-                                   for col in transfer_fields]
-                            row = self.blobs_to_binary(row, transfer_fields,
-                                                       transfer_col_data)
-                            self.execute(sql, row)
+                            row = transfer_plan.make_params(t, convo_values,
+                                                            default="")
+                            self.execute(transfer_plan.sql, row)
                 if (m["chatmsg_type"] == 7 and m["type"] == 64
                 and "smses" in source_db.tables):
-                    smses = [s for s in source_db.get_smses()
-                             if s.get("chatmsg_id") == m["id"]]
+                    smses = source_db.get_message_smses(m)
                     if smses:
-                        sql = "INSERT INTO smses (%s) VALUES (%s)" % \
-                              (sms_cols, sms_vals)
+                        sms_values = {"chatmsg_id": m_id}
                         for sms in smses:
-                            t = [sms.get(col, "") if col != "chatmsg_id" else m_id
-                                 for col in sms_fields]
-                            t = self.blobs_to_binary(t, sms_fields, sms_col_data)
-                            self.execute(sql, t)
+                            row = sms_plan.make_params(sms, sms_values,
+                                                       default="")
+                            self.execute(sms_plan.sql, row)
                 timestamp_earliest = min(timestamp_earliest, m["timestamp"])
                 result.append(m_id)
                 if heartbeat and beatcount and i and not i % beatcount:
@@ -1191,7 +2592,7 @@ class SkypeDatabase(object):
                     datetime.datetime.fromtimestamp(timestamp_earliest)
                 self.execute("UPDATE conversations SET creation_timestamp = "
                              ":creation_timestamp WHERE id = :id", chat)
-            self.connection.commit()
+            self.commit()
             self.last_modified = datetime.datetime.now()
         return result
 
@@ -1212,206 +2613,1712 @@ class SkypeDatabase(object):
                 len(participants), chat["title_long_lc"], self.filename
             )
             self.ensure_backup()
-            col_data = self.get_table_columns("participants")
-            fields = [col["name"] for col in col_data if col["name"] != "id"]
-            str_cols = ", ".join(fields)
-            str_vals = ":" + ", :".join(fields)
-
+            plan = self.get_insert_plan("participants")
+            values = {"convo_id": chat["id"]}
             for p in participants:
-                p_filled = self.fill_missing_fields(p, fields)
-                p_filled = self.blobs_to_binary(p_filled, fields, col_data)
-                p_filled["convo_id"] = chat["id"]
-                self.execute("INSERT INTO participants (%s) VALUES (%s)" % (
-                    str_cols, str_vals
-                ), p_filled)
+                self.execute(plan.sql, plan.make_params(p, values))
 
-            self.connection.commit()
+            self.commit()
             self.last_modified = datetime.datetime.now()
 
 
-    def insert_account(self, account):
+    def insert_account(self, account):
+        """
+        Inserts the specified account into this database and sets it as the
+        current account.
+        """
+        if self.is_open() and "accounts" not in self.tables:
+            self.create_table("accounts")
+            self.get_tables(True, "accounts")
+        if self.is_open() and "accounts" in self.tables:
+            main.log("Inserting account \"%s\" into %s.",
+                account["skypename"], self.filename
+            )
+            self.ensure_backup()
+            plan = self.get_insert_plan("accounts")
+            a_values = plan.make_params(account)
+            self.execute(plan.sql, a_values)
+            a_filled = dict(zip(plan.fields, a_values))
+            self.commit()
+            self.last_modified = datetime.datetime.now()
+            self.account = a_filled
+            self.id = a_filled["skypename"]
+
+
+    def insert_contacts(self, contacts, source_db):
+        """
+        Inserts the specified contacts into this database.
+        """
+        if self.is_open() and not self.account and source_db.account:
+            self.insert_account(source_db.account)
+        if self.is_open() and "contacts" not in self.tables:
+            self.create_table("contacts")
+        if self.is_open() and "contacts" in self.tables:
+            main.log(
+                "Merging %d contacts into %s.", len(contacts), self.filename
+            )
+            self.ensure_backup()
+            plan = self.get_insert_plan("contacts")
+            for c in contacts:
+                self.execute(plan.sql, plan.make_params(c))
+            self.commit()
+            self.last_modified = datetime.datetime.now()
+
+
+    def replace_contactgroups(self, groups, source_db):
+        """
+        Inserts or updates the specified contact groups in this database.
+        """
+        if self.is_open() and not self.account and source_db.account:
+            self.insert_account(source_db.account)
+        if self.is_open() and "contactgroups" not in self.tables:
+            self.create_table("contactgroups")
+        if self.is_open() and "contactgroups" in self.tables:
+            main.log("Merging %d contact groups into %s.",
+                len(groups), self.filename
+            )
+            self.ensure_backup()
+
+            col_data = self.get_table_columns("contactgroups")
+            pk = [c["name"] for c in col_data if c["pk"]][0]
+            pk_key = "PK%s" % int(time.time())
+            fields = [col["name"] for col in col_data if not col["pk"]]
+            str_fields = ", ".join(["%s = :%s" % (col, col) for col in fields])
+            existing = dict([(c["name"], c) for c in self.get_contactgroups()])
+            for c in filter(lambda x: x["name"] in existing, groups):
+                c_filled = self.fill_missing_fields(c, fields)
+                c_filled[pk_key] = existing[c["name"]][pk]
+                self.execute("UPDATE contactgroups SET %s WHERE %s = :%s" % (
+                    str_fields, pk, pk_key
+                ), c_filled)
+
+            plan = self.get_insert_plan("contactgroups")
+            for c in filter(lambda x: x["name"] not in existing, groups):
+                self.execute(plan.sql, plan.make_params(c))
+            self.commit()
+            self.last_modified = datetime.datetime.now()
+
+
+    def save_row(self, table, row):
+        """
+        Updates the row in the database or inserts it if not existing.
+
+        @return  ID of the inserted row
+        """
+        if self.is_open():
+            self.ensure_backup()
+            table = table.lower()
+            col_data = self.get_table_columns(table)
+            pk = [c["name"] for c in col_data if c["pk"]][0]
+            exists = self.execute(
+                "SELECT * FROM %s WHERE %s = :%s" % (table, pk, pk), row
+            ).fetchone()
+            if exists:
+                return self.update_row(table, row)
+            else:
+                return self.insert_row(table, row)
+
+
+    def update_row(self, table, row, original_row):
+        """
+        Updates the table row in the database, identified by its primary key
+        in its original values.
+        """
+        if self.is_open():
+            table = table.lower()
+            main.log("Updating 1 row in table %s, %s.",
+                self.tables[table]["name"], self.filename
+            )
+            self.ensure_backup()
+            col_data = self.get_table_columns(table)
+            pk = [c["name"] for c in col_data if c["pk"]][0]
+            fields = ", ".join([
+                "%(name)s = :%(name)s" % col
+                    for col in col_data
+            ])
+            pk_key = "PK%s" % int(time.time())
+            values = row.copy()
+            values[pk_key] = original_row[pk]
+            self.execute("UPDATE %s SET %s WHERE %s = :%s" % (
+                table, fields, pk, pk_key
+            ), values)
+            self.commit()
+            self.last_modified = datetime.datetime.now()
+            return row[pk]
+
+
+    def insert_row(self, table, row):
+        """
+        Inserts the new table row in the database.
+
+        @return  ID of the inserted row
+        """
+        if self.is_open():
+            table = table.lower()
+            main.log("Inserting 1 row into table %s, %s.",
+                self.tables[table]["name"], self.filename
+            )
+            self.ensure_backup()
+            col_data = self.get_table_columns(table)
+            fields = [col["name"] for col in col_data]
+            str_cols = ", ".join(fields)
+            str_vals = ":" + ", :".join(fields)
+            row = self.blobs_to_binary(row, fields, col_data)
+            cursor = self.execute("INSERT INTO %s (%s) VALUES (%s)"
+                                  % (table, str_cols, str_vals), row)
+            self.commit()
+            self.last_modified = datetime.datetime.now()
+            return cursor.lastrowid
+
+
+    def delete_row(self, table, row):
+        """
+        Deletes the table row from the database. Row is identified by its
+        primary key.
+        """
+        if self.is_open():
+            table = table.lower()
+            main.log("Deleting 1 row from table %s, %s.",
+                     self.tables[table]["name"], self.filename)
+            self.ensure_backup()
+            col_data = self.get_table_columns(table)
+            pk = [c["name"] for c in col_data if c["pk"]][0]
+            self.execute("DELETE FROM %s WHERE %s = :%s" % (table, pk, pk), row)
+            self.commit()
+            self.last_modified = datetime.datetime.now()
+
+
+
+class Row(object):
+    """
+    A resultset row acting as a dictionary, keeps the raw sqlite3 row tuple
+    and a column index map shared by all rows of the same query. String and
+    BLOB values are decoded to Unicode on first access; decoded, changed and
+    added values are kept in a separate dictionary.
+    """
+    __slots__ = ("_columns", "_values", "_data")
+    __hash__ = None # Mutable like a dict, so not hashable
+
+    # For creating the values dictionary once if rows are shared by threads
+    _data_lock = threading.Lock()
+
+
+    def __init__(self, columns, values):
+        """
+        @param   columns  {column name: index in values}, shared between rows
+        @param   values   row values tuple as returned from sqlite3
+        """
+        self._columns = columns
+        self._values = values
+        self._data = None # {name: decoded or assigned value, }
+
+
+    def __getitem__(self, key):
+        data = self._data
+        if data is not None and key in data:
+            return data[key]
+        value = self._values[self._columns[key]]
+        datatype = type(value)
+        if datatype is str:
+            try:
+                value = value.decode("utf-8")
+            except UnicodeError:
+                value = value.decode("latin1")
+        elif datatype is buffer:
+            value = str(value).decode("latin1")
+        else:
+            return value
+        if data is None:
+            data = self._init_data()
+        data[key] = value
+        return value
+
+
+    def __setitem__(self, key, value):
+        data = self._data
+        if data is None:
+            data = self._init_data()
+        data[key] = value
+
+
+    def _init_data(self):
+        """Returns the values dictionary, creating it if not yet created."""
+        with self._data_lock:
+            if self._data is None:
+                self._data = {}
+            return self._data
+
+
+    def __delitem__(self, key):
+        if key in self._columns:
+            # Switch to a plain dictionary, rows with dropped columns are rare.
+            self._data = self.copy()
+            self._columns, self._values = {}, ()
+        if self._data is None:
+            raise KeyError(key)
+        del self._data[key]
+
+
+    def __contains__(self, key):
+        return key in self._columns \
+               or (self._data is not None and key in self._data)
+
+
+    def __iter__(self):
+        return iter(self.keys())
+
+
+    def __len__(self):
+        return len(self.keys())
+
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+        if not isinstance(other, (dict, Row)):
+            return NotImplemented
+        return self.copy() == dict(other.items())
+
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+
+    def __repr__(self):
+        return repr(self.copy())
+
+
+    def has_key(self, key):
+        return key in self
+
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+
+    def keys(self):
+        result = list(self._columns)
+        if self._data:
+            result.extend(k for k in self._data if k not in self._columns)
+        return result
+
+
+    def values(self):
+        return [self[k] for k in self.keys()]
+
+
+    def items(self):
+        return [(k, self[k]) for k in self.keys()]
+
+
+    def iterkeys(self):
+        return iter(self.keys())
+
+
+    def itervalues(self):
+        return (self[k] for k in self.keys())
+
+
+    def iteritems(self):
+        return ((k, self[k]) for k in self.keys())
+
+
+    def copy(self):
+        """Returns the row as a new plain dictionary with all values decoded."""
+        return dict((k, self[k]) for k in self.keys())
+
+
+    def update(self, other=None, **kwargs):
+        if other is not None:
+            pairs = other.items() if hasattr(other, "keys") else other
+            for key, value in pairs:
+                self[key] = value
+        for key, value in kwargs.items():
+            self[key] = value
+
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+
+    def pop(self, key, *default):
+        if key not in self:
+            if default:
+                return default[0]
+            raise KeyError(key)
+        value = self[key]
+        del self[key]
+        return value
+
+
+
+class LazyRow(Row):
+    """
+    A resultset row with some values produced on first access by loader
+    functions, like participant lists of chats. Values not yet loaded are
+    not compared in equality checks.
+    """
+    __slots__ = ("_loaders", "_keep")
+
+
+    def __init__(self, row, loaders, keep=True):
+        """
+        @param   row      Row to take columns and values from
+        @param   loaders  {name: function returning value, }
+        @param   keep     whether loaded values are kept in the row,
+                          or loaded anew on every access
+        """
+        Row.__init__(self, row._columns, row._values)
+        self._data = dict(row._data) if row._data else None
+        self._loaders = dict(loaders)
+        self._keep = keep
+
+
+    def __getitem__(self, key):
+        if key in self._loaders:
+            if not self._keep:
+                return self._loaders[key]()
+            self[key] = self._loaders[key]()
+        return Row.__getitem__(self, key)
+
+
+    def __setitem__(self, key, value):
+        self._loaders.pop(key, None)
+        Row.__setitem__(self, key, value)
+
+
+    def __delitem__(self, key):
+        if self._loaders.pop(key, None) is None:
+            Row.__delitem__(self, key)
+
+
+    def __contains__(self, key):
+        return key in self._loaders or Row.__contains__(self, key)
+
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+        if not isinstance(other, (dict, Row)):
+            return NotImplemented
+        pending = set(self._loaders) | set(getattr(other, "_loaders", ()))
+        items1 = dict((k, self[k]) for k in self.keys() if k not in pending)
+        items2 = dict((k, other[k]) for k in other.keys() if k not in pending)
+        return items1 == items2
+
+
+    def keys(self):
+        result = Row.keys(self)
+        result.extend(k for k in self._loaders if k not in result)
+        return result
+
+
+    def copy(self, load=True):
+        """
+        Returns the row as a new plain dictionary with all values decoded.
+
+        @param   load  whether to include values not yet loaded
+        """
+        keys = self.keys() if load else Row.keys(self)
+        return dict((k, self[k]) for k in keys)
+
+
+
+class MessageCache(object):
+    """
+    Cached message lists per chat, acting as a dictionary of {chat ID:
+    [message, ]}. Total size of cached messages is kept within a byte budget
+    by evicting least recently used chats. Sizes are estimated from message
+    contents, including parsed DOMs cached in messages. Message lists are kept
+    sorted by (timestamp, id), with a parallel list of timestamps for
+    bisecting ranges. Access is synchronized, for background loading.
+    """
+
+    """Estimated size of a message row and its parsed DOM, in bytes."""
+    MESSAGE_SIZE = 2500
+
+    """Estimated size per character of message body, in bytes."""
+    MESSAGE_CHAR_SIZE = 10
+
+
+    def __init__(self, budget):
+        """
+        @param   budget  maximum total estimated size of cached messages,
+                         in bytes
+        """
+        self.budget = budget
+        self.chats = collections.OrderedDict() # {chat ID: [message, ]}
+        self.timestamps = {} # {chat ID: [message timestamp, ]}
+        self.sizes = {} # {chat ID: estimated size in bytes}
+        self.size = 0   # Total estimated size in bytes
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+        self.lock = threading.RLock()
+
+
+    def get(self, key, default=None):
+        """
+        Returns the message list of the chat, marking the chat as recently
+        used, or default if not cached. Counted in cache statistics.
+        """
+        with self.lock:
+            result = self.chats.pop(key, None)
+            if result is None:
+                self.stats["misses"] += 1
+                return default
+            self.stats["hits"] += 1
+            self.chats[key] = result
+            return result
+
+
+    def peek(self, key, default=None):
+        """Returns the message list of the chat, without marking it as used."""
+        with self.lock:
+            return self.chats.get(key, default)
+
+
+    def add_if_room(self, key, messages):
+        """
+        Adds the message list of the chat if it fits into the budget without
+        evicting other chats, for loading in the background.
+
+        @return  the cached message list of the chat, or None if no room
+        """
+        messages.sort(key=lambda m: (m["timestamp"], m["id"]))
+        size = self.estimate_size(messages)
+        with self.lock:
+            if key in self.chats:
+                return self.chats[key]
+            if self.size + size > self.budget:
+                return None
+            self.chats[key] = messages
+            self.timestamps[key] = [m["timestamp"] for m in messages]
+            self.sizes[key] = size
+            self.size += size
+            return messages
+
+
+    def update_size(self, key):
+        """
+        Re-estimates the size of the chat's message list after changes,
+        evicting other chats if over budget.
+        """
+        with self.lock:
+            if key in self.chats:
+                self.size -= self.sizes[key]
+                self.sizes[key] = self.estimate_size(self.chats[key])
+                self.size += self.sizes[key]
+                self.evict()
+
+
+    def add(self, key, message):
+        """
+        Inserts the message into the chat's cached message list in sorted
+        position. Size is not re-estimated, call update_size() afterwards.
+        """
+        with self.lock:
+            index = self.bisect(key, message["timestamp"], message["id"])
+            self.chats[key].insert(index, message)
+            self.timestamps[key].insert(index, message["timestamp"])
+
+
+    def bisect(self, key, timestamp, message_id=None, right=False):
+        """
+        Returns the position in the chat's cached message list where a
+        message with the timestamp and ID would be inserted.
+
+        @param   message_id  if None, position is found by timestamp only
+        @param   right       whether position is after messages with the
+                             same key, or before them
+        """
+        with self.lock:
+            messages, timestamps = self.chats[key], self.timestamps[key]
+        if message_id is None:
+            func = bisect.bisect_right if right else bisect.bisect_left
+            return func(timestamps, timestamp)
+        lo = bisect.bisect_left(timestamps, timestamp)
+        hi = bisect.bisect_right(timestamps, timestamp, lo)
+        while lo < hi: # Messages with equal timestamps are sorted by ID
+            mid = (lo + hi) // 2
+            mid_id = messages[mid]["id"]
+            if mid_id < message_id or right and mid_id == message_id:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+
+    def estimate_size(self, messages):
+        """Returns the estimated size of the message list, in bytes."""
+        chars = sum(len(m["body_xml"] or "") for m in messages)
+        return (len(messages) * self.MESSAGE_SIZE +
+                chars * self.MESSAGE_CHAR_SIZE)
+
+
+    def evict(self):
+        """Drops least recently used chats until within budget."""
+        with self.lock:
+            while self.size > self.budget and len(self.chats) > 1:
+                key, _ = self.chats.popitem(last=False)
+                self.size -= self.sizes.pop(key)
+                del self.timestamps[key]
+                self.stats["evictions"] += 1
+
+
+    def clear(self):
+        with self.lock:
+            self.chats.clear()
+            self.timestamps.clear()
+            self.sizes.clear()
+            self.size = 0
+
+
+    def __getitem__(self, key):
+        with self.lock:
+            result = self.chats.pop(key)
+            self.chats[key] = result
+            return result
+
+
+    def __setitem__(self, key, messages):
+        messages.sort(key=lambda m: (m["timestamp"], m["id"]))
+        timestamps = [m["timestamp"] for m in messages]
+        size = self.estimate_size(messages)
+        with self.lock:
+            if key in self.chats:
+                del self[key]
+            self.chats[key] = messages
+            self.timestamps[key] = timestamps
+            self.sizes[key] = size
+            self.size += size
+            self.evict()
+
+
+    def __delitem__(self, key):
+        with self.lock:
+            del self.chats[key]
+            del self.timestamps[key]
+            self.size -= self.sizes.pop(key)
+
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.chats
+
+
+    def __iter__(self):
+        return iter(self.keys())
+
+
+    def __len__(self):
+        with self.lock:
+            return len(self.chats)
+
+
+    def keys(self):
+        with self.lock:
+            return self.chats.keys()
+
+
+    def values(self):
+        with self.lock:
+            return self.chats.values()
+
+
+    def items(self):
+        with self.lock:
+            return self.chats.items()
+
+
+
+class DailyStatistics(object):
+    """
+    Message counts of a single chat per day and author, with prefix sums
+    over days kept for each author, so that counts for any range of days are
+    taken in logarithmic time regardless of the number of messages.
+    """
+
+    """Count fields summed over days."""
+    FIELDS = ["total", "messages", "chars", "smses", "smschars", "calls",
+              "calldurations", "callmaxdurations", "files", "bytes"]
+
+    """Values of a new day and author entry."""
+    EMPTY = dict([(k, 0) for k in FIELDS], first=None, last=None)
+
+
+    def __init__(self, days=None, state=None):
+        """
+        @param   days   {"YYYY-MM-DD": {author: {FIELDS.., "first", "last"}}}
+        @param   state  [max message ID, message count] of the chat, as of
+                        the counted messages
+        """
+        self.days = {}       # {"YYYY-MM-DD": {author: {FIELDS.., ..}}}
+        self.state = [0, 0]  # [max message ID, message count]
+        self.version = None  # Database data version when last up to date
+        self.sums = None     # {author: ([day, ], [(FIELDS prefix sums), ])}
+        self.bounds = None   # ([day, ], [(first timestamp, last), ])
+        if days:
+            self.add(days, state)
+
+
+    def add(self, days, state):
+        """
+        Adds counts of new messages.
+
+        @param   days   {"YYYY-MM-DD": {author: {FIELDS.., "first", "last"}}}
+        @param   state  [max message ID, message count] of the chat, as of
+                        the counted messages
+        """
+        for day, authors in days.items():
+            for author, values in authors.items():
+                counts = self.days.setdefault(day, {})
+                counts = counts.setdefault(author, dict(self.EMPTY))
+                for k in self.FIELDS:
+                    counts[k] += values[k]
+                counts["first"] = min(filter(None, [counts["first"],
+                                      values["first"]]) or [None])
+                counts["last"] = max(counts["last"], values["last"])
+        self.state = list(state or self.state)
+        self.sums = self.bounds = None
+
+
+    def get(self, first_day=None, last_day=None):
+        """
+        Returns counts over the range of days.
+
+        @param   first_day  first day to include, as "YYYY-MM-DD", if any
+        @param   last_day   last day to include, as "YYYY-MM-DD", if any
+        @return             {"counts": {author: {FIELDS..}}, FIELDS..,
+                             "first": first timestamp, "last": last timestamp}
+        """
+        if self.sums is None:
+            self.make_sums()
+        result = dict(self.EMPTY, counts={})
+        span = lambda days: (bisect.bisect_left(days, first_day)
+                             if first_day else 0,
+                             bisect.bisect_right(days, last_day)
+                             if last_day else len(days))
+        for author, (days, sums) in self.sums.items():
+            i, j = span(days)
+            if i < j:
+                counts = dict((k, b - a) for k, a, b
+                              in zip(self.FIELDS, sums[i], sums[j]))
+                result["counts"][author] = counts
+                for k in self.FIELDS:
+                    result[k] += counts[k]
+        days, bounds = self.bounds
+        i, j = span(days)
+        if i < j:
+            result["first"], result["last"] = bounds[i][0], bounds[j - 1][1]
+        return result
+
+
+    def make_sums(self):
+        """Computes prefix sums over days and day bounds."""
+        self.sums, self.bounds = {}, ([], [])
+        for day in sorted(self.days):
+            firsts, lasts = [], []
+            for author, values in self.days[day].items():
+                days, sums = self.sums.setdefault(author,
+                    ([], [tuple(0 for k in self.FIELDS)]))
+                days.append(day)
+                sums.append(tuple(a + values[k]
+                                  for k, a in zip(self.FIELDS, sums[-1])))
+                firsts.append(values["first"]), lasts.append(values["last"])
+            if filter(None, firsts):
+                self.bounds[0].append(day)
+                self.bounds[1].append((min(filter(None, firsts)), max(lasts)))
+
+
+
+class ConnectionPool(object):
+    """
+    A bounded pool of read-only connections to a database file. Connections
+    are checked out per thread: nested checkouts in the same thread share one
+    connection, which returns to the pool when all its checkouts have been
+    released.
+    """
+
+    def __init__(self, opener, size):
+        """
+        @param   opener  function returning a new read-only connection
+        @param   size    maximum number of connections to open
+        """
+        self.opener = opener
+        self.size = size
+        self.lock = threading.Condition()
+        self.connections = [] # All opened connections
+        self.idle = []        # Opened connections not checked out
+        self.owned = {}       # {thread ident: connection, }
+        self.checkouts = {}   # {id(connection): [thread ident, count], }
+        self.closed = False
+        # Usage statistics, for sizing the pool
+        self.stats = {"checkouts": 0, "waits": 0, "wait_time": 0.,
+                      "timeouts": 0, "created": 0, "max_used": 0}
+
+
+    def acquire(self, timeout=None):
+        """
+        Checks out a connection for the current thread, opening a new one if
+        all are in use and the pool is not full, or waiting for one to be
+        released otherwise.
+
+        @param   timeout  seconds to wait for a free connection, if any
+        @return           sqlite3.Connection, or None if pool is closed
+                          or timed out
+        """
+        ident = threading.current_thread().ident
+        with self.lock:
+            if self.closed:
+                return None
+            self.stats["checkouts"] += 1
+            connection = self.owned.get(ident)
+            if not connection:
+                waited = None
+                while not self.closed and not self.idle \
+                and len(self.connections) >= self.size:
+                    if waited is None:
+                        waited = time.time()
+                        self.stats["waits"] += 1
+                    remaining = None
+                    if timeout is not None:
+                        remaining = waited + timeout - time.time()
+                        if remaining <= 0:
+                            break # break while not self.closed
+                    self.lock.wait(remaining)
+                if waited is not None:
+                    self.stats["wait_time"] += time.time() - waited
+                if self.closed:
+                    return None
+                if self.idle:
+                    connection = self.idle.pop()
+                elif len(self.connections) < self.size:
+                    connection = self.connect()
+                else:
+                    self.stats["timeouts"] += 1
+                    return None
+                self.owned[ident] = connection
+                self.checkouts[id(connection)] = [ident, 0]
+                self.stats["max_used"] = max(self.stats["max_used"],
+                                             len(self.checkouts))
+            self.checkouts[id(connection)][1] += 1
+        return connection
+
+
+    def release(self, connection):
+        """
+        Releases a checkout of the connection, returning it to the pool if
+        no more checkouts remain. Can be called from any thread.
+        """
+        with self.lock:
+            checkout = self.checkouts.get(id(connection))
+            if not checkout:
+                return
+            checkout[1] -= 1
+            if checkout[1] > 0:
+                return
+            del self.checkouts[id(connection)]
+            if self.owned.get(checkout[0]) is connection:
+                del self.owned[checkout[0]]
+            if self.closed:
+                self.connections.remove(connection)
+                try:
+                    connection.close()
+                except Exception:
+                    pass
+            else:
+                self.idle.append(connection)
+                self.lock.notify()
+
+
+    def connect(self):
+        """Opens and returns a new read-only connection to the database."""
+        connection = self.opener()
+        self.connections.append(connection)
+        self.stats["created"] += 1
+        return connection
+
+
+    def close(self):
+        """
+        Closes all idle connections, and connections still checked out as
+        soon as they are released.
+        """
+        with self.lock:
+            self.closed = True
+            for connection in self.idle:
+                self.connections.remove(connection)
+                try:
+                    connection.close()
+                except Exception:
+                    pass
+            del self.idle[:]
+            self.lock.notify_all()
+
+
+
+class InsertPlan(object):
+    """
+    A prepared INSERT statement for a table, turning row dictionaries into
+    parameter tuples in column order, with BLOB values as sqlite3.Binary.
+    Primary key column "id" is left for the database to assign.
+    """
+
+    def __init__(self, table, col_data):
+        """
+        @param   table     table name
+        @param   col_data  table columns, as returned from get_table_columns()
+        """
+        self.table = table
+        self.fields = [c["name"] for c in col_data if c["name"] != "id"]
+        types = dict((c["name"], c["type"]) for c in col_data)
+        self.blob_indexes = frozenset(i for i, x in enumerate(self.fields)
+                                      if "blob" == (types[x] or "").lower())
+        self.sql = "INSERT INTO %s (%s) VALUES (%s)" % (table,
+                   ", ".join(self.fields), ", ".join(["?"] * len(self.fields)))
+
+
+    def make_params(self, row, values=None, default=None):
+        """
+        Returns the row as a tuple of query parameters.
+
+        @param   row      source row, as a dict or Row
+        @param   values   values overriding those in row, as {name: value}
+        @param   default  value for fields missing from row
+        @return           tuple of values in column order
+        """
+        result = []
+        values, get = values or {}, row.get
+        blob_indexes = self.blob_indexes
+        for i, name in enumerate(self.fields):
+            val = values[name] if name in values else get(name, default)
+            if val and i in blob_indexes:
+                if isinstance(val, unicode):
+                    val = val.encode("latin1")
+                val = sqlite3.Binary(val)
+            result.append(val)
+        return tuple(result)
+
+
+
+class SidecarIndex(object):
+    """
+    An index database kept in a separate file next to the program, mapping
+    lookup columns of Messages, Transfers, SMSes and Calls to row IDs, for
+    queries the Skype database itself has no indexes for. The Skype database
+    schema is never changed. Rows appended via the main connection are indexed
+    incrementally. Tables changed in place, or changed by other programs, are
+    checked against index row checksums in the background, and dropped from
+    use until checked. Also stores per-chat daily message counts for
+    DailyStatistics, and message word counts for the term frequency index,
+    cleared for chats having rows changed in place.
+    """
+
+    """Indexed tables, as {table: [columns, ]}."""
+    TABLES = {
+        "calls":     ["conv_dbid"],
+        "messages":  ["convo_id", "timestamp", "type", "remote_id"],
+        "smses":     ["chatmsg_id"],
+        "transfers": ["chatmsg_guid"],
+    }
+
+    """
+    Columns linking indexed rows to chats whose aggregates in STATS_TABLES
+    depend on them, as {table: column}. Transfers link via message GUID.
+    """
+    STATS_LINKS = {"messages": "convo_id", "transfers": "chatmsg_guid"}
+
+    """Indexes on the mapping tables, as {index name: (table, columns)}."""
+    INDEXES = {
+        "calls_conv_dbid":         ("calls", "conv_dbid"),
+        "messages_convo_id":       ("messages", "convo_id, timestamp"),
+        "messages_remote_id":      ("messages", "remote_id"),
+        "messages_timestamp":      ("messages", "timestamp"),
+        "smses_chatmsg_id":        ("smses", "chatmsg_id"),
+        "transfers_chatmsg_guid":  ("transfers", "chatmsg_guid"),
+    }
+
+    """
+    Tables of per-chat message aggregates built on demand: daily message
+    counts for DailyStatistics, and word counts per author and month if
+    conf.DBTermIndexEnabled, with message state of each chat as of counting,
+    as {table: SQL columns}.
+    """
+    STATS_TABLES = {
+        "daily":       "convo_id INTEGER, day TEXT, author TEXT, %s, "
+                       "first INTEGER, last INTEGER, "
+                       "PRIMARY KEY (convo_id, day, author)" % ", ".join(
+                       "%s INTEGER" % k for k in DailyStatistics.FIELDS),
+        "daily_chats": "convo_id INTEGER PRIMARY KEY, max_id INTEGER, "
+                       "count INTEGER",
+        "terms":       "convo_id INTEGER, author TEXT, month TEXT, "
+                       "term TEXT, count INTEGER, "
+                       "PRIMARY KEY (convo_id, author, month, term)",
+        "terms_chats": "convo_id INTEGER PRIMARY KEY, max_id INTEGER, "
+                       "count INTEGER",
+    }
+
+    """Index structure version, index is rebuilt if changed."""
+    VERSION = 3
+
+    """Number of rows inserted into the index per transaction."""
+    CHUNK = 10000
+
+
+    def __init__(self, db, filename):
+        """
+        @param   db        SkypeDatabase instance
+        @param   filename  path of the index database file
+        """
+        self.db = db
+        self.filename = filename
+        self.connection = None
+        self.lock = threading.Lock()
+        self.thread = None   # Background indexing thread
+        self.closed = False
+        self.tables = set()  # Tables currently indexed and usable
+        self.state = {}      # {table: [max rowid, row count] when indexed}
+        self.version = None  # Skype database data version when last synced
+        self.verified = {}   # {table: PRAGMA data_version when checked}
+        self.dirty = set()   # Tables changed in place via main connection
+        self.attached = {}   # {id(connection): connection}
+
+
+    def open(self):
+        """
+        Opens the index database, clearing it if made for another database
+        or with a different structure.
+        """
+        directory = os.path.dirname(self.filename)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.connection = sqlite3.connect(self.filename,
+                                          check_same_thread=False)
+        self.connection.text_factory = str
+        # Write-ahead logging lets readers proceed during indexing
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        identity = json.dumps({"path": os.path.abspath(self.db.filename),
+            "version": self.VERSION, "schema": dict((t, self.db.tables[t]
+            ["sql"]) for t in sorted(self.TABLES) if t in self.db.tables),
+            "timezone": [time.timezone, time.altzone]}, # For daily counts
+            sort_keys=True)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS meta "
+                                "(key TEXT PRIMARY KEY, value TEXT)")
+        meta = dict(self.connection.execute("SELECT key, value FROM meta"))
+        if identity != meta.get("identity"):
+            main.log("Creating index database %s for %s.",
+                     self.filename, self.db.filename)
+            for table in list(self.TABLES) + list(self.STATS_TABLES):
+                self.connection.execute("DROP TABLE IF EXISTS %s" % table)
+            meta = {}
+        for table, columns in self.TABLES.items():
+            self.connection.execute("CREATE TABLE IF NOT EXISTS %s "
+                "(id INTEGER PRIMARY KEY, %s, checksum INTEGER)"
+                % (table, ", ".join(columns)))
+        for table, columns in self.STATS_TABLES.items():
+            self.connection.execute("CREATE TABLE IF NOT EXISTS %s (%s)"
+                                    % (table, columns))
+        for name, (table, columns) in self.INDEXES.items():
+            self.connection.execute("CREATE INDEX IF NOT EXISTS %s ON %s "
+                                    "(%s)" % (name, table, columns))
+        self.state = json.loads(meta.get("state", "{}"))
+        self.connection.execute("INSERT OR REPLACE INTO meta (key, value) "
+                                "VALUES ('identity', ?)", [identity])
+        self.connection.commit()
+
+
+    def refresh(self):
+        """Brings the index up to date in a background thread."""
+        if not (self.thread and self.thread.is_alive()):
+            self.thread = threading.Thread(target=self.sync,
+                                           kwargs={"full": True})
+            self.thread.daemon = True
+            self.thread.start()
+
+
+    def sync(self, full=False):
+        """
+        Brings the index up to date with the Skype database, if changed.
+        Without full, only appended rows are indexed, and tables needing
+        checking are dropped from use until refreshed in the background.
+
+        @param   full  whether to wait for other syncing to finish, and
+                       check tables changed other than by appending
+        @return        whether syncing was done, False if index is busy
+        """
+        if not self.lock.acquire(full):
+            return False
+        try:
+            if self.closed:
+                return False
+            version = self.db.get_data_version()
+            if version == self.version and not self.dirty:
+                return True
+            if not self.connection:
+                self.open()
+            reindex = []
+            with self.db.read_connection() as connection:
+                for table in sorted(self.TABLES):
+                    if not self.sync_table(table, connection, version[0],
+                                           full):
+                        reindex.append(table)
+            self.connection.execute("INSERT OR REPLACE INTO meta (key, value)"
+                " VALUES ('state', ?)", [json.dumps(self.state)])
+            self.connection.commit()
+            if reindex:
+                self.refresh()
+            else:
+                self.version = version
+            return True
+        except Exception:
+            self.tables.clear()
+            if not self.closed:
+                main.log("Error indexing %s in %s.\n\n%s", self.db.filename,
+                         self.filename, traceback.format_exc())
+            return False
+        finally:
+            if self.closed and self.connection:
+                self.connection.close()
+                self.connection = None
+            self.lock.release()
+
+
+    def sync_table(self, table, connection, data_version=None, full=False):
+        """
+        Indexes new rows in the Skype database table. Rows are taken as only
+        appended if the table was checked at the same data version and has not
+        been changed in place since, as other programs changing rows in place
+        leave row counts unchanged.
+
+        @param   connection    connection to the Skype database
+        @param   data_version  current PRAGMA data_version of the Skype
+                               database main connection
+        @param   full          whether to check the whole table if it may have
+                               been changed other than by appending
+        @return                False if table needs checking, True otherwise
+        """
+        if table not in self.db.tables:
+            self.tables.discard(table)
+            self.state.pop(table, None)
+            return True
+        cursor = connection.cursor()
+        cursor.row_factory = None
+        sql = "SELECT COALESCE(MAX(rowid), 0), COUNT(*) FROM %s" % table
+        max_rowid, rows = cursor.execute(sql).fetchone()
+        state = self.state.get(table)
+        from_rowid = None # Index rows from this rowid, checking all if None
+        if state and max_rowid >= state[0] and table not in self.dirty \
+        and data_version is not None \
+        and self.verified.get(table) == data_version:
+            if [max_rowid, rows] == state:
+                self.tables.add(table)
+                return True
+            sql = "SELECT COUNT(*) FROM %s WHERE rowid > ?" % table
+            appended = cursor.execute(sql, [state[0]]).fetchone()[0]
+            if rows - state[1] == appended:
+                from_rowid = state[0]
+        if from_rowid is None:
+            self.tables.discard(table)
+            if not full:
+                return False
+            self.dirty.discard(table)
+            self.check_table(table, connection, max_rowid)
+        else:
+            cursor.execute("SELECT rowid, * FROM %s WHERE rowid > ? "
+                           "AND rowid <= ?" % table, [from_rowid, max_rowid])
+            for chunk in self.read_rows(table, cursor):
+                self.connection.executemany(self.get_insert_sql(table), chunk)
+                self.connection.commit()
+        self.state[table] = [max_rowid, rows]
+        self.verified[table] = data_version
+        self.tables.add(table)
+        return True
+
+
+    def check_table(self, table, connection, max_rowid):
+        """
+        Compares the index with all rows of the Skype database table up to
+        the specified rowid, updating index rows that differ, and clearing
+        aggregates of chats that had rows changed or deleted.
+        """
+        main.log("Checking index of table %s in %s.", table, self.db.filename)
+        columns = self.TABLES[table]
+        link = self.STATS_LINKS.get(table)
+        cursor = connection.cursor()
+        cursor.row_factory = None
+        cursor.execute("SELECT rowid, * FROM %s WHERE rowid <= ? "
+                       "ORDER BY rowid" % table, [max_rowid])
+        sql = "SELECT id, %s, checksum FROM %s WHERE id > ? AND id <= ?" % \
+              (", ".join(columns), table)
+        last_rowid, changes = 0, 0
+        chunks = self.read_rows(table, cursor)
+        while True:
+            chunk = next(chunks, None)
+            rowid = chunk[-1][0] if chunk else sys.maxint
+            indexed = dict((x[0], x) for x in self.connection.execute(
+                           sql, [last_rowid, rowid]))
+            changed, links = [], set()
+            for row in chunk or []:
+                previous = indexed.pop(row[0], None)
+                if previous != row:
+                    changed.append(row)
+                if previous and previous != row and link:
+                    links.add(previous[1 + columns.index(link)])
+            if link:
+                links.update(x[1 + columns.index(link)]
+                             for x in indexed.values())
+            if indexed:
+                self.connection.executemany("DELETE FROM %s WHERE id = ?"
+                    % table, ([x] for x in indexed))
+            self.connection.executemany(self.get_insert_sql(table), changed)
+            self.clear_stats(table, links, connection)
+            self.connection.commit()
+            changes += len(changed) + len(indexed)
+            if not chunk:
+                break # break while True
+            last_rowid = rowid
+        if changes:
+            main.log("Updated %s in index of table %s in %s.",
+                     util.plural("row", changes), table, self.db.filename)
+
+
+    def read_rows(self, table, cursor):
+        """
+        Yields chunks of index rows from a "SELECT rowid, *" query executed
+        on the Skype database table, as [(rowid, indexed values.., checksum)].
+        """
+        names = [x[0].lower() for x in cursor.description]
+        indexes = [names.index(x, 1) for x in self.TABLES[table]]
+        rows = cursor.fetchmany(self.CHUNK)
+        while rows:
+            if self.closed:
+                raise sqlite3.OperationalError("Index closed.")
+            yield [(x[0], ) + tuple(x[i] for i in indexes)
+                   + (self.get_checksum(x[1:]), ) for x in rows]
+            rows = cursor.fetchmany(self.CHUNK)
+
+
+    def get_checksum(self, values):
+        """Returns a checksum of row values, for detecting changed rows."""
+        return zlib.crc32(repr([str(x) if isinstance(x, buffer) else x
+                                for x in values]))
+
+
+    def get_insert_sql(self, table):
+        """Returns the SQL statement for inserting rows into the index."""
+        columns = self.TABLES[table]
+        return "INSERT OR REPLACE INTO %s (id, %s, checksum) VALUES (?, %s)" \
+               % (table, ", ".join(columns), ", ".join(["?"] * len(columns)
+                                                        + ["?"]))
+
+
+    def clear_stats(self, table, links, connection):
+        """
+        Deletes aggregates in STATS_TABLES of chats depending on changed rows
+        of the Skype database table.
+
+        @param   links       values of the STATS_LINKS column of the table
+                             in changed rows
+        @param   connection  connection to the Skype database
+        """
+        links, ids = [x for x in links if x is not None], set()
+        for i in range(0, len(links), 500): # Stay under SQL variable limit
+            chunk = links[i:i + 500]
+            if "transfers" == table:
+                ids.update(x[0] for x in connection.execute(
+                    "SELECT DISTINCT convo_id FROM messages WHERE guid IN "
+                    "(%s)" % ", ".join(["?"] * len(chunk)), chunk))
+            else:
+                ids.update(chunk)
+        for name in self.STATS_TABLES:
+            self.connection.executemany("DELETE FROM %s WHERE convo_id = ?"
+                                        % name, ([x] for x in ids))
+        for x in ids:
+            self.db.daily_stats.pop(x, None)
+
+
+    def invalidate(self, table):
+        """
+        Drops the table from use until checked in full, after the Skype
+        database main connection changed its rows in place.
+
+        @param   table  name of the changed table, or "*" if unknown
+        """
+        tables = set(self.TABLES if "*" == table else [table])
+        tables &= set(self.TABLES)
+        self.dirty.update(tables)
+        self.tables.difference_update(tables)
+
+
+    def get_daily(self, convo_id):
+        """
+        Returns daily message counts stored for the chat, as DailyStatistics,
+        or None if not stored or the index is busy.
+        """
+        if not self.lock.acquire(False):
+            return None
+        try:
+            if self.closed or not self.connection:
+                return None
+            state = self.connection.execute("SELECT max_id, count FROM "
+                "daily_chats WHERE convo_id = ?", [convo_id]).fetchone()
+            if not state:
+                return None
+            days = {}
+            cursor = self.connection.execute("SELECT * FROM daily "
+                                             "WHERE convo_id = ?", [convo_id])
+            columns = [x[0] for x in cursor.description]
+            for row in cursor:
+                values = dict(zip(columns, row))
+                author = values["author"] and values["author"].decode("utf-8")
+                days.setdefault(values["day"], {})[author] = values
+            return DailyStatistics(days, state)
+        finally:
+            self.lock.release()
+
+
+    def set_daily(self, convo_id, daily, days=None):
+        """
+        Stores daily message counts for the chat, skipped if index is busy.
+
+        @param   daily  DailyStatistics for the chat
+        @param   days   days to store if not all, replacing all if None
+        """
+        if not self.lock.acquire(False):
+            return
+        try:
+            if self.closed or not self.connection:
+                return
+            if days is None:
+                self.connection.execute("DELETE FROM daily "
+                                        "WHERE convo_id = ?", [convo_id])
+            fields = DailyStatistics.FIELDS + ["first", "last"]
+            sql = "INSERT OR REPLACE INTO daily (convo_id, day, author, %s) " \
+                  "VALUES (?, ?, ?, %s)" % (", ".join(fields),
+                                            ", ".join(["?"] * len(fields)))
+            self.connection.executemany(sql, ([convo_id, day, author] +
+                [values[k] for k in fields] for day in (days or daily.days)
+                for author, values in daily.days[day].items()))
+            self.connection.execute("INSERT OR REPLACE INTO daily_chats "
+                "(convo_id, max_id, count) VALUES (?, ?, ?)",
+                [convo_id] + daily.state)
+            self.connection.commit()
+        except Exception:
+            self.connection.rollback()
+            main.log("Error storing daily statistics in %s.\n\n%s",
+                     self.filename, traceback.format_exc())
+        finally:
+            self.lock.release()
+
+
+    def get_terms_state(self, convo_id):
+        """
+        Returns [max message ID, message count] of the chat as of its
+        indexed word counts, or None if not indexed.
+        """
+        with self.lock:
+            if self.closed or not self.connection:
+                return None
+            return self.connection.execute("SELECT max_id, count FROM "
+                "terms_chats WHERE convo_id = ?", [convo_id]).fetchone()
+
+
+    def add_terms(self, convo_id, counts, state, clear=False):
+        """
+        Adds word counts of chat messages to the term frequency index.
+
+        @param   counts  {(author, "YYYY-MM", word): count}
+        @param   state   [max message ID, message count] of the chat, as of
+                         the counted messages
+        @param   clear   whether to replace all indexed counts of the chat
+        @return          whether counts were stored
+        """
+        terms = collections.defaultdict(int) # {(author, month, word): count}
+        for (author, month, word), count in counts.iteritems():
+            # NULL in the primary key would never match for updating counts
+            terms[(author or "", month or "", word)] += count
+        with self.lock:
+            if self.closed or not self.connection:
+                return False
+            try:
+                if clear:
+                    self.connection.execute("DELETE FROM terms "
+                                            "WHERE convo_id = ?", [convo_id])
+                self.connection.executemany("INSERT OR IGNORE INTO terms "
+                    "(convo_id, author, month, term, count) "
+                    "VALUES (?, ?, ?, ?, 0)",
+                    ([convo_id] + list(k) for k in terms))
+                self.connection.executemany("UPDATE terms SET count = "
+                    "count + ? WHERE convo_id = ? AND author = ? AND "
+                    "month = ? AND term = ?",
+                    ([c, convo_id] + list(k) for k, c in terms.iteritems()))
+                self.connection.execute("INSERT OR REPLACE INTO terms_chats "
+                    "(convo_id, max_id, count) VALUES (?, ?, ?)",
+                    [convo_id] + list(state))
+                self.connection.commit()
+                return True
+            except Exception:
+                self.connection.rollback()
+                main.log("Error storing word counts in %s.\n\n%s",
+                         self.filename, traceback.format_exc())
+                return False
+
+
+    def attach(self, connection):
+        """
+        Attaches the index database to the Skype database connection as
+        "sidecar", if not already attached.
+
+        @return  whether the index database is attached
+        """
+        if id(connection) not in self.attached:
+            try:
+                connection.execute("ATTACH DATABASE ? AS sidecar",
+                                   [self.filename])
+                self.attached[id(connection)] = connection
+            except Exception:
+                return False # Cannot attach within a transaction
+        return True
+
+
+    def close(self):
+        """Closes the index database, stopping any indexing in progress."""
+        self.closed = True
+        self.attached.clear()
+        if self.lock.acquire(False):
+            try:
+                if self.connection:
+                    self.connection.close()
+                    self.connection = None
+            finally:
+                self.lock.release()
+
+
+
+class MetadataCache(object):
+    """
+    Precomputed database metadata kept in a JSON file across program
+    sessions, as {normalized database path: {"identity": {file identity},
+    "used": timestamp, ..}}. Least recently used entries beyond the limit
+    are dropped on saving.
+    """
+
+    def __init__(self, filename, limit=None):
         """
-        Inserts the specified account into this database and sets it as the
-        current account.
+        @param   filename  path of the metadata cache file
+        @param   limit     maximum number of databases to keep metadata for
         """
-        if self.is_open() and "accounts" not in self.tables:
-            self.create_table("accounts")
-            self.get_tables(True, "accounts")
-        if self.is_open() and "accounts" in self.tables:
-            main.log("Inserting account \"%s\" into %s.",
-                account["skypename"], self.filename
-            )
-            self.ensure_backup()
-            col_data = self.get_table_columns("accounts")
-            fields = [col["name"] for col in col_data if col["name"] != "id"]
-            str_cols = ", ".join(fields)
-            str_vals = ":" + ", :".join(fields)
+        self.filename = filename
+        self.limit = limit
+
+
+    def get(self, path):
+        """Returns the metadata entry for the database file, or None."""
+        return self.read().get(self.make_key(path))
+
+
+    def set(self, path, entry):
+        """Stores the metadata entry for the database file."""
+        data = self.read()
+        data[self.make_key(path)] = dict(entry, used=time.time())
+        if self.limit:
+            for key in sorted(data, key=lambda k: data[k].get("used"))[
+            :max(0, len(data) - self.limit)]:
+                data.pop(key)
+        directory = os.path.dirname(self.filename)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        tempname = "%s.tmp" % self.filename
+        with open(tempname, "wb") as f:
+            json.dump(data, f)
+        if os.path.exists(self.filename):
+            os.remove(self.filename) # os.rename does not overwrite in Windows
+        os.rename(tempname, self.filename)
+
+
+    def read(self):
+        """Returns the contents of the metadata cache file."""
+        result = {}
+        if os.path.exists(self.filename):
+            try:
+                with open(self.filename, "rb") as f:
+                    result = json.load(f)
+            except Exception, e:
+                main.log("Error reading %s (%s).", self.filename, e)
+        return result if isinstance(result, dict) else {}
 
-            a_filled = self.fill_missing_fields(account, fields)
-            del a_filled["id"]
-            a_filled = self.blobs_to_binary(a_filled, fields, col_data)
-            self.execute("INSERT INTO accounts (%s) VALUES (%s)" % (
-                str_cols, str_vals
-            ), a_filled)
-            self.connection.commit()
-            self.last_modified = datetime.datetime.now()
-            self.account = a_filled
-            self.id = a_filled["skypename"]
 
+    def make_key(self, path):
+        """Returns the normalized database path used as entry key."""
+        path = os.path.normcase(os.path.abspath(path))
+        return path.decode(sys.getfilesystemencoding() or "utf-8") \
+               if isinstance(path, str) else path
 
-    def insert_contacts(self, contacts, source_db):
+
+
+class QueryProfiler(object):
+    """
+    Collects execution statistics of SQL statements per calling function and
+    statement: number of calls, time spent in SQLite executing and fetching,
+    and rows fetched. Query plans are captured for statements slower than
+    conf.DBSlowQueryThreshold.
+    """
+
+    def __init__(self, enabled=False):
         """
-        Inserts the specified contacts into this database.
+        @param   enabled  whether statistics are collected
         """
-        if self.is_open() and not self.account and source_db.account:
-            self.insert_account(source_db.account)
-        if self.is_open() and "contacts" not in self.tables:
-            self.create_table("contacts")
-        if self.is_open() and "contacts" in self.tables:
-            main.log(
-                "Merging %d contacts into %s.", len(contacts), self.filename
-            )
-            self.ensure_backup()
-            col_data = self.get_table_columns("contacts")
-            fields = [col["name"] for col in col_data if col["name"] != "id"]
-            str_cols = ", ".join(fields)
-            str_vals = ":" + ", :".join(fields)
-            for c in contacts:
-                c_filled = self.fill_missing_fields(c, fields)
-                c_filled = self.blobs_to_binary(c_filled, fields, col_data)
-                self.execute("INSERT INTO contacts (%s) VALUES (%s)" % (
-                    str_cols, str_vals
-                ), c_filled)
-            self.connection.commit()
-            self.last_modified = datetime.datetime.now()
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        # {(caller, sql): {"calls": int, "time": float, "max": float,
+        #                  "rows": int, "plan": [str, ] or None,
+        #                  "logged": whether logged as slow}}
+        self.stats = {}
 
 
-    def replace_contactgroups(self, groups, source_db):
+    def execute(self, connection, sql, params, caller):
         """
-        Inserts or updates the specified contact groups in this database.
+        Executes the statement on the connection, returning a cursor that
+        records statistics when rows have been fetched or it is closed.
         """
-        if self.is_open() and not self.account and source_db.account:
-            self.insert_account(source_db.account)
-        if self.is_open() and "contactgroups" not in self.tables:
-            self.create_table("contactgroups")
-        if self.is_open() and "contactgroups" in self.tables:
-            main.log("Merging %d contact groups into %s.",
-                len(groups), self.filename
-            )
-            self.ensure_backup()
+        start = time.time()
+        cursor = connection.execute(sql, params)
+        elapsed = time.time() - start
+        if cursor.description is None: # No rows to fetch
+            self.record(caller, sql, elapsed, 0, connection, params)
+            return cursor
+        if elapsed >= conf.DBSlowQueryThreshold:
+            # Capture plan while the connection is certainly used by this
+            # thread, as the cursor may be finished only when discarded
+            self.explain(caller, sql, connection, params)
+        return ProfiledCursor(self, cursor, elapsed,
+                              (caller, sql, connection, params))
+
+
+    def record(self, caller, sql, elapsed, rows, connection=None, params=()):
+        """
+        Adds statement execution to statistics, logging the first slow
+        execution, with query plan captured on the connection if given.
+        """
+        with self.lock:
+            stat = self.get_stat(caller, sql)
+            stat["calls"] += 1
+            stat["time"] += elapsed
+            stat["max"] = max(stat["max"], elapsed)
+            stat["rows"] += rows
+            log = not stat["logged"] and elapsed >= conf.DBSlowQueryThreshold
+            if log:
+                stat["logged"] = True # Mark as logged for concurrent calls
+        if log and connection:
+            self.explain(caller, sql, connection, params)
+        if log:
+            main.log("Slow query in %s (%.3f sec, %s):\n%s\n%s", caller,
+                     elapsed, util.plural("row", rows), sql,
+                     "\n".join(stat["plan"] or []))
+
+
+    def explain(self, caller, sql, connection, params=()):
+        """
+        Captures the query plan of the statement on the connection, if not
+        already captured. The connection must not be in use by another
+        thread.
+        """
+        with self.lock:
+            stat = self.get_stat(caller, sql)
+            explain = stat["plan"] is None and sql.lstrip()[:6].upper() \
+                      in ("SELECT", "INSERT", "UPDATE", "DELETE")
+            if explain:
+                stat["plan"] = [] # Mark as captured for concurrent calls
+        if explain:
+            try:
+                plan = connection.execute("EXPLAIN QUERY PLAN %s" % sql,
+                                          params).fetchall()
+                stat["plan"] = [r["detail"] if isinstance(r, Row) else r[-1]
+                                for r in plan]
+            except Exception:
+                pass
 
-            col_data = self.get_table_columns("contactgroups")
-            pk = [c["name"] for c in col_data if c["pk"]][0]
-            pk_key = "PK%s" % int(time.time())
-            fields = [col["name"] for col in col_data if not col["pk"]]
-            str_fields = ", ".join(["%s = :%s" % (col, col) for col in fields])
-            existing = dict([(c["name"], c) for c in self.get_contactgroups()])
-            for c in filter(lambda x: x["name"] in existing, groups):
-                c_filled = self.fill_missing_fields(c, fields)
-                c_filled[pk_key] = existing[c["name"]][pk]
-                self.execute("UPDATE contactgroups SET %s WHERE %s = :%s" % (
-                    str_fields, pk, pk_key
-                ), c_filled)
 
-            str_cols = ", ".join(fields)
-            str_vals = ":" + ", :".join(fields)
-            for c in filter(lambda x: x["name"] not in existing, groups):
-                c_filled = self.fill_missing_fields(c, fields)
-                c_filled = self.blobs_to_binary(c_filled, fields, col_data)
-                self.execute("INSERT INTO contactgroups (%s) VALUES (%s)" % (
-                    str_cols, str_vals
-                ), c_filled)
-            self.connection.commit()
-            self.last_modified = datetime.datetime.now()
+    def get_stat(self, caller, sql):
+        """Returns the statistics entry of the statement, created if none."""
+        key = (caller, sql)
+        if key not in self.stats:
+            self.stats[key] = {"calls": 0, "time": 0., "max": 0., "rows": 0,
+                               "plan": None, "logged": False}
+        return self.stats[key]
 
 
-    def save_row(self, table, row):
+    def report(self, limit=None):
         """
-        Updates the row in the database or inserts it if not existing.
+        Returns collected statistics as text, ordered by total time.
 
-        @return  ID of the inserted row
+        @param   limit  maximum number of statements to include, if any
         """
-        if self.is_open():
-            self.ensure_backup()
-            table = table.lower()
-            col_data = self.get_table_columns(table)
-            pk = [c["name"] for c in col_data if c["pk"]][0]
-            exists = self.execute(
-                "SELECT * FROM %s WHERE %s = :%s" % (table, pk, pk), row
-            ).fetchone()
-            if exists:
-                return self.update_row(table, row)
-            else:
-                return self.insert_row(table, row)
+        with self.lock:
+            items = sorted(self.stats.items(), key=lambda x: -x[1]["time"])
+        lines = ["%8s %10s %9s %10s  %s" % ("Calls", "Total sec", "Max sec",
+                                            "Rows", "Caller / SQL")]
+        for (caller, sql), stat in items[:limit]:
+            lines.append("%(calls)8d %(time)10.3f %(max)9.3f %(rows)10d  "
+                         % stat + caller)
+            lines.append(" " * 42 + re.sub(r"\s+", " ", sql).strip())
+            for detail in stat["plan"] or []:
+                lines.append(" " * 44 + "plan: %s" % detail)
+        return "\n".join(lines)
 
 
-    def update_row(self, table, row, original_row):
+    def write(self, filename):
+        """Writes the statistics report into the file."""
+        with open(filename, "w") as f:
+            f.write(self.report().encode("utf-8"))
+
+
+    def clear(self):
+        """Clears all collected statistics."""
+        with self.lock:
+            self.stats.clear()
+
+
+
+class ProfiledCursor(object):
+    """
+    Wrapper for sqlite3.Cursor, measuring time spent fetching rows and
+    reporting to QueryProfiler once all rows are fetched or the cursor is
+    closed or discarded.
+    """
+
+    def __init__(self, profiler, cursor, elapsed, info):
         """
-        Updates the table row in the database, identified by its primary key
-        in its original values.
+        @param   profiler  QueryProfiler instance
+        @param   cursor    sqlite3.Cursor
+        @param   elapsed   seconds spent executing the statement
+        @param   info      (caller, sql, connection, params)
         """
-        if self.is_open():
-            table = table.lower()
-            main.log("Updating 1 row in table %s, %s.",
-                self.tables[table]["name"], self.filename
-            )
-            self.ensure_backup()
-            col_data = self.get_table_columns(table)
-            pk = [c["name"] for c in col_data if c["pk"]][0]
-            fields = ", ".join([
-                "%(name)s = :%(name)s" % col
-                    for col in col_data
-            ])
-            pk_key = "PK%s" % int(time.time())
-            values = row.copy()
-            values[pk_key] = original_row[pk]
-            self.execute("UPDATE %s SET %s WHERE %s = :%s" % (
-                table, fields, pk, pk_key
-            ), values)
-            self.connection.commit()
-            self.last_modified = datetime.datetime.now()
-            return row[pk]
+        self._profiler = profiler
+        self._cursor = cursor
+        self._elapsed = elapsed
+        self._rows = 0
+        self._info = info
 
 
-    def insert_row(self, table, row):
-        """
-        Inserts the new table row in the database.
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
 
-        @return  ID of the inserted row
-        """
-        if self.is_open():
-            table = table.lower()
-            main.log("Inserting 1 row into table %s, %s.",
-                self.tables[table]["name"], self.filename
-            )
-            self.ensure_backup()
-            col_data = self.get_table_columns(table)
-            fields = [col["name"] for col in col_data]
-            str_cols = ", ".join(fields)
-            str_vals = ":" + ", :".join(fields)
-            row = self.blobs_to_binary(row, fields, col_data)
-            cursor = self.execute("INSERT INTO %s (%s) VALUES (%s)"
-                                  % (table, str_cols, str_vals), row)
-            self.connection.commit()
-            self.last_modified = datetime.datetime.now()
-            return cursor.lastrowid
+
+    def __iter__(self):
+        return self
 
 
-    def delete_row(self, table, row):
+    def next(self):
+        row = self.fetchone()
+        if row is None:
+            raise StopIteration()
+        return row
+
+
+    def fetchone(self):
+        start = time.time()
+        row = self._cursor.fetchone()
+        self._elapsed += time.time() - start
+        if row is None:
+            self._finish()
+        else:
+            self._rows += 1
+        return row
+
+
+    def fetchmany(self, size=None):
+        start = time.time()
+        rows = self._cursor.fetchmany(*[size] if size else [])
+        self._elapsed += time.time() - start
+        self._rows += len(rows)
+        if not rows:
+            self._finish()
+        return rows
+
+
+    def fetchall(self):
+        start = time.time()
+        rows = self._cursor.fetchall()
+        self._elapsed += time.time() - start
+        self._rows += len(rows)
+        self._finish()
+        return rows
+
+
+    def close(self):
+        self._finish()
+        self._cursor.close()
+
+
+    def _finish(self, finalizing=False):
         """
-        Deletes the table row from the database. Row is identified by its
-        primary key.
+        Reports statistics to profiler, if not already reported.
+
+        @param   finalizing  whether called on garbage collection, when the
+                             connection may already be used by another
+                             thread, and must not be queried for query plan
         """
-        if self.is_open():
-            table = table.lower()
-            main.log("Deleting 1 row from table %s, %s.",
-                     self.tables[table]["name"], self.filename)
-            self.ensure_backup()
-            col_data = self.get_table_columns(table)
-            pk = [c["name"] for c in col_data if c["pk"]][0]
-            self.execute("DELETE FROM %s WHERE %s = :%s" % (table, pk, pk), row)
-            self.connection.commit()
-            self.last_modified = datetime.datetime.now()
+        if self._info:
+            caller, sql, connection, params = self._info
+            self._info = None
+            self._profiler.record(caller, sql, self._elapsed, self._rows,
+                                  None if finalizing else connection, params)
+
+
+    def __del__(self):
+        try:
+            self._finish(finalizing=True)
+        except Exception:
+            pass
+
+
+
+class CallDurationsAggregate(object):
+    """
+    SQLite aggregate function CALL_DURATIONS(body_xml) over call messages,
+    returning JSON {"max": sum of longest participant durations per call,
+                    "durations": {identity: total duration in seconds, }}.
+    """
+
+    def __init__(self):
+        self.max = 0
+        self.durations = {} # {identity: total duration in seconds, }
+
+
+    def step(self, body):
+        """Adds the participant durations from the call message body."""
+        if not body:
+            return
+        if isinstance(body, unicode):
+            body = body.encode("utf-8")
+        try:
+            dom = xml.etree.cElementTree.fromstring(
+                  "<xml>%s</xml>" % str(body).replace("&apos;", "'"))
+        except Exception:
+            return
+        call_durations = {} # {identity: duration in seconds, }
+        for elem in dom.getiterator("part"):
+            identity = elem.get("identity")
+            duration = elem.findtext("duration")
+            if identity and duration:
+                try:
+                    call_durations[identity] = int(duration)
+                except Exception:
+                    pass
+        for identity, duration in call_durations.items():
+            self.durations[identity] = \
+                self.durations.get(identity, 0) + duration
+        self.max += max(call_durations.values() + [0])
+
+
+    def finalize(self):
+        return json.dumps({"max": self.max, "durations": self.durations})
 
 
 
@@ -1436,6 +4343,9 @@ class TableBase(wx.grid.PyGridTableBase):
         self.is_query = True
         self.db = db
         self.sql = sql
+        # Rows are retrieved on the main connection: a pooled connection
+        # would hold a read lock on the database until all rows are read,
+        # making writes on the main connection fail meanwhile
         self.row_iterator = self.db.execute(sql)
         # Fill column information
         self.columns = []
@@ -1514,6 +4424,13 @@ class TableBase(wx.grid.PyGridTableBase):
         return self
 
 
+    def Close(self):
+        """Stops retrieving rows from the cursor, closing it."""
+        if self.row_iterator:
+            self.row_iterator.close()
+        self.row_iterator = None
+
+
     def GetColLabelValue(self, col):
         label = self.columns[col]["name"]
         if col == self.sort_column:
@@ -1570,7 +4487,7 @@ class TableBase(wx.grid.PyGridTableBase):
                 self.idx_all.append(idx)
                 self.iterator_index += 1
             else:
-                self.row_iterator = None
+                self.Close()
         if self.is_query:
             if (self.row_count != self.iterator_index + 1):
                 self.row_count = self.iterator_index + 1
@@ -1938,6 +4855,122 @@ class TableBase(wx.grid.PyGridTableBase):
 
 
 
+class EmoticonScanner(object):
+    """
+    Finds raw emoticon texts like ":)" in message bodies in a single pass,
+    with a regex compiled from a character trie of all emoticon strings, so
+    that matching branches on each next character instead of trying every
+    emoticon in turn. Checks for emoticons being part of a word or an HTML
+    entity are compiled into the same regex as look-around assertions.
+
+    Of emoticons starting at the same position, the longest acceptable one
+    is taken; if none is acceptable, the longest is skipped as plain text.
+    """
+
+    """Regex character class for HTML entity names, like "&lt;" or "&#39;"."""
+    ENTITY_CHARS = "[#0-9A-Za-z_]"
+
+
+    def __init__(self, emoticon_data):
+        """
+        @param   emoticon_data  {name: {"strings": [raw text, ], ..}, }
+        """
+        self._strings = {} # {raw text: name}
+        trie = {} # {char: {char: {..}, "": True if emoticon ends here}, }
+        for name, data in emoticon_data.items():
+            for text in data["strings"]:
+                self._strings.setdefault(text, name)
+                node = trie
+                for char in text:
+                    node = node.setdefault(char, {})
+                node[""] = True
+        # Emoticons ending and starting with a word character, the only
+        # ones that can affect whether a neighbouring emoticon is in a word
+        word_ends = collections.defaultdict(list) # {length: [raw text, ]}
+        word_starts = []
+        for text in sorted(self._strings):
+            if re.match("\\w", text[-1]):
+                word_ends[len(text)].append(re.escape(text))
+            if re.match("\\w", text[0]):
+                word_starts.append(re.escape(text))
+        self._word_ends = dict((k, "|".join(v)) for k, v in word_ends.items())
+        self._word_starts = "|".join(word_starts)
+        self._plain_rgx = re.compile(self._make_pattern(trie))
+        self._rgx = re.compile("(?P<ok>%s)|%s" % (
+            self._make_pattern(trie, checked=True), self._plain_rgx.pattern),
+            re.UNICODE)
+
+
+    def contains(self, text):
+        """
+        Returns whether the text contains any raw emoticon text, including
+        ones that are part of a word or an HTML entity.
+        """
+        return bool(self._plain_rgx.search(text))
+
+
+    def sub(self, repl, text):
+        """
+        Returns the text with raw emoticon texts replaced, skipping texts
+        that are part of a word or an HTML entity. Byte strings are taken
+        as UTF-8, for telling Unicode letters apart.
+
+        @param   repl  function(emoticon name, raw text) returning replacement
+        """
+        encoding = None
+        if isinstance(text, str):
+            try:
+                text, encoding = text.decode("utf-8"), "utf-8"
+            except UnicodeError:
+                text, encoding = text.decode("latin1"), "latin1"
+        result = self._rgx.sub(lambda m: m.group() if m.group("ok") is None
+                               else repl(self._strings[m.group()], m.group()),
+                               text)
+        return result.encode(encoding) if encoding else result
+
+
+    def _make_pattern(self, node, checked=False, char=None):
+        """
+        Returns regex pattern matching the strings in the trie node, with
+        longer strings tried before their prefixes.
+
+        @param   checked  whether to assert that emoticons are not part of
+                          a word, like "max(" or ":psi", or part of an HTML
+                          entity, like "&lt;(" or ":&quot;"
+        @param   char     last character of the strings leading to node
+        """
+        result = []
+        for x in sorted(node):
+            if not x:
+                continue # continue for x in sorted(node)
+            head = re.escape(x)
+            # Check the start after its first character, as look-behind
+            # assertions before it would disable first character scanning
+            if checked and char is None and x in string.ascii_letters:
+                # Not the end of a word, unless the end of another emoticon
+                head += "(?:(?<!\\w%s)%s)" % (head, "".join(
+                    "|(?<=(?:%s)%s)" % (v, head)
+                    for k, v in sorted(self._word_ends.items())))
+            elif checked and char is None and ";" == x:
+                # Not the end of an HTML entity
+                head += "".join("(?<!&%s{%s};)" % (self.ENTITY_CHARS, i)
+                                for i in range(2, 7))
+            result.append(head + self._make_pattern(node[x], checked, x))
+        if "" in node:
+            tail = ""
+            if checked and char in string.ascii_letters:
+                # Not the start of a word, unless the start of another emoticon
+                tail = "(?:(?!\\w)|(?=%s))" % self._word_starts
+            elif checked and "&" == char: # Not the start of an HTML entity
+                tail = "(?!%s{2,4};)" % self.ENTITY_CHARS
+            if result or tail:
+                result.append(tail)
+        if len(result) > 1:
+            return "(?:%s)" % "|".join(result)
+        return "".join(result)
+
+
+
 class MessageParser(object):
     """A Skype message parser, able to collect statistics from its input."""
 
@@ -1949,55 +4982,23 @@ class MessageParser(object):
     """HTML entities in the body to be replaced before feeding to xml.etree."""
     REPLACE_ENTITIES = { "&apos;": "'" }
 
-    """Regex for checking if string ends with any HTML entity, like "&lt;"."""
-    ENTITY_CHECKBEHIND_RGX = re.compile(".*(&[#\\w]{2,};)$")
+    """Scanner for finding raw emoticon texts in plaintext bodies."""
+    EMOTICON_SCANNER = EmoticonScanner(emoticons.EmoticonData)
 
-    """Regex for checking if string starts with any HTML entity, like "&lt;"."""
-    ENTITY_CHECKAHEAD_RGX = re.compile("^(&[#\\w]{2,};).*")
+    """Replacer callback for raw emoticon text, producing an emoticon tag."""
+    EMOTICON_REPL = lambda self, name, text: \
+        "<ss type=\"%s\">%s</ss>" % (name, text)
 
-    """Regex for replacing raw emoticon texts with emoticon tags."""
-    EMOTICON_RGX = re.compile("(%s)" % "|".join(
-                              s for i in emoticons.EmoticonData.values()
-                              for s in map(re.escape, i["strings"])))
-
-    # Regexes for checking if an emoticon is preceded or followed by
-    # a non-alphanumeric character or a smiley or an empty string.
-    EMOTICON_CHECKBEHIND_RGX = re.compile("(\\W)|(%s)|(^)$" % "|".join(
-                               s for i in emoticons.EmoticonData.values()
-                               for s in map(re.escape, i["strings"])),
-                               re.UNICODE)
-    EMOTICON_CHECKAHEAD_RGX  = re.compile("^(\\W)|(%s)|(^)$" % "|".join(
-                               s for i in emoticons.EmoticonData.values()
-                               for s in map(re.escape, i["strings"])),
-                               re.UNICODE)
+    """Regex for checking the existence of any character all emoticons have."""
+    EMOTICON_CHARS_RGX = re.compile("[:|()/]")
 
     """
-    Replacer callback for raw emoticon text. Must check whether the preceding
-    text up to the first or following text from the last emoticon char is not
-    an HTML entity, e.g. "(&lt;)" or ":&quot;", and whether emoticon start and
-    preceding text or emoticon end and following text is not alphanumeric.
+    Regex for checking whether message text may differ from the raw body
+    for reasons other than emoticons: markup, entities, or characters that
+    XML parsing would change.
     """
-    EMOTICON_REPL = lambda self, m: ("<ss type=\"%s\">%s</ss>" % 
-        (emoticons.EmoticonStrings[m.group(1)], m.group(1))
-        if m.group(1) in emoticons.EmoticonStrings
-        and (m.group(1)[:1] != ";" # Check HTML entity end, like '&lt;('
-             or not MessageParser.ENTITY_CHECKBEHIND_RGX.match(
-                m.string[max(0, m.start(1) - 7):m.start(1) + 1]))
-        and (m.group(1)[-1:] != "&" # Check for HTML entity start, like ':&gt;'
-             or not MessageParser.ENTITY_CHECKAHEAD_RGX.match(
-                m.string[m.end(1) - 1:m.end(1) + 5]))
-        and (m.group(1)[:1] not in string.ascii_letters
-             # Letter at start: check for not being the end a word, like 'max('
-             or MessageParser.EMOTICON_CHECKBEHIND_RGX.match(
-                m.string[max(0, m.start(1) - 16):m.start(1)]))
-        and (m.group(1)[-1:] not in string.ascii_letters
-             # Letter at end: check for not being the start a word, like ':psi'
-             or MessageParser.EMOTICON_CHECKAHEAD_RGX.match(
-                m.string[m.start(1) + len(m.group(1)):m.start(1) + 32]))
-        else m.group(1))
-
-    """Regex for checking the existence of any character all emoticons have."""
-    EMOTICON_CHARS_RGX = re.compile("[:|()/]")
+    PLAINTEXT_CHECK_RGX = re.compile(u"[<>&\r\x00-\x08\x0B\x0C\x0E-\x1F"
+                                     u"\uFFFE\uFFFF]")
 
     """Regex for replacing low bytes unparseable in XML (\x00 etc)."""
     SAFEBYTE_RGX = re.compile("[\x00-\x08,\x0B-\x0C,\x0E-x1F,\x7F]")
@@ -2031,10 +5032,9 @@ class MessageParser(object):
         @param   stats  whether to collect message statistics
         """
         self.db = db
-        self.dc = wx.MemoryDC()
-        self.dc.SetFont(wx.Font(8, wx.SWISS, wx.NORMAL, wx.NORMAL,
-            face=conf.HistoryFontName)
-        )
+        # Device context for wrapping HTML, created on first use so that
+        # parsers in background threads make no wx objects
+        self.dc = None
         self.textwrapper = textwrap.TextWrapper(width=self.TEXT_MAXWIDTH,
             expand_tabs=False, replace_whitespace=False,
             break_long_words=False, break_on_hyphens=False
@@ -2047,9 +5047,10 @@ class MessageParser(object):
                           "messages": 0, "counts": {}, "total": 0,
                           "calldurations": 0, "callmaxdurations": 0,
                           "startdate": None, "enddate": None, "wordcloud": [],
-                          "cloudtext": "", "links": [], "last_message": "",
-                          "chars": 0, "smschars": 0, "files": 0, "bytes": 0,
-                          "info_items": []}
+                          "words": wordcloud.WordCounter(), "chars": 0,
+                          "smschars": 0, "files": 0, "bytes": 0,
+                          "info_items": [], "ids": [], "range": [None, None],
+                          "textlengths": {}}
 
 
     def make_xml(self, text, message):
@@ -2114,7 +5115,7 @@ class MessageParser(object):
             and self.EMOTICON_CHARS_RGX.search(body):
                 # Replace emoticons with <ss> tags if message appears to
                 # have no XML (probably in older format).
-                body = self.EMOTICON_RGX.sub(self.EMOTICON_REPL, body)
+                body = self.EMOTICON_SCANNER.sub(self.EMOTICON_REPL, body)
             dom = self.make_xml(body, message)
 
             if MESSAGES_TYPE_SMS == message["type"]:
@@ -2142,7 +5143,8 @@ class MessageParser(object):
                     body = body.encode("utf-8")
                 # Replace text emoticons with <ss>-tags if body not XML.
                 if "<" not in body and self.EMOTICON_CHARS_RGX.search(body):
-                    body = self.EMOTICON_RGX.sub(self.EMOTICON_REPL, body)
+                    body = self.EMOTICON_SCANNER.sub(self.EMOTICON_REPL,
+                                                     body)
                 status_text = " SMS"
                 status = dom.find("*/failurereason")
                 if status is not None and status.text in self.FAILURE_REASONS:
@@ -2150,30 +5152,13 @@ class MessageParser(object):
                 dom = self.make_xml("<msgstatus>%s</msgstatus>%s" %
                                     (status_text, body), message)
             elif MESSAGES_TYPE_FILE == message["type"]:
-                transfers = self.db.get_transfers()
-                files = dict((f["chatmsg_index"], f) for f in transfers
-                             if f["chatmsg_guid"] == message["guid"])
-                if not files:
-                    # No rows in Transfers, try to find data from message body
-                    # and create replacements for Transfers fields
-                    for f in dom.findall("*/file"):
-                        files[int(f.get("index"))] = {
-                            "filename": f.text, "filepath": "",
-                            "filesize": f.get("size"),
-                            "partner_handle": message["author"],
-                            "partner_dispname": message["from_dispname"],
-                            "starttime": message["timestamp"],
-                            "type": (TRANSFER_TYPE_OUTBOUND 
-                                     if message["author"] == self.db.id
-                                     else TRANSFER_TYPE_INBOUND)}
-                message["__files"] = [f for i, f in sorted(files.items())]
+                files = message["__files"] = self.get_files(message, dom)
                 dom.clear()
                 dom.text = "Sent file" + ("s " if len(files) > 1 else " ")
                 a = None
-                for i in sorted(files.keys()):
+                for f in files:
                     if len(dom) > 0:
                         a.tail = ", "
-                    f = files[i]
                     h = util.path_to_url(f["filepath"] or f["filename"])
                     a = xml.etree.cElementTree.SubElement(dom, "a", {"href": h})
                     a.text = f["filename"]
@@ -2370,6 +5355,11 @@ class MessageParser(object):
                     index += 1
                 if html.get("w", 0) <= 0:
                     continue # Skip word-wrapping if no real width given
+                if not self.dc:
+                    self.dc = wx.MemoryDC()
+                    self.dc.SetFont(wx.Font(8, wx.SWISS, wx.NORMAL, wx.NORMAL,
+                        face=conf.HistoryFontName)
+                    )
                 for name, value in [("text", elem.text), ("tail", elem.tail)]:
                     if value:
                         w = wx.lib.wordwrap.wordwrap(value, html["w"], self.dc)
@@ -2414,63 +5404,40 @@ class MessageParser(object):
         else:
             result = dom
 
-        # Collect statistics
+        # Collect statistics needing the DOM, counts are queried afterwards
         if self.stats:
-            author_stats = collections.defaultdict(lambda: 0)
-            author, m = message["author"], message
-            self.stats["last_message"] = ""
-            if m["type"] in [MESSAGES_TYPE_SMS, MESSAGES_TYPE_MESSAGE]:
-                self.collect_dom_stats(message["dom"])
-                message["body_txt"] = self.stats["last_message"]
-            if m["type"] in [MESSAGES_TYPE_SMS, MESSAGES_TYPE_CALL,
-                             MESSAGES_TYPE_FILE, MESSAGES_TYPE_MESSAGE] \
-            and author not in self.stats["counts"]:
-                self.stats["counts"][author] = author_stats.copy()
-            if MESSAGES_TYPE_SMS == m["type"]:
-                self.stats["smses"] += 1
-                self.stats["counts"][author]["smses"] += 1
-                self.stats["counts"][author]["smschars"] += \
-                    len(self.stats["last_message"])
-            elif MESSAGES_TYPE_CALL == m["type"]:
-                self.stats["calls"] += 1
-                self.stats["counts"][author]["calls"] += 1
-                if not call_durations and "__call_durations" in m:
-                    call_durations = m["__call_durations"]
-                for identity, duration in call_durations.items():
-                    if identity not in self.stats["counts"]:
-                        self.stats["counts"][identity] = author_stats.copy()
-                    self.stats["counts"][identity]["calldurations"] += duration
-                self.stats["callmaxdurations"] += \
-                    max(call_durations.values() + [0])
-            elif MESSAGES_TYPE_FILE == m["type"]:
-                files = m.get("__files")
-                if files is None:
-                    transfers = self.db.get_transfers()
-                    filedict = dict((f["chatmsg_index"], f) for f in transfers
-                                    if f["chatmsg_guid"] == m["guid"])
-                    files = [f for i, f in sorted(filedict.items)]
-                    m["__files"] = files
-                self.stats["transfers"].extend(files)
-                self.stats["counts"][author]["files"] += len(files)
-                self.stats["counts"][author]["bytes"] += \
-                    sum([int(i["filesize"]) for i in files])
-            elif MESSAGES_TYPE_MESSAGE == m["type"]:
-                self.stats["messages"] += 1
-                self.stats["counts"][author]["messages"] += 1
-                self.stats["counts"][author]["chars"] += \
-                    len(self.stats["last_message"])
-            if not self.stats["startdate"]:
-                self.stats["startdate"] = m["datetime"]
-            self.stats["enddate"] = m["datetime"]
-            self.stats["total"] += 1
+            if message["type"] in [MESSAGES_TYPE_SMS, MESSAGES_TYPE_MESSAGE]:
+                message["body_txt"] = self.collect_dom_stats(message["dom"])
+                if not self.is_plaintext(message["body_xml"]):
+                    self.stats["textlengths"][message["id"]] = \
+                        len(message["body_txt"])
+            key, bounds = (message["timestamp"], message["id"]), \
+                          self.stats["range"]
+            if not bounds[0] or key < bounds[0]:
+                bounds[0] = key
+            if not bounds[1] or key > bounds[1]:
+                bounds[1] = key
+            self.stats["ids"].append(message["id"])
 
         return result
 
 
-    def collect_dom_stats(self, dom, tails_new=None):
-        """Updates current statistics with data from the message DOM."""
+    def collect_dom_stats(self, dom, tails_new=None, texts=None,
+                          counter=None):
+        """
+        Updates current statistics with data from the message DOM, feeding
+        words to the word counter if collecting statistics.
+
+        @param   texts    list to append message text parts to, if not new
+        @param   counter  WordCounter to feed words to, if not the one in
+                          current statistics
+        @return           message text, as counted in statistics
+        """
         to_skip = {} # {element to skip: True, }
         tails_new = {} if tails_new is None else tails_new
+        texts = [] if texts is None else texts
+        if counter is None and self.stats:
+            counter = self.stats["words"]
         for elem in dom.getiterator():
             if elem in to_skip:
                 continue
@@ -2481,26 +5448,25 @@ class MessageParser(object):
             if type(tail) is str:
                 tail = tail.decode("utf-8")
             subitems = []
+            if elem.tag in ["a", "b", "quote", "quotefrom", "xml"] \
+            and (text or texts):
+                texts.append(text) # Text parts are joined with spaces
             if "quote" == elem.tag:
-                self.add_dict_text(self.stats, "cloudtext", text)
-                self.add_dict_text(self.stats, "last_message", text)
                 subitems = elem.getchildren()
-            elif "a" == elem.tag:
-                self.stats["links"].append(text)
-                self.add_dict_text(self.stats, "last_message", text)
+            elif "a" == elem.tag and counter:
+                counter.add_words([text])
             elif "ss" == elem.tag:
                 self.emoticons_unique.add(elem.get("type"))
-            elif "quotefrom" == elem.tag:
-                self.add_dict_text(self.stats, "last_message", text)
-            elif elem.tag in ["xml", "b"]:
-                self.add_dict_text(self.stats, "cloudtext", text)
-                self.add_dict_text(self.stats, "last_message", text)
+            if elem.tag in ["b", "quote", "xml"] and text and counter:
+                counter.add_text(text)
             for i in subitems:
-                self.collect_dom_stats(i, tails_new)
+                self.collect_dom_stats(i, tails_new, texts, counter)
                 to_skip[i] = True
             if tail:
-                self.add_dict_text(self.stats, "cloudtext", tail)
-                self.add_dict_text(self.stats, "last_message", tail)
+                texts.append(tail)
+                if counter:
+                    counter.add_text(tail)
+        return u" ".join(texts)
 
 
     def dom_to_text(self, dom, tails_new=None):
@@ -2532,23 +5498,99 @@ class MessageParser(object):
         return fulltext
 
 
-    def add_dict_text(self, dictionary, key, text, inter=" "):
-        """Adds text to an entry in the dictionary."""
-        dictionary[key] += (inter if dictionary[key] else "") + text
+    def is_plaintext(self, body):
+        """Returns whether message text is the same as the raw body."""
+        return not body or not self.PLAINTEXT_CHECK_RGX.search(body) \
+               and not (self.EMOTICON_CHARS_RGX.search(body)
+                        and self.EMOTICON_SCANNER.contains(body))
+
+
+    def get_text_length(self, body, type):
+        """
+        Returns the length of message text as counted in statistics, parsing
+        the body only if the text may differ from the raw body. Used for SQL
+        function MESSAGE_TEXT_LENGTH(id, body_xml, type).
+        """
+        if not body:
+            return 0
+        if isinstance(body, str):
+            body = body.decode("utf-8", "replace")
+        if self.is_plaintext(body):
+            return len(body)
+        message = dict((k, None) for k in MESSAGE_FIELDS_PARSE)
+        message.update(body_xml=body, type=type)
+        return len(self.collect_dom_stats(self.parse(message)))
+
+
+    def count_words(self, body, type, counter):
+        """
+        Feeds the words of message text to the word counter, as counted in
+        statistics, parsing the body only if the text may differ from the
+        raw body.
+        """
+        if not body:
+            return
+        if isinstance(body, str):
+            body = body.decode("utf-8", "replace")
+        if self.is_plaintext(body):
+            return counter.add_text(body)
+        message = dict((k, None) for k in MESSAGE_FIELDS_PARSE)
+        message.update(body_xml=body, type=type)
+        self.collect_dom_stats(self.parse(message), counter=counter)
+
+
+    def get_files(self, message, dom=None):
+        """
+        Returns the files sent in the message, from Transfers or from the
+        message body if not in Transfers, ordered by file index.
+
+        @param   dom  message body DOM, parsed from message if not given
+        """
+        transfers = self.db.get_indexed_rows(
+            "transfers", "chatmsg_guid", message["guid"])
+        files = dict((f["chatmsg_index"], f) for f in transfers)
+        if not files:
+            # No rows in Transfers, try to find data from message body
+            # and create replacements for Transfers fields
+            if dom is None:
+                body = message["body_xml"] or ""
+                for entity, value in self.REPLACE_ENTITIES.items():
+                    body = body.replace(entity, value)
+                dom = self.make_xml(body.encode("utf-8"), message)
+            for f in dom.findall("*/file"):
+                files[int(f.get("index"))] = {
+                    "filename": f.text, "filepath": "",
+                    "filesize": f.get("size"),
+                    "partner_handle": message["author"],
+                    "partner_dispname": message["from_dispname"],
+                    "starttime": message["timestamp"],
+                    "type": (TRANSFER_TYPE_OUTBOUND 
+                             if message["author"] == self.db.id
+                             else TRANSFER_TYPE_INBOUND)}
+        return [f for i, f in sorted(files.items())]
 
 
     def get_collected_stats(self):
         """
-        Returns the statistics collected during message parsing.
+        Returns the statistics collected during message parsing, with counts
+        queried from the database for the parsed messages: over the range of
+        parsed messages if it has no others, or by message IDs otherwise.
 
         @return  dict with statistics entries, or empty dict if not collecting
         """
         if not self.stats:
             return {}
         stats = self.stats
-        for k in ["chars", "smschars", "files", "bytes", "calls",
-                  "calldurations"]:
-            stats[k] = sum(i[k] for i in stats["counts"].values())
+        if stats["ids"]:
+            counts, ids = None, set(stats["ids"])
+            lengths = stats["textlengths"]
+            if self.chat and None not in stats["range"][0]:
+                counts = self.db.get_chat_statistics(self.chat,
+                    *stats["range"], text_lengths=lengths)
+            if not counts or counts["total"] != len(ids):
+                counts = self.db.get_chat_statistics(self.chat,
+                    message_ids=ids, text_lengths=lengths)
+            stats.update(counts)
 
         del stats["info_items"][:]
         delta_date = None
@@ -2591,7 +5633,7 @@ class MessageParser(object):
                 per_day = "%.1f" % per_day
             stats["info_items"].append(("Messages per day", per_day))
 
-        cloud = wordcloud.get_cloud(stats["cloudtext"], stats["links"])
+        cloud = wordcloud.get_cloud(stats["words"])
         stats["wordcloud"] = cloud
         return stats
 
@@ -2613,6 +5655,21 @@ def is_sqlite_file(filename, path=None):
     return result
 
 
+def is_uri_supported():
+    """
+    Returns whether SQLite opens URI filenames like "file:x?mode=ro", which
+    needs SQLite 3.7.7+ compiled with SQLITE_USE_URI, as Python 2 sqlite3
+    does not pass the URI flag itself.
+    """
+    result = False
+    if sqlite3.sqlite_version_info >= (3, 7, 7):
+        connection = sqlite3.connect(":memory:")
+        options = connection.execute("PRAGMA compile_options").fetchall()
+        connection.close()
+        result = any(re.match("USE_URI(=1)?$", x[0]) for x in options)
+    return result
+
+
 def detect_databases():
     """
     Tries to detect Skype database files on the current computer, looking
@@ -2668,6 +5725,26 @@ def find_databases(folder):
             yield os.path.join(root, f)
 
 
+def merge_activity_statistics(stats, partial):
+    """
+    Merges partial activity statistics into cumulative statistics, both as
+    returned from SkypeDatabase.get_activity_statistics().
+
+    @return  the updated cumulative statistics
+    """
+    stats["messages"] += partial["messages"]
+    stats["chats"] += partial["chats"]
+    for key in ["authors", "days"]:
+        for k, v in partial[key].items():
+            stats[key][k] = stats[key].get(k, 0) + v
+    stats["hours"] = [a + b for a, b in zip(stats["hours"], partial["hours"])]
+    for key, choose in [("first", min), ("last", max)]:
+        items = filter(None, [stats[key], partial[key]])
+        stats[key] = choose(items, key=lambda x: x["timestamp"]) \
+                     if items else None
+    return stats
+
+
 def import_contacts_file(filename):
     """
     Returns the contacts found in the specified CSV file,
@@ -2719,7 +5796,8 @@ def get_avatar(datadict, size=None, keep_aspect_ratio=True):
     """
     Returns a wx.Bitmap for the contact/account avatar, if any.
 
-    @param   datadict           row from Contacts or Accounts
+    @param   datadict           row from Contacts or Accounts, with BLOBs
+                                possibly retrieved on access
     @param   size               (width, height) to resize image to, if any
     @param   keep_aspect_ratio  if True, keeps image aspect ratio is on
                                 resizing, filling the outside in white
@@ -2753,7 +5831,8 @@ def get_avatar_jpg(datadict, max_size=None, keep_aspect_ratio=True):
     """
     Returns the JPG data of the contact/account avatar image, if any.
 
-    @param   datadict           row from Contacts or Accounts
+    @param   datadict           row from Contacts or Accounts, with BLOBs
+                                possibly retrieved on access
     @param   max_size           (width, height) to resize larger image down to,
                                 if any
     @param   keep_aspect_ratio  if True, keeps image aspect ratio is on
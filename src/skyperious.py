@@ -70,6 +70,8 @@ import workers
 WorkerEvent, EVT_WORKER = wx.lib.newevent.NewEvent()
 ContactWorkerEvent, EVT_CONTACT_WORKER = wx.lib.newevent.NewEvent()
 DetectionWorkerEvent, EVT_DETECTION_WORKER = wx.lib.newevent.NewEvent()
+CountWorkerEvent, EVT_COUNT_WORKER = wx.lib.newevent.NewEvent()
+StatisticsWorkerEvent, EVT_STATISTICS_WORKER = wx.lib.newevent.NewEvent()
 OpenDatabaseEvent, EVT_OPEN_DATABASE = wx.lib.newevent.NewEvent()
 
 
@@ -1075,7 +1077,9 @@ class MainWindow(guibase.TemplateFrameMixIn, wx.Frame):
         """Opens the database and updates main page UI with database info."""
         db = None
         try:
-            db = self.dbs.get(filename) or skypedata.SkypeDatabase(filename)
+            # Read once for the preview, without locking out a running Skype
+            db = self.dbs.get(filename) or \
+                 skypedata.SkypeDatabase(filename, immutable=True)
         except Exception, e:
             self.label_account.Value = "(database not readable)"
             self.label_messages.Value = "Error text: %s" % e
@@ -1261,6 +1265,9 @@ class MainWindow(guibase.TemplateFrameMixIn, wx.Frame):
                 del conf.LastActivePage[page.db.filename]
 
             [i.stop() for i in page.workers_search.values()]
+            page.worker_counts.stop()
+            page.worker_prefetch.stop()
+            page.worker_statistics.stop()
             page.save_page_conf()
 
             if page in self.db_pages:
@@ -1355,8 +1362,12 @@ class MainWindow(guibase.TemplateFrameMixIn, wx.Frame):
         if not db:
             db = None
             if os.path.exists(filename):
+                # Files on read-only media can only be opened read-only
+                read_only = conf.DBOpenReadOnly \
+                            or not os.access(filename, os.W_OK)
                 try:
-                    db = skypedata.SkypeDatabase(filename)
+                    db = skypedata.SkypeDatabase(filename,
+                                                 read_only=read_only)
                 except:
                     is_accessible = False
                     try:
@@ -1374,7 +1385,8 @@ class MainWindow(guibase.TemplateFrameMixIn, wx.Frame):
                         if wx.OK == response:
                             self.skype_handler.shutdown()
                             try_result, db = util.try_until(lambda:
-                                skypedata.SkypeDatabase(filename, False))
+                                skypedata.SkypeDatabase(filename, False,
+                                                        read_only))
                             if not try_result:
                                 wx.MessageBox(
                                     "Still could not open %s." % filename,
@@ -1390,9 +1402,12 @@ class MainWindow(guibase.TemplateFrameMixIn, wx.Frame):
                             "Not a valid SQLITE database?" % filename,
                             conf.Title, wx.OK | wx.ICON_WARNING)
                 if db:
-                    main.log("Opened %s (%s).", db, util.format_bytes(
-                             db.filesize))
+                    main.log("Opened %s (%s%s).", db, util.format_bytes(
+                             db.filesize), ", read-only" if read_only else "")
                     main.status_flash("Reading Skype database file %s.", db)
+                    if conf.DBSidecarEnabled:
+                        db.open_sidecar()
+                    db.load_metadata()
                     self.dbs[filename] = db
                     # Add filename to Recent Files menu and conf, if needed
                     if filename in conf.RecentFiles:
@@ -1402,7 +1417,8 @@ class MainWindow(guibase.TemplateFrameMixIn, wx.Frame):
                     util.add_unique(conf.RecentFiles, filename, -1,
                                     conf.MaxRecentFiles)
                     conf.save()
-                    self.check_future_dates(db)
+                    if not db.read_only:
+                        self.check_future_dates(db)
             else:
                 wx.MessageBox("Nonexistent file: %s." % filename,
                               conf.Title, wx.OK | wx.ICON_WARNING)
@@ -1513,6 +1529,13 @@ class DatabasePage(wx.Panel):
         self.worker_search_contacts = \
             workers.ContactSearchThread(self.on_search_contacts_callback)
         self.search_data_contact = {"id": None} # Current contacts search data
+        self.Bind(EVT_COUNT_WORKER, self.on_count_tables_result)
+        self.worker_counts = \
+            workers.RowCountThread(self.on_count_tables_callback)
+        self.worker_prefetch = workers.PrefetchThread(None)
+        self.Bind(EVT_STATISTICS_WORKER, self.on_statistics_result)
+        self.worker_statistics = \
+            workers.StatisticsThread(self.on_statistics_callback)
 
         sizer = self.Sizer = wx.BoxSizer(wx.VERTICAL)
 
@@ -1596,6 +1619,8 @@ class DatabasePage(wx.Panel):
         self.TopLevelParent.console.run(
             "page = self.page_db_latest # Database tab")
         self.TopLevelParent.console.run("db = page.db # Skype database")
+        self.TopLevelParent.console.run(
+            "# db.profiler.enabled = True; print db.profiler.report()")
 
         self.Layout()
         self.toggle_filter(True)
@@ -1945,6 +1970,7 @@ class DatabasePage(wx.Panel):
         grid.Bind(wx.grid.EVT_GRID_LABEL_RIGHT_CLICK,
                   self.on_filter_grid_column)
         grid.Bind(wx.grid.EVT_GRID_CELL_CHANGE, self.on_change_table)
+        grid.EnableEditing(not self.db.read_only)
         label_help = wx.StaticText(panel2, wx.NewId(),
             "Double-click on column header to sort, right click to filter.")
         label_help.ForegroundColour = "grey"
@@ -2055,6 +2081,8 @@ class DatabasePage(wx.Panel):
         button_import = self.button_import_file = \
             wx.Button(panel1, label="Se&lect contacts file")
         button_import.Bind(wx.EVT_BUTTON, self.on_choose_import_file)
+        # Skype would write imported contacts into this database
+        button_import.Enabled = not self.db.read_only
         sizer_header.Add(button_import, border=10,
                          flag=wx.RIGHT | wx.ALIGN_CENTER_VERTICAL)
         sizer_header.Add(label_header, border=60, flag=wx.LEFT)
@@ -2200,13 +2228,19 @@ class DatabasePage(wx.Panel):
 
         names = ["edit_info_chats", "edit_info_contacts",
                  "edit_info_transfers", "edit_info_messages",
-                 "edit_info_lastmessage", "edit_info_firstmessage", "",
+                 "edit_info_lastmessage", "edit_info_firstmessage",
+                 "edit_info_hours", "edit_info_days", "edit_info_authors", "",
                  "edit_info_path", "edit_info_size", "edit_info_modified",
                  "edit_info_sha1", "edit_info_md5", ]
         labels = ["Conversations", "Contacts", "File transfers", "Messages",
-                  "Last message", "First message", "", 
+                  "Last message", "First message", "Messages by hour",
+                  "Messages by month", "Most active", "",
                   "Full path", "File size", "Last modified",
                   "SHA-1 checksum", "MD5 checksum",  ]
+        if conf.DBTermIndexEnabled:
+            names.insert(names.index("edit_info_authors") + 1,
+                         "edit_info_words")
+            labels.insert(labels.index("Most active") + 1, "Common words")
         for name, label in zip(names, labels):
             if not name and not label:
                 sizer_file.AddSpacer(20), sizer_file.AddSpacer(20)
@@ -2421,20 +2455,19 @@ class DatabasePage(wx.Panel):
             self.db.update_accountinfo()
             self.update_accountinfo()
         for name in ["chats", "contacts", "messages", "transfers",
-        "lastmessage", "firstmessage", "size", "modified", "sha1", "md5"]:
-            getattr(self, "edit_info_%s" % name).Value = ""
+        "lastmessage", "firstmessage", "hours", "days", "authors", "words",
+        "size", "modified", "sha1", "md5"]:
+            if hasattr(self, "edit_info_%s" % name):
+                getattr(self, "edit_info_%s" % name).Value = ""
         stats = {}
         try:
-            stats = self.db.get_general_statistics()
+            stats = self.db.get_general_statistics(full=False)
         except: pass
         if stats:
             self.edit_info_chats.Value = "%(chats)s" % stats
             self.edit_info_contacts.Value = "%(contacts)s" % stats
             self.edit_info_messages.Value = "%(messages)s" % stats
             self.edit_info_transfers.Value = "%(transfers)s" % stats
-        if "messages_from" in stats:
-            self.edit_info_messages.Value += " (%s sent and %s received)" % \
-                (stats.get("messages_from"), stats.get("messages_to"))
         text = ""
         if "lastmessage_dt" in stats:
             text = "%(lastmessage_dt)s %(lastmessage_from)s" % stats
@@ -2442,13 +2475,14 @@ class DatabasePage(wx.Panel):
         or skypedata.CHATS_TYPE_SINGLE != stats.get("lastmessage_chattype")):
             text += " in %(lastmessage_chat)s" % stats
         self.edit_info_lastmessage.Value = text
-        text = ""
-        if "firstmessage_dt" in stats:
-            text = "%(firstmessage_dt)s %(firstmessage_from)s" % stats
-        if stats and (stats.get("firstmessage_skypename") == self.db.id
-        or skypedata.CHATS_TYPE_SINGLE != stats.get("firstmessage_chattype")):
-            text += " in %(firstmessage_chat)s" % stats
-        self.edit_info_firstmessage.Value = text
+        activity = self.db.get_metadata("activity")
+        if activity:
+            self.update_info_activity(activity)
+        elif "messages" in self.db.tables:
+            for name in ["firstmessage", "hours", "days", "authors", "words"]:
+                if hasattr(self, "edit_info_%s" % name):
+                    getattr(self, "edit_info_%s" % name).Value = "Analyzing.."
+            self.worker_statistics.work({"db": self.db})
 
         self.edit_info_size.Value = "%s (%s)" % \
             (util.format_bytes(self.db.filesize),
@@ -2471,6 +2505,60 @@ class DatabasePage(wx.Panel):
         self.button_refresh_fileinfo.Enabled = True
 
 
+    def update_info_activity(self, stats):
+        """
+        Updates the Information page with message activity statistics,
+        as collected by workers.StatisticsThread.
+        """
+        # Keep the total count of all messages, add the split of analyzed ones
+        total = self.edit_info_messages.Value.split(" (")[0]
+        sent = stats["authors"].get(self.db.id, 0)
+        self.edit_info_messages.Value = "%s (%s sent and %s received)" % \
+            (total or stats["messages"], sent, stats["messages"] - sent)
+        text, first = "", stats["first"]
+        if first:
+            dt = datetime.datetime.fromtimestamp(first["timestamp"])
+            text = "%s %s" % (dt.strftime("%Y-%m-%d %H:%M"),
+                              first["from_dispname"])
+            if first["author"] == self.db.id \
+            or skypedata.CHATS_TYPE_SINGLE != first["chat_type"]:
+                text += (" in \"%s\""
+                         if skypedata.CHATS_TYPE_SINGLE != first["chat_type"]
+                         else " in chat with %s") % first["chat_title"]
+        self.edit_info_firstmessage.Value = text
+
+        hours, text = stats["hours"], ""
+        if any(hours):
+            text = u"%s  busiest at %02d:00" % \
+                   (util.plot_sparkline(hours), hours.index(max(hours)))
+        self.edit_info_hours.Value = text
+        text = ""
+        if stats["days"]:
+            months = collections.defaultdict(int) # {"YYYY-MM": count}
+            for day, count in stats["days"].items():
+                months[day[:7]] += count
+            year, month = map(int, min(months).split("-"))
+            values = [] # Message counts for each month, empty ones included
+            while "%04d-%02d" % (year, month) <= max(months):
+                values.append(months.get("%04d-%02d" % (year, month), 0))
+                year, month = (year + 1, 1) if 12 == month else (year,
+                                                                 month + 1)
+            busiest = max(stats["days"], key=stats["days"].get)
+            text = u"%s  %s active days, busiest %s (%s messages)" % (
+                   util.plot_sparkline(values), len(stats["days"]), busiest,
+                   stats["days"][busiest])
+        self.edit_info_days.Value = text
+        authors = sorted(stats["authors"].items(), key=lambda x: -x[1])[:5]
+        self.edit_info_authors.Value = ", ".join("%s (%s)" % (
+            self.db.get_contact_name(a) if a else "", c) for a, c in authors)
+        if stats["chats"] < stats.get("chats_total", stats["chats"]):
+            self.edit_info_authors.Value += " .. analyzed %s of %s chats." % \
+                (stats["chats"], stats["chats_total"])
+        if hasattr(self, "edit_info_words"):
+            self.edit_info_words.Value = ", ".join("%s (%s)" % (w, c)
+                for w, c in stats.get("words", [])[:20])
+
+
     def on_choose_import_file(self, event):
         """Handler for clicking to choose a CSV file for contact import."""
         contacts = None
@@ -3172,6 +3260,66 @@ class DatabasePage(wx.Panel):
             wx.CallAfter(support.report_error, errormsg)
 
 
+    def update_table_rowcounts(self, tables):
+        """
+        Shows table row counts in the tables list, estimated counts marked
+        with "~", and starts counting exact rows for estimated tables.
+
+        @param   tables  [{"name": "tablename", "rows": int,
+                           "rows_estimated": bool}, ]
+        """
+        tablemap = dict((t["name"].lower(), t) for t in tables)
+        item = self.tree_tables.GetNext(self.tree_tables.RootItem)
+        while item and item.IsOk():
+            name = self.tree_tables.GetItemPyData(item)
+            table = tablemap.get(name.lower()) if name else None
+            if table:
+                self.tree_tables.SetItemText(item, "%s%d row%s" % (
+                    "~" if table.get("rows_estimated") else "", table["rows"],
+                    "s" if table["rows"] != 1 else " "
+                ), 1)
+            item = self.tree_tables.GetNextSibling(item)
+        estimated = [t["name"] for t in tables if t.get("rows_estimated")]
+        if estimated:
+            self.worker_counts.work({"db": self.db, "tables": estimated})
+
+
+    def on_count_tables_result(self, event):
+        """
+        Handler for getting exact table row counts from the count thread,
+        updates the tables list.
+        """
+        result = event.result
+        if self and result["db"] is self.db:
+            tables = self.db.get_tables()
+            self.update_table_rowcounts([t for t in tables
+                                         if t["name"] in result["counts"]])
+
+
+    def on_statistics_result(self, event):
+        """
+        Handler for getting activity statistics from the statistics thread,
+        updates the Information page.
+        """
+        result = event.result
+        if self and result["db"] is self.db:
+            self.update_info_activity(result["stats"])
+            if result.get("complete"):
+                self.db.set_metadata("activity", result["stats"])
+
+
+    def on_statistics_callback(self, result):
+        """Callback function for StatisticsThread, posts the data to self."""
+        if self: # Check if instance is still valid (i.e. not destroyed by wx)
+            wx.PostEvent(self, StatisticsWorkerEvent(result=result))
+
+
+    def on_count_tables_callback(self, result):
+        """Callback function for RowCountThread, posts the data to self."""
+        if self: # Check if instance is still valid (i.e. not destroyed by wx)
+            wx.PostEvent(self, CountWorkerEvent(result=result))
+
+
     def on_searchall_callback(self, result):
         """Callback function for SearchThread, posts the data to self."""
         if self: # Check if instance is still valid (i.e. not destroyed by wx)
@@ -3519,6 +3667,9 @@ class DatabasePage(wx.Panel):
         """Executes the SQL query and populates the SQL grid with results."""
         try:
             grid_data = None
+            if isinstance(self.grid_sql.Table, skypedata.TableBase):
+                # Stop retrieving rows of the previous query
+                self.grid_sql.Table.Close()
             if sql.lower().startswith(("select", "pragma", "explain")):
                 # SELECT statement: populate grid with rows
                 grid_data = self.db.execute_select(sql)
@@ -3594,15 +3745,11 @@ class DatabasePage(wx.Panel):
             self.grid_table.Table.SaveChanges()
             self.on_change_table(None)
             # Refresh tables list with updated row counts
-            tablemap = dict((t["name"], t) for t in self.db.get_tables(True))
+            self.update_table_rowcounts(self.db.get_tables(True))
             item = self.tree_tables.GetNext(self.tree_tables.RootItem)
             while item and item.IsOk():
                 table = self.tree_tables.GetItemPyData(item)
                 if table:
-                    self.tree_tables.SetItemText(item, "%d row%s" % (
-                        tablemap[table]["rows"],
-                        "s" if tablemap[table]["rows"] != 1 else " "
-                    ), 1)
                     if table == self.grid_table.Table.table:
                         self.tree_tables.SetItemTextColour(
                             item,
@@ -3683,8 +3830,8 @@ class DatabasePage(wx.Panel):
             col_range = range(grid_data.GetNumberCols())
             map(self.grid_table.AutoSizeColLabelSize, col_range)
             self.on_change_table(None)
-            self.tb_grid.EnableTool(wx.ID_ADD, True)
-            self.tb_grid.EnableTool(wx.ID_DELETE, True)
+            self.tb_grid.EnableTool(wx.ID_ADD, not self.db.read_only)
+            self.tb_grid.EnableTool(wx.ID_DELETE, not self.db.read_only)
             self.button_export_table.Enabled = True
             self.button_reset_grid_table.Enabled = True
 
@@ -3703,6 +3850,7 @@ class DatabasePage(wx.Panel):
         """Loads history of the specified chat (as returned from db)."""
         if chat and (chat != self.chat or center_message_id):
             busy = None
+            self.worker_prefetch.stop_work(drop_results=True)
             if chat != self.chat:
                 # Update chat list colours and scroll to the opened chat
                 self.list_chats.Freeze()
@@ -3822,6 +3970,37 @@ class DatabasePage(wx.Panel):
             self.populate_chat_statistics()
             if self.html_stats.Shown:
                 self.show_stats(True) # To restore scroll position
+            self.prefetch_chats()
+
+
+    def prefetch_chats(self):
+        """
+        Starts loading messages in the background for chats next to the
+        opened chat in the chats list, and for the most recently active chats.
+        """
+        chats, index_opened = [], -1
+        chat_id = self.chat["id"] if self.chat else None
+        for i in range(self.list_chats.ItemCount):
+            if self.list_chats.GetItemMappedData(i)["id"] == chat_id:
+                index_opened = i
+                break # break for i in range(self.list_chats..)
+        if index_opened >= 0:
+            for delta in range(1, conf.ChatPrefetchNeighbours + 1):
+                for i in [index_opened + delta, index_opened - delta]:
+                    if 0 <= i < self.list_chats.ItemCount:
+                        chats.append(self.list_chats.GetItemMappedData(i))
+        recents = sorted((c for c in self.chats or []
+                          if c["last_message_datetime"]),
+                         key=lambda c: c["last_message_datetime"],
+                         reverse=True)
+        chats.extend(recents[:conf.ChatPrefetchRecent])
+        unique, ids = [], set([chat_id])
+        for chat in chats:
+            if chat["id"] not in ids:
+                unique.append(chat)
+                ids.add(chat["id"])
+        if unique:
+            self.worker_prefetch.work({"db": self.db, "chats": unique})
 
 
     def populate_chat_statistics(self):
@@ -3974,9 +4153,6 @@ class DatabasePage(wx.Panel):
             child = None
             for table in tables:
                 child = self.tree_tables.AppendItem(root, table["name"])
-                self.tree_tables.SetItemText(child, "%d row%s" % (
-                    table["rows"], "s" if table["rows"] != 1 else " "
-                ), 1)
                 self.tree_tables.SetItemPyData(child, table["name"])
 
                 for col in self.db.get_table_columns(table["name"]):
@@ -3991,6 +4167,7 @@ class DatabasePage(wx.Panel):
                     self.tree_tables.Size.width -
                     self.tree_tables.GetColumnWidth(0) - 5))
                 self.tree_tables.Collapse(child)
+            self.update_table_rowcounts(tables)
 
 
             # Add table and column names to SQL editor autocomplete
@@ -4003,7 +4180,7 @@ class DatabasePage(wx.Panel):
             # Load chat statistics and update the chat list
             self.db.get_conversations_stats(self.chats)
             for c in self.chats:
-                people = sorted([p["identity"] for p in c["participants"]])
+                people = sorted((c["participant_identities"] or "").split())
                 if skypedata.CHATS_TYPE_SINGLE != c["type"]:
                     c["people"] = "%s (%s)" % (len(people), ", ".join(people))
                 else:
@@ -4634,6 +4811,8 @@ class MergerPage(wx.Panel):
             db_target, db_source = self.db1, self.db2
             list_source = self.list_contacts2
             source = 1
+        if not self.check_writable(db_target):
+            return
         button_all = [
             self.button_merge_allcontacts1, self.button_merge_allcontacts2
         ][source]
@@ -4805,6 +4984,18 @@ class MergerPage(wx.Panel):
             wx.Bell()
 
 
+    def check_writable(self, db):
+        """
+        Returns whether data can be merged into the database, showing a
+        warning if the database is opened in read-only mode.
+        """
+        if db.read_only:
+            wx.MessageBox("Cannot merge into %s: database is opened in "
+                          "read-only mode." % db, conf.Title,
+                          wx.OK | wx.ICON_WARNING)
+        return not db.read_only
+
+
     def on_merge_all(self, event):
         """
         Handler for clicking to copy all the differences to the other
@@ -4813,6 +5004,8 @@ class MergerPage(wx.Panel):
         source = 0 if event.EventObject == self.button_mergeall1 else 1
         db1 = [self.db1, self.db2][source]
         db2 = [self.db1, self.db2][1 - source]
+        if not self.check_writable(db2):
+            return
         chats  = self.chats_differing[source]
         contacts = [self.con1diff, self.con2diff][source]
         contactgroups = [self.congroup1diff, self.congroup2diff][source]
@@ -4945,6 +5138,8 @@ class MergerPage(wx.Panel):
         source = 0 if (self.button_merge_chat_1 == event.EventObject) else 1
         db1 = [self.db1, self.db2][source]
         db2 = [self.db1, self.db2][1 - source]
+        if not self.check_writable(db2):
+            return
         chats_differing = self.chats_differing[source] \
                           if self.chats_differing else []
         chat  = [self.chat_diff["c1"], self.chat_diff["c2"]][source]
@@ -5115,7 +5310,7 @@ class MergerPage(wx.Panel):
                     )
                 if identical:
                     c["diff_status"] = self.DIFFSTATUS_IDENTICAL
-                people = sorted([p["identity"] for p in c["participants"]])
+                people = sorted((c["participant_identities"] or "").split())
                 if skypedata.CHATS_TYPE_SINGLE != c["type"]:
                     c["people"] = "%s (%s)" % (len(people), ", ".join(people))
                 else:
@@ -5413,36 +5608,26 @@ class ChatContentSTC(controls.SearchableStyledTextCtrl):
             # If date filtering was just applied, check if we need to
             # retrieve more messages from earlier (messages are retrieved
             # starting from latest).
-            if not self._messages[0]["datetime"] \
+            while not self._messages[0]["datetime"] \
             or self._messages[0]["datetime"].date() \
             >= self._filter["daterange"][0]:
-                m_iter = self._db.get_messages(self._chat,
-                    ascending=False,
-                    timestamp_from=self._messages[0]["timestamp"]
+                first = self._messages[0]
+                messages = self._db.get_messages_page(self._chat,
+                    before=(first["timestamp"], first["id"]),
+                    limit=conf.MaxHistoryInitialMessages
                 )
-                while m_iter:
-                    try:
-                        m = m_iter.next()
-                        self._messages.appendleft(m)
-                        if m["datetime"].date() < self._filter["daterange"][0]:
-                            m_iter = None
-                    except StopIteration, e:
-                        m_iter = None
+                if not messages:
+                    break # break while not self._messages[0]["datetime"]..
+                self._messages.extendleft(reversed(messages))
         last_dt = self._chat.get("last_message_datetime")
         if self._messages and last_dt \
         and self._messages[-1]["datetime"] < last_dt:
             # Last message timestamp is earlier than chat's last message
             # timestamp: new messages have arrived
-            m_iter = self._db.get_messages(self._chat,
-                ascending=True, use_cache=False,
-                timestamp_from=self._messages[-1]["timestamp"]
-            )
-            while m_iter:
-                try:
-                    m = m_iter.next()
-                    self._messages.append(m)
-                except StopIteration, e:
-                    m_iter = None
+            last = self._messages[-1]
+            self._messages.extend(self._db.get_messages_page(self._chat,
+                after=(last["timestamp"], last["id"])
+            ))
 
 
     def RefreshMessages(self, center_message_id=None):
@@ -5748,34 +5933,24 @@ class ChatContentSTC(controls.SearchableStyledTextCtrl):
         if messages is not None:
             message_range = collections.deque(messages)
         else:
-            m_iter = db.get_messages(chat, ascending=False)
-
-            i = 0
-            message_range = collections.deque()
-            try:
-                iterate = (i < message_show_limit)
-                while iterate:
-                    m = m_iter.next()
-                    if m:
-                        i += 1
-                        message_range.appendleft(m)
-                        if m["id"] == center_message_id:
-                            self._center_message_index = len(message_range)
-                            self._center_message_id = center_message_id
-                    else:
-                        break # break while iterate
-                    if center_message_id:
-                        iterate = (self._center_message_index < 0) or (
-                            len(message_range) < self._center_message_index \
-                                + message_show_limit / 2
-                        )
-                    else:
-                        iterate = (i < message_show_limit)
-            except StopIteration:
-                m_iter = None
-            if self._center_message_index >= 0:
-                self._center_message_index = \
-                    len(message_range) - self._center_message_index
+            center = None
+            if center_message_id:
+                center = next(db.get_messages(chat, use_cache=False,
+                    additional_sql="m.id = :id",
+                    additional_params={"id": center_message_id}), None)
+            if center:
+                # All messages after the centered one, and half the limit
+                # before it
+                key = (center["timestamp"], center["id"])
+                message_range = collections.deque(db.get_messages_page(chat,
+                    before=key, limit=message_show_limit / 2))
+                self._center_message_index = len(message_range)
+                self._center_message_id = center_message_id
+                message_range.append(center)
+                message_range.extend(db.get_messages_page(chat, after=key))
+            else:
+                message_range = collections.deque(db.get_messages_page(chat,
+                    limit=message_show_limit))
 
         self._chat = chat
         self._db = db
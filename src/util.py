@@ -269,6 +269,17 @@ def round_float(value, precision=1):
     return result
 
 
+def plot_sparkline(values):
+    """
+    Returns the numeric values as a line of Unicode block characters, scaled
+    from the lowest block for zero to the highest block for the maximum.
+    """
+    blocks = u"\u2581\u2582\u2583\u2584\u2585\u2586\u2587\u2588"
+    top = float(max(values or [0])) or 1
+    return u"".join(blocks[int(round(v / top * (len(blocks) - 1)))]
+                    for v in values)
+
+
 def divide_delta(td1, td2):
     """Divides two timedeltas and returns the integer result."""
     us1 = td1.microseconds + 1000000 * (td1.seconds + 86400 * td1.days)
@@ -13,7 +13,9 @@ Released under the MIT License.
 ------------------------------------------------------------------------------
 """
 import collections
+import heapq
 import re
+import sys
 
 import conf
 
@@ -29,6 +31,15 @@ COUNT_MIN = 2
 """Minimum length for words to be included."""
 LENGTH_MIN = 2
 
+"""
+Maximum number of distinct words kept in a WordCounter, the rarest words are
+pruned beyond that.
+"""
+COUNTER_MAX = 10000
+
+"""Regex for finding words in text."""
+WORD_RGX = re.compile("\w{%s,}" % LENGTH_MIN, re.UNICODE)
+
 """Minimum font size for words (for wx.html.HtmlWindow)."""
 FONTSIZE_MIN = 0
 
@@ -150,6 +161,66 @@ COMMON_WORDS = {
     """
 }
 
+"""Common words of each language, as {language: frozenset(words)}."""
+COMMON_WORDS_SETS = dict((k, frozenset(re.findall("\w+", v, re.UNICODE)))
+                         for k, v in COMMON_WORDS.items())
+
+
+
+class WordCounter(object):
+    """
+    Incremental word frequency counter for word clouds, fed text as it comes,
+    so that the full text is never kept. Memory is bounded by pruning the
+    rarest words whenever distinct words exceed the limit.
+    """
+
+    def __init__(self, limit=COUNTER_MAX):
+        """
+        @param   limit  maximum number of distinct words to keep
+        """
+        self.limit = limit
+        self.counts = collections.defaultdict(lambda: 0) # {word: count}
+
+
+    def add_text(self, text):
+        """Counts the words in the text."""
+        self.add_words(WORD_RGX.findall(text.lower()))
+
+
+    def add_words(self, words):
+        """Counts the words as given."""
+        counts = self.counts
+        for word in words:
+            counts[word] += 1
+        if len(counts) > self.limit:
+            self.prune()
+
+
+    def merge(self, *others):
+        """
+        Adds the word counts of other counters, like partial counters of
+        several chats, without needing the texts again.
+
+        @param   others  WordCounter instances or {word: count} dictionaries
+        @return          self
+        """
+        counts = self.counts
+        for other in others:
+            other = getattr(other, "counts", other)
+            for word, count in other.iteritems():
+                counts[word] += count
+        if len(counts) > self.limit:
+            self.prune()
+        return self
+
+
+    def prune(self):
+        """Drops the rarest words, keeping the most frequent half of limit."""
+        keep = heapq.nlargest(self.limit / 2, self.counts.iteritems(),
+                              key=lambda x: x[1])
+        self.counts.clear()
+        self.counts.update(keep)
+
 
 
 def get_cloud(text, additions=None):
@@ -158,32 +229,38 @@ def get_cloud(text, additions=None):
     autodetected from among English (default), Estonian and Russian, and
     pre-defined common words (like 'at') are removed.
 
-    @param   text       text to analyze
+    @param   text       text to analyze, or a WordCounter with words counted,
+                        or a list of WordCounters to merge
     @param   additions  a pre-parsed list of additional words to add
     @return             in descending order of relevance, as
                         [('word', count, font size), ]
     """
     result = []
-    words = re.findall("\w{%s,}" % LENGTH_MIN, text.lower(), re.UNICODE) \
-            + (additions or [])
-    import main
-    commons = dict((i, i) for i in get_common_words(words))
-    cloud = collections.defaultdict(lambda: 0)
-    # Add and count all non-common words
-    for i in filter(lambda x: x not in commons, words):
-        cloud[i] += 1
+    counters = text if isinstance(text, list) else [text]
+    if not all(isinstance(x, WordCounter) for x in counters):
+        counter = WordCounter(limit=sys.maxint)
+        counter.add_text(text)
+        counters = [counter]
+    words = counters[0].counts
+    if len(counters) > 1 or additions:
+        words = WordCounter(limit=sys.maxint).merge(*counters).counts
+        for word in additions or []:
+            words[word] += 1
+    commons = get_common_words(words)
+    # Take all non-common words
+    cloud = [(w, c) for w, c in words.iteritems() if w not in commons]
     # Drop rare words and limit the number of words
     count_last = COUNT_MIN
     if len(cloud) > WORDS_MAX:
-        count_last = max(count_last, sorted(cloud.values())[WORDS_MAX - 1])
-    cloud = dict((i, cloud[i]) for i in cloud if cloud[i] >= count_last)
-    count_min = min(cloud.values()) if cloud else -1
-    count_max = max(cloud.values()) if cloud else -1
-    for word, count in cloud.items():
+        count_last = max(count_last, heapq.nsmallest(WORDS_MAX,
+                         (c for w, c in cloud))[-1])
+    cloud = [(w, c) for w, c in cloud if c >= count_last]
+    count_min = min(c for w, c in cloud) if cloud else -1
+    cloud = heapq.nlargest(WORDS_MAX, cloud, key=lambda x: x[1])
+    count_max = cloud[0][1] if cloud else -1
+    for word, count in cloud:
         size = get_word_size(count, count_min, count_max)
         result.append((word, count, size))
-    result.sort(key=lambda x: x[1], reverse=True) # Sort by count
-    result = result[:WORDS_MAX]
     return result
 
 
@@ -209,15 +286,16 @@ def get_common_words(words):
     Returns the defined common words for the specified words, in the language
     that matches best the given words.
 
-    @param   words  a list of words
+    @param   words  a list or dictionary of words
     @return         a list of common words
     """
     best_matches = []
     max_matches = 0
+    if not isinstance(words, (dict, set, frozenset)):
+        words = set(words)
 
-    for language, text in COMMON_WORDS.items():
-        commons = set(re.findall("\w+", text, re.UNICODE))
-        match_count = len(commons.intersection(words))
+    for language, commons in COMMON_WORDS_SETS.items():
+        match_count = sum(1 for w in commons if w in words)
 
         if match_count > max_matches:
             best_matches = commons
@@ -12,7 +12,9 @@ Released under the MIT License.
 @modified    02.11.2013
 ------------------------------------------------------------------------------
 """
+import copy
 import datetime
+import multiprocessing.pool
 import Queue
 import re
 import threading
@@ -28,6 +30,7 @@ import searchparser
 import skypedata
 import templates
 import util
+import wordcloud
 
 
 class WorkerThread(threading.Thread):
@@ -220,73 +223,79 @@ class SearchThread(WorkerThread):
                     count, result_type = 0, "messages"
                     chat_messages = {} # {chat id: [message, ]}
                     chat_order = []    # [chat id, ]
-                    messages = search["db"].get_messages(
-                        additional_sql=sql, additional_params=params,
-                        ascending=False, use_cache=False)
-                    for m in messages:
-                        chat = chat_map.get(m["convo_id"])
-                        chat_title = chat["title_long"]
-                        body = parser.parse(m,
-                            pattern_replace if match_words else None,
-                            html={"w": search["window"].Size.width * 5/9})
-                        count += 1
-                        result_count += 1
-                        result["html"] += template_message.expand(locals())
-                        key = "message:%s" % m["id"]
-                        result["map"][key] = {"chat": chat["id"],
-                                              "message": m["id"]}
-                        if not count % conf.SearchResultsChunk \
-                        and not self._drop_results:
-                            result["count"] = result_count
-                            self.postback(result)
-                            result = {"html": "", "map": {},
-                                      "search": search, "count": 0}
-                        if self._stop_work or count >= conf.SearchMessagesMax:
-                            break # break for m in messages
+                    with search["db"].read_connection("scan"):
+                        messages = search["db"].get_messages(
+                            additional_sql=sql, additional_params=params,
+                            ascending=False, use_cache=False,
+                            fields=skypedata.MESSAGE_FIELDS["search"])
+                        for m in messages:
+                            chat = chat_map.get(m["convo_id"])
+                            chat_title = chat["title_long"]
+                            body = parser.parse(m,
+                                pattern_replace if match_words else None,
+                                html={"w": search["window"].Size.width * 5/9})
+                            count += 1
+                            result_count += 1
+                            result["html"] += template_message.expand(locals())
+                            key = "message:%s" % m["id"]
+                            result["map"][key] = {"chat": chat["id"],
+                                                  "message": m["id"]}
+                            if not count % conf.SearchResultsChunk \
+                            and not self._drop_results:
+                                result["count"] = result_count
+                                self.postback(result)
+                                result = {"html": "", "map": {},
+                                          "search": search, "count": 0}
+                            if self._stop_work \
+                            or count >= conf.SearchMessagesMax:
+                                break # break for m in messages
 
                 infotext = search["table"]
                 if not self._stop_work and "all tables" == search["table"]:
                     infotext, result_type = "", "table row"
                     # Search over all fields of all tables.
-                    for table in search["db"].tables_list:
-                        sql, params, words = \
-                            query_parser.Parse(search["text"], table)
-                        if not sql:
-                            continue # continue for table in search["db"]..
-                        infotext += (", " if infotext else "") + table["name"]
-                        rows = search["db"].execute(sql, params)
-                        row = rows.fetchone()
-                        if not row:
-                            continue # continue for table in search["db"]..
-                        result["html"] = template_table.expand(locals())
-                        count = 0
-                        while row:
-                            count += 1
-                            result_count += 1
-                            result["html"] += template_row.expand(locals())
-                            key = "table:%s:%s" % (table["name"], count)
-                            result["map"][key] = {"table": table["name"],
-                                                  "row": row}
-                            if not count % conf.SearchResultsChunk \
-                            and not self._drop_results:
+                    with search["db"].read_connection("scan") as connection:
+                        for table in search["db"].tables_list:
+                            sql, params, words = \
+                                query_parser.Parse(search["text"], table)
+                            if not sql:
+                                continue # continue for table in search..
+                            infotext += (", " if infotext else "") \
+                                        + table["name"]
+                            rows = search["db"].execute(sql, params,
+                                       connection=connection)
+                            row = rows.fetchone()
+                            if not row:
+                                continue # continue for table in search..
+                            result["html"] = template_table.expand(locals())
+                            count = 0
+                            while row:
+                                count += 1
+                                result_count += 1
+                                result["html"] += template_row.expand(locals())
+                                key = "table:%s:%s" % (table["name"], count)
+                                result["map"][key] = {"table": table["name"],
+                                                      "row": row.copy()}
+                                if not count % conf.SearchResultsChunk \
+                                and not self._drop_results:
+                                    result["count"] = result_count
+                                    self.postback(result)
+                                    result = {"html": "", "map": {},
+                                              "search": search, "count": 0}
+                                if self._stop_work \
+                                or result_count >= conf.SearchTableRowsMax:
+                                    break # break while row
+                                row = rows.fetchone()
+                            if not self._drop_results:
+                                result["html"] += "</table>"
                                 result["count"] = result_count
                                 self.postback(result)
                                 result = {"html": "", "map": {},
                                           "search": search, "count": 0}
+                            infotext += " (%s)" % util.plural("result", count)
                             if self._stop_work \
                             or result_count >= conf.SearchTableRowsMax:
-                                break # break while row
-                            row = rows.fetchone()
-                        if not self._drop_results:
-                            result["html"] += "</table>"
-                            result["count"] = result_count
-                            self.postback(result)
-                            result = {"html": "", "map": {},
-                                      "search": search, "count": 0}
-                        infotext += " (%s)" % util.plural("result", count)
-                        if self._stop_work \
-                        or result_count >= conf.SearchTableRowsMax:
-                            break # break for table in search["db"]..
+                                break # break for table in search["db"]..
                     single_table = ("," not in infotext)
                     infotext = "table%s: %s" % \
                                ("" if single_table else "s", infotext)
@@ -428,42 +437,43 @@ class MergeThread(WorkerThread):
         count_messages = 0
         count_participants = 0
         try:
-            if contacts:
-                content = util.plural("contact", contacts)
-                self.postback({"type": "merge", "gauge": 0,
-                                "message": "Merging %s." % content})
-                db2.insert_contacts(contacts, db1)
-                self.postback({"type": "merge", "gauge": 100,
-                                "message": "Merged %s." % content})
-            if contactgroups:
-                content = util.plural("contact group", contactgroups)
-                self.postback({"type": "merge", "gauge": 0,
-                                "message": "Merging %s." % content})
-                db2.replace_contactgroups(contactgroups, db1)
-                self.postback({"type": "merge", "gauge": 100,
-                                "message": "Merged %s." % content})
-            for index, chat_data in enumerate(chats):
-                if self._stop_work:
-                    break # break for i, chat_data in enumerate(chats)
-                chat1 = chat_data["chat"]["c2" if source else "c1"]
-                chat2 = chat_data["chat"]["c1" if source else "c2"]
-                step = -1 if source else 1
-                messages1, messages2 = chat_data["diff"]["messages"][::step]
-                participants, participants2 = \
-                    chat_data["diff"]["participants"][::step]
-                if not chat2:
-                    chat2 = chat1.copy()
-                    chat_data["chat"]["c1" if source else "c2"] = chat2
-                    chat2["id"] = db2.insert_chat(chat2, db1)
-                if participants:
-                    db2.insert_participants(chat2, participants, db1)
-                    count_participants += len(participants)
-                if messages1:
-                    db2.insert_messages(chat2, messages1, db1, chat1,
-                                        self.yield_ui, self.REFRESH_COUNT)
-                    count_messages += len(messages1)
-                self.postback({"type": "merge", "index": index,
-                                "params": params})
+            with db2.pragma_profile("bulk-write"):
+                if contacts:
+                    content = util.plural("contact", contacts)
+                    self.postback({"type": "merge", "gauge": 0,
+                                    "message": "Merging %s." % content})
+                    db2.insert_contacts(contacts, db1)
+                    self.postback({"type": "merge", "gauge": 100,
+                                    "message": "Merged %s." % content})
+                if contactgroups:
+                    content = util.plural("contact group", contactgroups)
+                    self.postback({"type": "merge", "gauge": 0,
+                                    "message": "Merging %s." % content})
+                    db2.replace_contactgroups(contactgroups, db1)
+                    self.postback({"type": "merge", "gauge": 100,
+                                    "message": "Merged %s." % content})
+                for index, chat_data in enumerate(chats):
+                    if self._stop_work:
+                        break # break for i, chat_data in enumerate(chats)
+                    chat1 = chat_data["chat"]["c2" if source else "c1"]
+                    chat2 = chat_data["chat"]["c1" if source else "c2"]
+                    step = -1 if source else 1
+                    messages1, messages2 = chat_data["diff"]["messages"][::step]
+                    participants, participants2 = \
+                        chat_data["diff"]["participants"][::step]
+                    if not chat2:
+                        chat2 = chat1.copy()
+                        chat_data["chat"]["c1" if source else "c2"] = chat2
+                        chat2["id"] = db2.insert_chat(chat2, db1)
+                    if participants:
+                        db2.insert_participants(chat2, participants, db1)
+                        count_participants += len(participants)
+                    if messages1:
+                        db2.insert_messages(chat2, messages1, db1, chat1,
+                                            self.yield_ui, self.REFRESH_COUNT)
+                        count_messages += len(messages1)
+                    self.postback({"type": "merge", "index": index,
+                                    "params": params})
         except Exception, e:
             error = traceback.format_exc()
         finally:
@@ -492,10 +502,11 @@ class MergeThread(WorkerThread):
            "participants": [[participants different in db1], [..db2]]}.
         """
         c = chat
-        messages1 = db1.get_messages(c["c1"], use_cache=False) \
-                    if c["c1"] else []
-        messages2 = db2.get_messages(c["c2"], use_cache=False) \
-                    if c["c2"] else []
+        fields = skypedata.MESSAGE_FIELDS["diff"]
+        messages1 = db1.get_messages(c["c1"], use_cache=False,
+                                     fields=fields) if c["c1"] else []
+        messages2 = db2.get_messages(c["c2"], use_cache=False,
+                                     fields=fields) if c["c2"] else []
         c1m_diff = [] # Messages different in chat 1
         c2m_diff = [] # Messages different in chat 2
         participants1 = c["c1"]["participants"] if c["c1"] else []
@@ -689,3 +700,194 @@ class DetectDatabaseThread(WorkerThread):
 
                 result = {"done": True, "count": len(all_filenames)}
                 self.postback(result)
+
+
+
+class RowCountThread(WorkerThread):
+    """
+    Table row count background thread, counts exact rows in the given tables
+    of a database and yields the counts back to main thread.
+    """
+
+    def run(self):
+        self._is_running = True
+        while self._is_running:
+            data = self._queue.get()
+            self._stop_work = self._drop_results = False
+            if data:
+                result = {"counts": {}, "db": data["db"]}
+                try:
+                    for table in data["tables"]:
+                        count = data["db"].count_table_rows(table)
+                        result["counts"][table] = count
+                        if self._stop_work:
+                            break # break for table in data["tables"]
+                except Exception, e:
+                    main.log("Error counting rows in %s.\n\n%s",
+                             data["db"], traceback.format_exc())
+                if not self._drop_results:
+                    result["done"] = True
+                    self.postback(result)
+
+
+
+class PrefetchThread(WorkerThread):
+    """
+    Chat prefetch background thread, loads messages of the given chats into
+    the database message cache and parses the latest of them, so that opening
+    these chats later needs no database access. Gives way to any new work,
+    and skips chats that would not fit into the cache without evicting others.
+    """
+
+    def run(self):
+        self._is_running = True
+        while self._is_running:
+            data = self._queue.get()
+            self._stop_work = self._drop_results = False
+            if data:
+                db, prefetched = data["db"], []
+                try:
+                    for chat in data["chats"]:
+                        time.sleep(conf.ChatPrefetchDelay) # Let UI go first
+                        if self._stop_work or not db.is_open():
+                            break # break for chat in data["chats"]
+                        if self.prefetch_chat(db, chat):
+                            prefetched.append(chat["title_long_lc"])
+                except Exception, e:
+                    main.log("Error prefetching chats in %s.\n\n%s",
+                             db, traceback.format_exc())
+                if prefetched:
+                    main.log("Prefetched messages for %s in %s.",
+                             ", ".join(prefetched), db.filename)
+
+
+    def prefetch_chat(self, db, chat):
+        """
+        Loads all chat messages into the database message cache and parses
+        the latest ones, caching their DOMs.
+
+        @return  whether the chat was fully prefetched
+        """
+        cache = db.message_cache
+        messages = cache.peek(chat["id"])
+        if messages is None:
+            size = (chat.get("message_count") or 0) * cache.MESSAGE_SIZE
+            if cache.size + size > cache.budget:
+                return False
+            messages = []
+            for m in db.get_messages(chat, use_cache=False):
+                messages.append(m)
+                if self._stop_work:
+                    return False
+            # Cache only if room, as evicting could drop the chat in use
+            messages = cache.add_if_room(chat["id"], messages)
+            if messages is None:
+                return False
+        parser = skypedata.MessageParser(db)
+        for m in messages[-conf.MaxHistoryInitialMessages:]:
+            if "dom" not in m:
+                parser.parse(m)
+            if self._stop_work:
+                return False
+        return True
+
+
+
+class StatisticsThread(WorkerThread):
+    """
+    Database statistics background thread, aggregates message activity over
+    all chats in a pool of threads, each on a pooled read-only connection,
+    and yields merged partial results back to main thread as chunks of chats
+    complete.
+    """
+
+    """Number of chat chunks per thread, for more frequent partial results."""
+    CHUNKS_PER_THREAD = 4
+
+
+    def run(self):
+        self._is_running = True
+        while self._is_running:
+            data = self._queue.get()
+            self._stop_work = self._drop_results = False
+            if data:
+                db, pool, pending = data["db"], None, []
+                stats = db.get_activity_statistics([])
+                result = {"db": db, "stats": stats}
+                try:
+                    # Leave one pooled connection free for other reads
+                    threads = max(1, conf.DBReadConnectionsMax - 1)
+                    count = threads * self.CHUNKS_PER_THREAD
+                    chunks = self.get_chunks(db, count)
+                    stats["chats_total"] = sum(map(len, chunks))
+                    if chunks:
+                        pool = multiprocessing.pool.ThreadPool(
+                            min(threads, len(chunks)))
+                        pending = [pool.apply_async(db.get_activity_statistics,
+                                                    (x, )) for x in chunks]
+                    while pending and not self._stop_work and db.is_open():
+                        done = [x for x in pending if x.ready()]
+                        if not done:
+                            time.sleep(0.1)
+                            continue # continue while pending
+                        pending = [x for x in pending if x not in done]
+                        for x in done:
+                            skypedata.merge_activity_statistics(stats, x.get())
+                        if pending and not self._drop_results:
+                            self.postback(dict(result,
+                                               stats=copy.deepcopy(stats)))
+                    if conf.DBTermIndexEnabled and not pending \
+                    and not self._stop_work:
+                        if not self._drop_results: # Words can take a while
+                            self.postback(dict(result,
+                                               stats=copy.deepcopy(stats)))
+                        self.collect_words(db, stats)
+                except Exception, e:
+                    main.log("Error collecting statistics for %s.\n\n%s",
+                             db, traceback.format_exc())
+                finally:
+                    if pool:
+                        pool.terminate()
+                if not self._drop_results:
+                    result.update(done=True, complete=not pending)
+                    self.postback(result)
+
+
+    def collect_words(self, db, stats):
+        """
+        Adds the most common words over all chats to statistics as
+        "words": [(word, count), ], from the term frequency index,
+        indexing chats first where needed.
+        """
+        with db.read_connection() as connection:
+            chats = db.execute("SELECT id FROM conversations",
+                               connection=connection).fetchall()
+        for chat in chats:
+            if self._stop_work or not db.is_open():
+                return
+            db.update_term_index(chat)
+        counter = db.get_term_counts()
+        if counter:
+            stats["words"] = [(word, count) for word, count, size
+                              in wordcloud.get_cloud(counter)]
+
+
+    def get_chunks(self, db, count):
+        """
+        Returns the IDs of all chats in the database, split into chunks of
+        similar message counts where known.
+
+        @param   count  maximum number of chunks
+        """
+        with db.read_connection() as connection:
+            ids = [x["id"] for x in db.execute("SELECT id FROM conversations",
+                                               connection=connection)]
+        counts = db.get_metadata("chats") or {} # {"id": [count, first, last]}
+        weights = dict((i, (counts.get(str(i)) or [1])[0] or 1) for i in ids)
+        chunks = [[] for i in range(min(count, len(ids)))]
+        sizes = [0] * len(chunks)
+        for i in sorted(ids, key=weights.get, reverse=True):
+            index = sizes.index(min(sizes)) # Add to the smallest chunk
+            chunks[index].append(i)
+            sizes[index] += weights[i]
+        return chunks
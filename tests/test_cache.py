@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for refreshing cached database content after changes made by other
+programs.
+
+------------------------------------------------------------------------------
+This file is part of Skyperious - a Skype database viewer and merger.
+Released under the MIT License.
+------------------------------------------------------------------------------
+"""
+import random
+import unittest
+
+import testdb
+
+
+class TestExternalChanges(testdb.DatabaseTestMixIn, unittest.TestCase):
+    """Tests SkypeDatabase.clear_cache() after changes by another program."""
+
+    def snapshot(self, db):
+        """Returns cached chats, contacts and messages of the database."""
+        chats = db.get_conversations()
+        messages = [(m["id"], m["body_xml"], m["timestamp"])
+                    for c in chats for m in db.get_messages(c)]
+        return (sorted(messages),
+                sorted((c["id"], c["title"]) for c in chats),
+                sorted((c["identity"], c["name"]) for c in db.get_contacts()))
+
+
+    def assert_fresh(self, db):
+        """Asserts that cached content equals a newly opened database."""
+        fresh = self.open_database()
+        self.assertEqual(self.snapshot(db), self.snapshot(fresh))
+
+
+    def test_delete(self):
+        """Tests that messages deleted elsewhere are dropped from cache."""
+        db = self.open_database()
+        before = self.snapshot(db)
+        connection = self.connect()
+        connection.execute("DELETE FROM messages WHERE id % 7 = 3")
+        connection.commit()
+        db.clear_cache()
+        self.assertNotEqual(self.snapshot(db), before)
+        self.assert_fresh(db)
+
+
+    def test_update(self):
+        """Tests that rows updated elsewhere are reloaded into cache."""
+        db = self.open_database()
+        self.snapshot(db)
+        connection = self.connect()
+        connection.execute("UPDATE messages SET body_xml = 'edited' "
+                           "WHERE id % 11 = 1")
+        connection.execute("UPDATE conversations SET displayname = 'Renamed' "
+                           "WHERE id = 1")
+        connection.execute("UPDATE contacts SET fullname = 'Newname' "
+                           "WHERE id = 1")
+        connection.commit()
+        self.assertEqual(db.get_changed_tables().get("messages"), "changed")
+        db.clear_cache()
+        self.assert_fresh(db)
+
+
+    def test_append(self):
+        """Tests that messages only appended elsewhere are loaded as new."""
+        db = self.open_database()
+        self.snapshot(db)
+        db.count_table_rows("messages")
+        db.mark_unchanged()
+        connection = self.connect()
+        rnd = random.Random(2)
+        for i in range(20):
+            testdb.add_message(connection, rnd, rnd.randint(1, 6), 1500000000)
+        connection.commit()
+        self.assertEqual(db.get_changed_tables().get("messages"), "appended")
+        db.clear_cache()
+        self.assert_fresh(db)
+
+
+    def test_delete_and_append(self):
+        """Tests that appending after a delete is not taken as append only."""
+        db = self.open_database()
+        self.snapshot(db)
+        db.count_table_rows("messages")
+        db.mark_unchanged()
+        connection = self.connect()
+        connection.execute("DELETE FROM messages WHERE id % 5 = 2")
+        rnd = random.Random(3)
+        for i in range(20):
+            testdb.add_message(connection, rnd, rnd.randint(1, 6), 1500000000)
+        connection.commit()
+        self.assertEqual(db.get_changed_tables().get("messages"), "changed")
+        db.clear_cache()
+        self.assert_fresh(db)
+
+
+
+if "__main__" == __name__:
+    unittest.main()
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for replacing raw emoticon texts in plaintext message bodies.
+
+------------------------------------------------------------------------------
+This file is part of Skyperious - a Skype database viewer and merger.
+Released under the MIT License.
+------------------------------------------------------------------------------
+"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "src"))
+import skypedata
+
+
+class TestEmoticonScanner(unittest.TestCase):
+    """Tests skypedata.EmoticonScanner against earlier regex output."""
+
+    """Texts replaced the same as with the earlier per-emoticon regexes."""
+    UNCHANGED = [
+        ("hello :) world", 'hello <ss type="smile">:)</ss> world'),
+        (":p", '<ss type="tongueout">:p</ss>'),
+        (":psi", ":psi"),
+        ("x( ok", '<ss type="angry">x(</ss> ok'),
+        ("max( ok", "max( ok"),
+        ("max(D)", "max(D)"),
+        ("wait(y)", 'wait<ss type="yes">(y)</ss>'),
+        (":px(", '<ss type="tongueout">:p</ss><ss type="angry">x(</ss>'),
+        (":)x(", '<ss type="smile">:)</ss><ss type="angry">x(</ss>'),
+        (":(:(", '<ss type="sad">:(</ss><ss type="sad">:(</ss>'),
+        ("&lt;(", "&lt;("),
+        ("(&lt;)", "(&lt;)"),
+        ("&lt;;)", '&lt;<ss type="wink">;)</ss>'),
+        (":&gt;", ":&gt;"),
+        (":& x", '<ss type="puke">:&</ss> x'),
+        ("\xd0\xbfX=(", "\xd0\xbfX=("),
+        (":p\xd0\xbf", ":p\xd0\xbf"),
+        ("\xc3\xa4 :p", '\xc3\xa4 <ss type="tongueout">:p</ss>'),
+        ("I=)\xd0\xbf", '<ss type="sleepy">I=)</ss>\xd0\xbf'),
+    ]
+
+    """
+    Texts replaced differently from the earlier regexes, as
+    [(text, earlier result, current result)].
+    """
+    CHANGED = [
+        # The longest emoticon is taken, not the first one listed
+        ("|-()", '<ss type="dull">|-(</ss>)', '<ss type="dull">|-()</ss>'),
+        ("(drunk)max &lt;|-();",
+         '<ss type="drunk">(drunk)</ss>max &lt;<ss type="dull">|-(</ss>);',
+         '<ss type="drunk">(drunk)</ss>max &lt;<ss type="dull">|-()</ss>;'),
+        # Word boundary is checked at the character just before the
+        # emoticon, not at the first of up to 16 preceding characters
+        ("!max(wtf)", '!ma<ss type="angry">x(</ss>wtf)', "!max(wtf)"),
+        ("B-)1X(", '<ss type="cool">B-)</ss>1<ss type="angry">X(</ss>',
+         '<ss type="cool">B-)</ss>1X('),
+        # Byte strings are taken as UTF-8, not as single-byte characters
+        ("\xe2\x80\x94x(", "\xe2\x80\x94x(",
+         '\xe2\x80\x94<ss type="angry">x(</ss>'),
+    ]
+
+
+    def setUp(self):
+        parser = skypedata.MessageParser(None)
+        self.repl = parser.EMOTICON_REPL
+        self.scanner = parser.EMOTICON_SCANNER
+
+
+    def test_unchanged(self):
+        """Tests texts replaced the same as before."""
+        for text, expected in self.UNCHANGED:
+            self.assertEqual(self.scanner.sub(self.repl, text), expected)
+
+
+    def test_changed(self):
+        """Tests texts replaced by the changed rules."""
+        for text, earlier, expected in self.CHANGED:
+            result = self.scanner.sub(self.repl, text)
+            self.assertEqual(result, expected)
+            self.assertNotEqual(result, earlier)
+
+
+    def test_unicode(self):
+        """Tests that Unicode and UTF-8 texts give the same result."""
+        for text, expected in self.UNCHANGED:
+            result = self.scanner.sub(self.repl, text.decode("utf-8"))
+            self.assertEqual(result, expected.decode("utf-8"))
+
+
+    def test_contains(self):
+        """Tests finding emoticon texts, also ones inside words."""
+        self.assertTrue(self.scanner.contains("max("))
+        self.assertTrue(self.scanner.contains("hello :)"))
+        self.assertFalse(self.scanner.contains("hello"))
+
+
+
+if "__main__" == __name__:
+    unittest.main()
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for keeping cached chat messages within a memory budget.
+
+------------------------------------------------------------------------------
+This file is part of Skyperious - a Skype database viewer and merger.
+Released under the MIT License.
+------------------------------------------------------------------------------
+"""
+import random
+import unittest
+
+import testdb
+
+
+class TestMessageCache(testdb.DatabaseTestMixIn, unittest.TestCase):
+    """Tests SkypeDatabase message caching with skypedata.MessageCache."""
+
+    def read(self, db, chat):
+        """Returns (ID, body) of all chat messages, read through the cache."""
+        return [(m["id"], m["body_xml"]) for m in db.get_messages(chat)]
+
+
+    def load_sizes(self, db):
+        """Returns {chat ID: estimated size} of fully cached chat messages."""
+        cache = db.message_cache
+        for chat in db.get_conversations():
+            self.read(db, chat)
+        result = dict(cache.sizes)
+        self.assertEqual(cache.size, sum(result.values()))
+        cache.clear()
+        return result
+
+
+    def test_evictions(self):
+        """Tests that reading all chats keeps cache size within budget."""
+        db = self.open_database()
+        chats, cache = db.get_conversations(), db.message_cache
+        sizes = self.load_sizes(db)
+        expected = dict((c["id"], self.read(db, c)) for c in chats)
+        cache.clear()
+        cache.budget = max(sizes.values()) * 2
+        for chat in chats:
+            self.assertEqual(self.read(db, chat), expected[chat["id"]])
+            self.assertLessEqual(cache.size, cache.budget)
+            self.assertEqual(cache.size, sum(cache.sizes.values()))
+        self.assertGreater(cache.stats["evictions"], 0)
+        self.assertLess(len(cache), len(chats))
+        self.assertIn(chats[-1]["id"], cache)
+        for chat in chats: # Evicted chats are read again from database
+            self.assertEqual(self.read(db, chat), expected[chat["id"]])
+
+
+    def test_least_recently_used(self):
+        """Tests that the least recently read chat is evicted first."""
+        db = self.open_database()
+        chats, cache = db.get_conversations(), db.message_cache
+        sizes = self.load_sizes(db)
+        chat1, chat2, chat3 = chats[:3]
+        cache.budget = sizes[chat1["id"]] + max(sizes[chat2["id"]],
+                                                sizes[chat3["id"]])
+        self.read(db, chat1)
+        self.read(db, chat2)
+        self.read(db, chat1) # chat2 is now least recently used
+        hits = cache.stats["hits"]
+        self.read(db, chat3)
+        self.assertEqual(cache.stats["hits"], hits)
+        self.assertEqual(cache.stats["evictions"], 1)
+        self.assertEqual(list(cache), [chat1["id"], chat3["id"]])
+
+
+    def test_oversized_chat(self):
+        """Tests that a single chat over budget is still cached."""
+        db = self.open_database()
+        chats, cache = db.get_conversations(), db.message_cache
+        cache.budget = 1
+        self.read(db, chats[0])
+        self.read(db, chats[1])
+        self.assertEqual(list(cache), [chats[1]["id"]])
+        self.assertEqual(cache.stats["evictions"], 1)
+
+
+    def test_add_if_room(self):
+        """Tests that background loading does not evict other chats."""
+        db = self.open_database()
+        chats, cache = db.get_conversations(), db.message_cache
+        sizes = self.load_sizes(db)
+        chat1, small, large = sorted(chats, key=lambda c: sizes[c["id"]])[:3]
+        cache.budget = sizes[chat1["id"]] + sizes[small["id"]]
+        self.read(db, chat1)
+        messages = list(db.get_messages(large, use_cache=False))
+        self.assertIsNone(cache.add_if_room(large["id"], messages))
+        messages = list(db.get_messages(small, use_cache=False))
+        self.assertIs(cache.add_if_room(small["id"], messages), messages)
+        self.assertEqual(list(cache), [chat1["id"], small["id"]])
+        self.assertEqual(cache.stats["evictions"], 0)
+
+
+    def test_appended_messages(self):
+        """Tests that messages appended elsewhere count towards budget."""
+        db = self.open_database()
+        chats, cache = db.get_conversations(), db.message_cache
+        sizes = self.load_sizes(db)
+        chat1, chat2 = chats[:2]
+        cache.budget = sizes[chat1["id"]] + sizes[chat2["id"]]
+        self.read(db, chat1)
+        self.read(db, chat2)
+        db.count_table_rows("messages")
+        db.mark_unchanged()
+        connection = self.connect()
+        rnd = random.Random(4)
+        for i in range(20):
+            testdb.add_message(connection, rnd, chat2["id"], 1500000000)
+        connection.commit()
+        db.clear_cache()
+        self.assertEqual(list(cache), [chat2["id"]])
+        self.assertEqual(cache.stats["evictions"], 1)
+        self.assertGreater(cache.size, sizes[chat2["id"]])
+        self.assertEqual(cache.size, cache.estimate_size(cache.peek(
+                                                         chat2["id"])))
+
+
+
+if "__main__" == __name__:
+    unittest.main()
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for reading on pooled connections while writing on the main
+connection.
+
+------------------------------------------------------------------------------
+This file is part of Skyperious - a Skype database viewer and merger.
+Released under the MIT License.
+------------------------------------------------------------------------------
+"""
+import threading
+import unittest
+
+import testdb
+
+
+class TestPooledReads(testdb.DatabaseTestMixIn, unittest.TestCase):
+    """Tests SkypeDatabase reads and writes on separate connections."""
+
+    def test_write_during_messages(self):
+        """Tests writing while messages are read in chunks."""
+        db = self.open_database()
+        db.MESSAGES_CHUNK = 50
+        total = db.execute("SELECT COUNT(*) AS count FROM messages WHERE "
+                           "type IN (2, 10, 12, 13, 30, 39, 51, 60, 61, 63, "
+                           "64, 68)").fetchone()["count"]
+        messages = db.get_messages(use_cache=False, additional_sql="1")
+        ids = [next(messages)["id"] for i in range(60)]
+        db.execute("UPDATE messages SET body_xml = 'edited' WHERE id = ?",
+                   [ids[-1]])
+        db.commit()
+        ids += [m["id"] for m in messages]
+        self.assertEqual(len(ids), total)
+        self.assertEqual(len(set(ids)), total)
+
+
+    def test_write_during_query_grid(self):
+        """Tests writing while SQL query results are partly retrieved."""
+        db = self.open_database()
+        grid = db.execute_select("SELECT * FROM messages")
+        grid.SeekToRow(10)
+        db.execute_action("UPDATE messages SET body_xml = 'edited' "
+                          "WHERE id = 1")
+        grid.SeekAhead(to_end=True)
+        self.assertEqual(grid.GetNumberRows(), db.execute(
+            "SELECT COUNT(*) AS count FROM messages").fetchone()["count"])
+
+
+    def test_uncommitted_changes(self):
+        """Tests that reads see changes not yet committed."""
+        db = self.open_database()
+        with db.read_connection() as connection:
+            self.assertIsNot(connection, db.connection)
+        chat = db.get_conversations()[0]
+        db.execute("UPDATE messages SET body_xml = 'pending' "
+                   "WHERE convo_id = ?", [chat["id"]])
+        with db.read_connection() as connection:
+            self.assertIs(connection, db.connection)
+        bodies = [m["body_xml"] for m in db.get_messages(chat,
+                                                         use_cache=False)]
+        self.assertEqual(set(bodies), set(["pending"]))
+        db.commit()
+        with db.read_connection() as connection:
+            self.assertIsNot(connection, db.connection)
+
+
+    def test_concurrent_reads(self):
+        """Tests reading in threads while writing on the main connection."""
+        db = self.open_database()
+        chats, errors = db.get_conversations(), []
+        def read():
+            try:
+                for chat in chats:
+                    list(db.get_messages(chat, use_cache=False))
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=read) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for i in range(20):
+            db.execute("UPDATE messages SET body_xml = ? WHERE id = ?",
+                       ["edited %s" % i, i + 1])
+            db.commit()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+
+
+if "__main__" == __name__:
+    unittest.main()
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for chat statistics taken via the sidecar index database, against
+statistics taken from the Skype database alone.
+
+------------------------------------------------------------------------------
+This file is part of Skyperious - a Skype database viewer and merger.
+Released under the MIT License.
+------------------------------------------------------------------------------
+"""
+import random
+import unittest
+
+import testdb
+import conf
+
+
+class TestSidecarStatistics(testdb.DatabaseTestMixIn, unittest.TestCase):
+    """Tests SkypeDatabase.get_chat_statistics() with and without sidecar."""
+
+    def setUp(self):
+        super(TestSidecarStatistics, self).setUp()
+        self.addCleanup(setattr, conf, "DBSidecarDirectory",
+                        conf.DBSidecarDirectory)
+        conf.DBSidecarDirectory = self.tempdir
+        self.plain = self.open_database()
+        self.indexed = self.open_database()
+        self.indexed.open_sidecar()
+        self.indexed.sidecar.sync(full=True)
+
+
+    def statistics(self, db, chat, **kwargs):
+        """Returns chat statistics, with transfers as (filename, size)."""
+        stats = db.get_chat_statistics(chat, **kwargs)
+        stats["transfers"] = [(f["filename"], f["filesize"])
+                              for f in stats["transfers"]]
+        return stats
+
+
+    def assert_same(self, **kwargs):
+        """Asserts equal statistics for all chats with and without sidecar."""
+        with self.indexed.read_connection() as connection:
+            self.assertTrue(self.indexed.use_sidecar(connection, "messages"))
+        for chat in self.plain.get_conversations():
+            self.assertEqual(self.statistics(self.indexed, chat, **kwargs),
+                             self.statistics(self.plain, chat, **kwargs))
+
+
+    def get_range(self, chat):
+        """Returns (first, last) of the middle half of chat messages."""
+        messages = list(self.plain.get_messages(chat))
+        first = messages[len(messages) // 4]
+        last = messages[len(messages) * 3 // 4]
+        return ((first["timestamp"], first["id"]),
+                (last["timestamp"], last["id"]))
+
+
+    def test_whole_chats(self):
+        """Tests statistics of all chat messages."""
+        self.assert_same()
+        self.assert_same(by_day=True)
+
+
+    def test_ranges(self):
+        """Tests statistics of message ranges spanning several days."""
+        for chat in self.plain.get_conversations():
+            first, last = self.get_range(chat)
+            for kwargs in [{"first": first}, {"last": last},
+                           {"first": first, "last": last},
+                           {"first": first, "last": last, "by_day": True}]:
+                self.assertEqual(self.statistics(self.indexed, chat, **kwargs),
+                                 self.statistics(self.plain, chat, **kwargs))
+            self.assertTrue(self.indexed.sidecar.get_daily(chat["id"]))
+
+
+    def test_message_ids(self):
+        """Tests statistics of selected messages."""
+        for chat in self.plain.get_conversations():
+            ids = [m["id"] for m in self.plain.get_messages(chat)][::3]
+            self.assertEqual(
+                self.statistics(self.indexed, chat, message_ids=ids),
+                self.statistics(self.plain, chat, message_ids=ids))
+
+
+    def test_external_changes(self):
+        """Tests statistics after other programs change the database."""
+        self.assert_same(by_day=True)
+        for chat in self.plain.get_conversations():
+            first, last = self.get_range(chat)
+            self.indexed.get_chat_statistics(chat, first=first, last=last)
+        connection = self.connect()
+        rnd = random.Random(5)
+        for i in range(30):
+            testdb.add_message(connection, rnd, rnd.randint(1, 6),
+                               1300000000 + rnd.randint(0, 6000000))
+        connection.execute("UPDATE messages SET author = 'me' "
+                           "WHERE id % 13 = 4")
+        connection.execute("DELETE FROM messages WHERE id % 17 = 5")
+        connection.commit()
+        for db in self.plain, self.indexed:
+            db.clear_cache()
+        self.indexed.sidecar.sync(full=True)
+        self.assert_same(by_day=True)
+        for chat in self.plain.get_conversations():
+            first, last = self.get_range(chat)
+            self.assertEqual(
+                self.statistics(self.indexed, chat, first=first, last=last),
+                self.statistics(self.plain, chat, first=first, last=last))
+
+
+
+if "__main__" == __name__:
+    unittest.main()
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+Helpers for tests, creating small Skype databases with generated content.
+
+------------------------------------------------------------------------------
+This file is part of Skyperious - a Skype database viewer and merger.
+Released under the MIT License.
+------------------------------------------------------------------------------
+"""
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "src"))
+import skypedata
+
+
+"""Words for generated message bodies."""
+WORDS = u"hello world skype chat merge export sqlite tere maailm :) (y) ;)" \
+        .split()
+
+"""Message types in generated messages, weighted by frequency."""
+MESSAGE_TYPES = [61] * 12 + [30, 39, 60, 64, 68]
+
+
+def make_database(path, chats=6, messages=600, seed=1):
+    """
+    Creates a Skype database file with the specified number of chats and
+    messages, from the same content for the same seed.
+    """
+    rnd = random.Random(seed)
+    connection = sqlite3.connect(path)
+    for sql in skypedata.SkypeDatabase.INSERT_STATEMENTS.values():
+        connection.execute(sql)
+    connection.execute("INSERT INTO accounts (skypename, fullname) "
+                       "VALUES ('me', 'Me Myself')")
+    for i in range(1, chats + 1):
+        group = not i % 3
+        connection.execute("INSERT INTO contacts (skypename, fullname) "
+                           "VALUES (?, ?)", ("user%d" % i, u"User ä %d" % i))
+        connection.execute("INSERT INTO conversations (id, identity, type, "
+            "displayname, creation_timestamp, last_activity_timestamp) "
+            "VALUES (?, ?, ?, ?, 1300000000, 1400000000)",
+            (i, "#group%d" % i if group else "user%d" % i, 2 if group else 1,
+             "Chat %d" % i))
+        connection.execute("INSERT INTO chats (name, conv_dbid) "
+                           "VALUES (?, ?)", ("#chat%d" % i, i))
+        for identity in ["me", "user%d" % i]:
+            connection.execute("INSERT INTO participants (convo_id, identity)"
+                               " VALUES (?, ?)", (i, identity))
+    timestamp = 1300000000
+    for i in range(messages):
+        add_message(connection, rnd, rnd.randint(1, chats), timestamp)
+        timestamp += rnd.randint(0, 20000)
+    connection.commit()
+    connection.close()
+
+
+def add_message(connection, rnd, convo_id, timestamp):
+    """Inserts a generated message into the chat, returns its ID."""
+    author = rnd.choice(["me", "user%d" % convo_id])
+    msgtype = rnd.choice(MESSAGE_TYPES)
+    body = u" ".join(rnd.choice(WORDS) for _ in range(rnd.randint(1, 10)))
+    if 30 == msgtype:
+        body = u'<partlist><part identity="%s"><duration>%d</duration>' \
+               u'</part></partlist>' % (author, rnd.randint(1, 500))
+    guid = sqlite3.Binary("".join(chr(rnd.randint(0, 255))
+                                  for _ in range(8)))
+    cursor = connection.execute("INSERT INTO messages (chatname, timestamp, "
+        "author, from_dispname, chatmsg_type, body_xml, convo_id, type, "
+        "guid) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        ("#chat%d" % convo_id, timestamp, author, author.title(),
+         18 if 30 == msgtype else 7, body, convo_id, msgtype, guid))
+    if 68 == msgtype:
+        connection.execute("INSERT INTO transfers (chatmsg_guid, "
+            "chatmsg_index, filename, filesize, convo_id, partner_handle, "
+            "type) VALUES (?, 0, 'f.txt', '123', ?, ?, 1)",
+            (guid, convo_id, author))
+    elif 64 == msgtype:
+        connection.execute("INSERT INTO smses (chatmsg_id, body) "
+                           "VALUES (?, 'sms body')", (cursor.lastrowid,))
+    elif 30 == msgtype:
+        connection.execute("INSERT INTO calls (conv_dbid, begin_timestamp, "
+                           "duration) VALUES (?, ?, 10)",
+                           (convo_id, timestamp))
+    return cursor.lastrowid
+
+
+class DatabaseTestMixIn(object):
+    """
+    Test case mix-in creating a generated database file in a temporary
+    directory for each test, available as self.filename.
+    """
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tempdir, "main.db")
+        make_database(self.filename)
+        self.dbs = []
+
+
+    def tearDown(self):
+        for db in self.dbs:
+            db.close()
+        shutil.rmtree(self.tempdir, ignore_errors=True)
+
+
+    def open_database(self, **kwargs):
+        """Returns a new SkypeDatabase for the file, closed on teardown."""
+        db = skypedata.SkypeDatabase(self.filename, **kwargs)
+        self.dbs.append(db)
+        return db
+
+
+    def connect(self):
+        """Returns a plain sqlite3 connection to the file, like Skype's."""
+        connection = sqlite3.connect(self.filename)
+        self.addCleanup(connection.close)
+        return connection